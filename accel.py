@@ -0,0 +1,176 @@
+# Native and viper code emitter versions of the hot paths
+#
+# The Itho message codec (ITHOPACKET.message_encode, message_decode and
+# ITHO.checksum) shifts single bits in loops, and MachineBus.transfer
+# runs for every CC1101 register access. Here these are compiled to
+# machine code by MicroPython's native and viper emitters. Modules
+# itho.py and hal.py import this module and replace the portable
+# versions at import time. On CPython, or on a port without these
+# emitters, the import fails and the portable code is used. The
+# results are identical, run conformance.py to check this.
+#
+# When precompiling with mpy-cross specify the architecture, for
+# example: mpy-cross -march=xtensawin accel.py
+#
+# Copyright 2022 (c) Erik de Lange
+# Released under MIT license
+
+import micropython  # not available on CPython, importing this module fails there
+
+
+@micropython.viper
+def encode(data: ptr8, length: int, out: ptr8, size: int) -> int:
+    """ Encode length bytes of data into out from byte 14 on, as ITHOPACKET.message_encode """
+    i = 14
+    while i < size:
+        out[i] = 0
+        i += 1
+
+    start = 14 * 8
+    pos = start  # bit position in out, every bit is followed by its inverse
+    n = 0
+    while n < length:
+        byte = data[n]
+        k = 0
+        while k < 8:
+            if k == 4 or (k == 0 and n > 0):  # 1 0 pattern after every 4 bits
+                out[pos >> 3] = out[pos >> 3] | (1 << (7 - (pos & 7)))
+                pos += 2
+            bit = (byte >> ((k + 4) & 7)) & 1  # bit order 4 5 6 7 0 1 2 3
+            out[pos >> 3] = out[pos >> 3] | (((bit << 1) | (bit ^ 1)) << (6 - (pos & 7)))
+            pos += 2
+            k += 1
+        n += 1
+
+    if pos == start or pos & 7 != 0:  # closing 1 0 patterns fill the last byte
+        while True:
+            out[pos >> 3] = out[pos >> 3] | (1 << (7 - (pos & 7)))
+            pos += 2
+            if pos & 7 == 0:
+                break
+
+    return (pos - 1) >> 3
+
+
+@micropython.viper
+def decode(message: ptr8, start: int, end: int, data: ptr8, chk: ptr8, first: int):
+    """ Decode message[start:end] into data and chk from byte first on, as ITHOPACKET.message_decode """
+    out_i = first
+    out_j = 4
+    out_i_chk = first
+    out_j_chk = 4
+    counter = 0  # 0 2 4 6 data bit, 1 3 5 7 inverted data bit, 8 9 pattern
+
+    i = start
+    while i < end:
+        byte = message[i]
+        j = 7
+        while j >= 0:
+            if counter < 8:
+                bit = (byte >> j) & 1
+                if counter & 1 == 0:
+                    data[out_i] = data[out_i] | (bit << out_j)
+                    out_j = (out_j + 1) & 7
+                    if out_j == 4:
+                        out_i += 1
+                else:
+                    chk[out_i_chk] = chk[out_i_chk] | (bit << out_j_chk)
+                    out_j_chk = (out_j_chk + 1) & 7
+                    if out_j_chk == 4:
+                        chk[out_i_chk] = chk[out_i_chk] ^ 0xFF
+                        out_i_chk += 1
+            counter += 1
+            if counter > 9:
+                counter = 0
+            j -= 1
+        i += 1
+
+
+@micropython.viper
+def checksum_bytes(data: ptr8, length: int) -> int:
+    value = 0
+    i = 0
+    while i < length:
+        value += data[i]
+        i += 1
+    return (0 - value) & 0xFF
+
+
+def message_encode(self, message):
+    """ Replaces ITHOPACKET.message_encode """
+    return encode(self.data_decoded, self.data_length, message.data, len(message.data))
+
+
+def message_decode(self, message, first=0, length=None):
+    """ Replaces ITHOPACKET.message_decode """
+    start = 2 + first * 5 // 2  # relevant data starts 2 bytes after the sync word
+    end = len(message)
+    if length is not None:
+        end = min(end, start + (length * 5 + 1) // 2)
+
+    self.data_length = (end - 2) // 5 * 2 + (1 if (end - 2) % 5 >= 3 else 0)
+    decode(message, start, end, self.data_decoded, self.data_decoded_chk, first)
+
+
+def checksum(itho_packet, length):
+    """ Replaces ITHO.checksum """
+    return checksum_bytes(itho_packet.data_decoded, length)
+
+
+@micropython.native
+def transfer(self, data):
+    """ Replaces MachineBus.transfer """
+    buf = bytearray(len(data))
+    self.ss.value(0)
+    miso = self.miso
+    while miso.value() != 0:
+        pass
+    self.spi.write_readinto(data, buf)
+    self.ss.value(1)
+    return buf
+
+
+if __name__ == "__main__":
+    # Compare the speed of the portable and accelerated codec (on a microcontroller) on
+    # a single frame, then check that they are equivalent on the full conformance corpus
+
+    import time
+
+    from itho import ITHO, ITHOCOMMAND, ITHOPACKET, PORTABLE
+
+    itho = ITHO(None, 22, (116, 233, 94))
+    message = itho.create_message(ITHOCOMMAND.HIGH)
+    frame = bytes(message[12:12 + ITHO.RECEIVE_LENGTH])
+    rounds = 200
+
+    class Message:
+        def __init__(self):
+            self.data = bytearray(128)
+
+    packet = ITHOPACKET()
+    itho.remote_type = 22
+    packet.message_decode(frame)
+
+    for name, portable, accelerated, args in (
+            ("message_encode", PORTABLE[0], message_encode, lambda: (packet, Message())),
+            ("message_decode", PORTABLE[1], message_decode, lambda: (ITHOPACKET(), frame)),
+            ("checksum", PORTABLE[2], checksum, lambda: (packet, 11))):
+        timing = list()
+        results = list()
+        for function in (portable, accelerated):
+            arguments = [args() for _ in range(rounds)]
+            start = time.ticks_us()
+            for a in arguments:
+                result = function(*a)
+            timing.append(time.ticks_diff(time.ticks_us(), start) / rounds)
+            results.append((result, bytes(arguments[-1][0].data_decoded), bytes(arguments[-1][1].data)
+                            if name == "message_encode" else None))
+        print(f"{name}: portable {timing[0]:.0f} us, accelerated {timing[1]:.0f} us, speedup {timing[0] / timing[1]:.1f}x,"
+              f" equal {results[0] == results[1]}")
+
+    import conformance
+
+    codec = (message_encode, message_decode, checksum)
+    print("corpus", conformance.run(conformance.encoder(codec), conformance.decoder(codec)))
+    print("properties", conformance.properties(codec))
+    print("transfer mismatches", conformance.transfer(transfer))
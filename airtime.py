@@ -0,0 +1,158 @@
+# Airtime accounting
+#
+# In the 868 MHz band a transmitter may only be on air for a limited
+# part of the time (duty cycle, 1% in the sub-band used by Itho). The
+# AirtimeLedger books the airtime of every transmission in one bucket
+# per minute, so the sum of the last 60 buckets is the airtime used in
+# the sliding window of the last hour. A transmission which would exceed
+# the budget is delayed until enough airtime becomes available, or
+# rejected if that takes too long. The airtime is reserved before the
+# lock of the radio is taken, so a delayed transmission does not block
+# other use of the radio, and booked at once, so transmissions waiting
+# at the same time cannot exceed the budget together. Airtime which is
+# not used after all is given back to the bucket it was booked in.
+#
+# The minutes are counted with time.ticks_ms(), so setting the clock
+# does not affect the window. The ledger must be used at least once
+# every few days (half the ticks period); after a longer pause old
+# airtime may still be counted, which only delays transmissions.
+#
+# Copyright 2022 (c) Erik de Lange
+# Released under MIT license
+
+import time
+from array import array
+
+import uasyncio as asyncio
+from micropython import const
+
+from cc1101 import CC1101
+from config import AIRTIME_BUDGET_MS
+
+
+class AirtimeExceeded(Exception):
+    pass
+
+
+def data_rate(mdmcfg4, mdmcfg3):
+    """ Return the data rate in baud set by registers MDMCFG4 and MDMCFG3
+
+    See the CC1101 datasheet: R = (256 + DRATE_M) * 2 ^ DRATE_E / 2 ^ 28 * F_XOSC
+    """
+    return ((256 + mdmcfg3) << (mdmcfg4 & 0x0F)) * CC1101.F_XOSC / (1 << 28)
+
+
+class AirtimeLedger:
+    BUCKETS = const(60)  # one bucket per minute, together one hour
+    MINUTE = const(60000)  # ms
+    MAX_WAIT = const(120)  # seconds a transmission may be delayed before it is rejected
+
+    def __init__(self, rate, budget_ms=AIRTIME_BUDGET_MS):
+        """ Create an airtime ledger
+
+        :param float rate: data rate in baud
+        :param int budget_ms: maximum airtime per hour in ms
+        """
+        self.rate = rate
+        self.budget = budget_ms * 1000  # us
+        self.buckets = array("L", [0] * AirtimeLedger.BUCKETS)  # us of airtime per minute
+        self.index = 0  # bucket of the current minute
+        self.start = time.ticks_ms()  # start of the current minute
+        self.frames = 0
+        self.delayed = 0
+        self.rejected = 0
+
+    def airtime(self, length):
+        """ Return the airtime in us of a frame of length bytes """
+        return int(length * 8 * 1000000 / self.rate)
+
+    def _advance(self):
+        """ Empty the buckets of the minutes passed since the last call """
+        elapsed = time.ticks_diff(time.ticks_ms(), self.start)
+        if elapsed < 0:  # more than half the ticks period passed, the whole window has expired
+            elapsed = AirtimeLedger.BUCKETS * AirtimeLedger.MINUTE
+        minutes = elapsed // AirtimeLedger.MINUTE
+        if minutes > 0:
+            for m in range(1, min(minutes, AirtimeLedger.BUCKETS) + 1):
+                self.buckets[(self.index + m) % AirtimeLedger.BUCKETS] = 0
+            self.index = (self.index + minutes) % AirtimeLedger.BUCKETS
+            self.start = time.ticks_add(self.start, minutes * AirtimeLedger.MINUTE)
+
+    def used(self):
+        """ Return the airtime used in the last hour in us """
+        self._advance()
+        return sum(self.buckets)
+
+    def record(self, frames):
+        """ Count frames transmitted, their airtime was booked by reserve() """
+        self.frames += frames
+
+    def wait_time(self, needed):
+        """ Return ms until needed us of airtime fit within the budget
+
+        :param int needed: airtime in us
+        :return int: 0 if it fits now, None if it never fits
+        """
+        if needed > self.budget:
+            return None
+        excess = self.used() + needed - self.budget
+        if excess <= 0:
+            return 0
+        # buckets expire oldest first, the bucket age minutes older than the current one
+        # leaves the window BUCKETS - age minutes after the start of the current minute
+        for age in range(AirtimeLedger.BUCKETS - 1, -1, -1):
+            excess -= self.buckets[(self.index - age) % AirtimeLedger.BUCKETS]
+            if excess <= 0:
+                end = time.ticks_add(self.start, (AirtimeLedger.BUCKETS - age) * AirtimeLedger.MINUTE)
+                return max(1, time.ticks_diff(end, time.ticks_ms()))
+        return None
+
+    async def reserve(self, needed, max_wait=MAX_WAIT):
+        """ Wait until needed us of airtime fit within the budget, and book it
+
+        Call before taking the lock of the radio. If the transmission does
+        not take place after all, give the airtime back with release().
+
+        :param int max_wait: seconds the transmission may be delayed, 0 to fail at once
+        :return int: booking, the ticks_ms() start of the minute the airtime was booked in
+        :raises AirtimeExceeded: if the wait would exceed max_wait seconds
+        """
+        while True:
+            ms = self.wait_time(needed)
+            if ms == 0:
+                self.buckets[self.index] += needed
+                return self.start
+            if ms is None or ms > max_wait * 1000:
+                self.rejected += 1
+                raise AirtimeExceeded(f"{needed // 1000} ms airtime needed, {(self.budget - self.used()) // 1000} ms available")
+            self.delayed += 1
+            await asyncio.sleep_ms(ms)
+
+    def release(self, needed, booking):
+        """ Give back reserved airtime which was not used
+
+        The airtime is taken from the bucket it was booked in, if that is
+        still within the window.
+
+        :param int needed: airtime in us
+        :param int booking: value returned by reserve()
+        """
+        self._advance()
+        age = time.ticks_diff(self.start, booking) // AirtimeLedger.MINUTE
+        if 0 <= age < AirtimeLedger.BUCKETS:
+            index = (self.index - age) % AirtimeLedger.BUCKETS
+            self.buckets[index] -= min(needed, self.buckets[index])
+
+    def as_dict(self):
+        used = self.used()
+        return {
+            "data_rate_baud": int(self.rate),
+            "budget_ms": self.budget // 1000,
+            "used_ms": used // 1000,
+            "used_percent": used / self.budget * 100 if self.budget > 0 else None,
+            "frames": self.frames,
+            "delayed": self.delayed,
+            "rejected": self.rejected,
+            "per_minute_ms": [self.buckets[(self.index - age) % AirtimeLedger.BUCKETS] // 1000
+                              for age in range(AirtimeLedger.BUCKETS - 1, -1, -1)]
+        }
@@ -0,0 +1,185 @@
+# Static file cache
+#
+# Static files are served gzip compressed together with a strong ETag
+# and a Cache-Control header. A browser which already has the current
+# version gets a 304 Not Modified instead of the file. The compressed
+# copy (filename + ".gz") is made once, either on the PC with
+# "gzip -k -9 index.html" and copied to the microcontroller, or on the
+# microcontroller itself if its MicroPython port can compress. A gzip
+# file ends with the CRC-32 and the size of the original, these are
+# compared with the current original to find a stale copy (file times
+# are not reliable, the RTC is not set when files are copied). Small
+# files are kept in RAM as long as they fit in the configured budget.
+#
+# Copyright 2022 (c) Erik de Lange
+# Released under MIT license
+
+import binascii
+import hashlib
+import os
+import struct
+
+from micropython import const
+
+from ahttpserver import HTTPResponse, sendfile
+
+try:
+    import deflate  # MicroPython 1.21 and later
+except ImportError:
+    deflate = None
+
+
+class Asset:
+
+    def __init__(self, filename, mimetype, cache_control):
+        self.filename = filename  # original file
+        self.mimetype = mimetype
+        self.cache_control = cache_control
+        self.path = filename  # file actually served, either original or compressed copy
+        self.gzip = False  # True if path is a gzip compressed copy
+        self.size = 0  # size of path in bytes
+        self.etag = None
+        self.data = None  # content of path if kept in RAM
+
+
+class Assets:
+    CHUNK_SIZE = const(512)
+
+    def __init__(self, budget=8192):
+        """ Create a cache for static files
+
+        :param int budget: maximum number of bytes to keep in RAM
+        """
+        self.budget = budget
+        self.cached = 0  # number of bytes kept in RAM
+        self.assets = dict()  # key is URL path, value is Asset
+
+    def add(self, path, filename, mimetype, cache_control="no-cache"):
+        """ Register a static file
+
+        :param str path: URL path the file is served on
+        :param str filename: file to serve
+        :param str mimetype: content type of the file
+        :param str cache_control: value of the Cache-Control header
+        """
+        asset = Asset(filename, mimetype, cache_control)
+
+        if Assets.compress(filename, filename + ".gz") is True:
+            asset.path = filename + ".gz"
+            asset.gzip = True
+
+        asset.size = 0
+        digest = hashlib.sha256()
+        with open(asset.path, "rb") as fp:
+            while True:
+                chunk = fp.read(Assets.CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                asset.size += len(chunk)
+        asset.etag = '"' + binascii.hexlify(digest.digest()[:8]).decode() + '"'
+
+        if asset.size <= self.budget - self.cached:
+            with open(asset.path, "rb") as fp:
+                asset.data = fp.read()
+            self.cached += asset.size
+
+        self.assets[path] = asset
+
+    @staticmethod
+    def fresh(source, target):
+        """ Check if gzip file target is a compressed copy of the current content of source
+
+        :return bool: False if target does not exist or was made from other content
+        """
+        try:
+            with open(target, "rb") as fp:
+                fp.seek(max(0, os.stat(target)[6] - 8))
+                trailer = fp.read(8)
+            if len(trailer) != 8:
+                return False
+            crc, size = struct.unpack("<II", trailer)  # gzip trailer
+            if size != os.stat(source)[6] & 0xFFFFFFFF:
+                return False
+            if not hasattr(binascii, "crc32"):
+                return True  # port without crc32, only the size can be compared
+            value = 0
+            with open(source, "rb") as fp:
+                while True:
+                    chunk = fp.read(Assets.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    value = binascii.crc32(chunk, value)
+            return value & 0xFFFFFFFF == crc
+        except (OSError, ValueError):
+            return False  # no compressed copy yet
+
+    @staticmethod
+    def compress(source, target):
+        """ Ensure target is an up to date gzip compressed copy of source
+
+        :param str source: filename of the original file
+        :param str target: filename of the compressed copy
+        :return bool: True if target can be used
+        """
+        if Assets.fresh(source, target) is True:
+            return True
+
+        if deflate is None:
+            return False
+
+        try:
+            with open(source, "rb") as src, open(target, "wb") as dst:
+                with deflate.DeflateIO(dst, deflate.GZIP, 9) as gz:
+                    while True:
+                        chunk = src.read(Assets.CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        gz.write(chunk)
+            return True
+        except (AttributeError, OSError, NotImplementedError):
+            # port cannot compress (or flash is full), serve the original
+            try:
+                os.remove(target)
+            except OSError:
+                pass
+            return False
+
+    async def send(self, writer, path, if_none_match=None, accept_encoding=""):
+        """ Send a registered file as response
+
+        :param StreamWriter writer: client connection
+        :param str path: URL path of the file
+        :param str if_none_match: value of the request's If-None-Match header (if any)
+        :param str accept_encoding: value of the request's Accept-Encoding header
+        """
+        asset = self.assets[path]
+
+        if asset.gzip is True and "gzip" not in accept_encoding:
+            # client cannot handle compression (rare), send the original without caching
+            response = HTTPResponse(200, asset.mimetype, header={"Cache-Control": "no-store"})
+            await response.send(writer)
+            await sendfile(writer, asset.filename)
+            return
+
+        header = {"ETag": asset.etag, "Cache-Control": asset.cache_control}
+        if asset.gzip is True:
+            header["Vary"] = "Accept-Encoding"
+
+        if if_none_match is not None and asset.etag in if_none_match:
+            response = HTTPResponse(304, header=header)
+            await response.send(writer)
+            return
+
+        if asset.gzip is True:
+            header["Content-Encoding"] = "gzip"
+        header["Content-Length"] = asset.size
+
+        response = HTTPResponse(200, asset.mimetype, header=header)
+        await response.send(writer)
+
+        if asset.data is not None:
+            writer.write(asset.data)
+            await writer.drain()
+        else:
+            await sendfile(writer, asset.path)
@@ -0,0 +1,206 @@
+# Event broadcasting
+#
+# A single producer formats every event once and hands the result to
+# all subscribed clients, instead of each client connection running
+# its own loop. Clients are connected either via server sent events
+# or via a WebSocket. Clients which cannot keep up are dropped. Every
+# client has one task which writes its data, woken when data is queued.
+# Listeners (e.g. the MQTT bridge) are called with every event.
+#
+# Copyright 2022 (c) Erik de Lange
+# Released under MIT license
+
+import json
+
+import uasyncio as asyncio
+from micropython import const
+
+from websocket import WebSocket
+
+
+class Subscriber:
+
+    def __init__(self, writer, framing):
+        self.writer = writer
+        self.framing = framing  # Broadcaster.SSE or Broadcaster.WEBSOCKET
+        self.busy = False  # True while data is queued or being drained to the client
+        self.pending = None  # data queued, written by the drain task
+        self.missed = 0  # consecutive events skipped because the client was busy
+        self.task = None  # drain task, None until the subscriber is started
+        self.wake = asyncio.Event()  # set when data is queued or the client is closed
+        self.closed = asyncio.Event()
+
+
+class Broadcaster:
+    MAX_SUBSCRIBERS = const(8)
+    MAX_MISSED = const(3)
+    DRAIN_TIMEOUT = const(5)  # seconds
+
+    # Framing of events
+    SSE = const(0)
+    WEBSOCKET = const(1)
+
+    def __init__(self, max_subscribers=MAX_SUBSCRIBERS, max_missed=MAX_MISSED):
+        """ Create a hub for events
+
+        :param int max_subscribers: maximum number of simultaneous clients
+        :param int max_missed: drop a client after missing this many consecutive events
+        """
+        self.max_subscribers = max_subscribers
+        self.max_missed = max_missed
+        self.subscribers = list()
+        self.listeners = list()  # functions called with (event, data) for every event
+        self.dropped = 0  # number of clients dropped for being too slow or gone
+
+    def subscribe(self, writer, framing=SSE):
+        """ Add a client, if there is room for it
+
+        The client takes its place at once, so a connection can be refused
+        before the SSE response header or WebSocket handshake is sent. It
+        receives no events until start() is called after the header or
+        handshake has been written to writer.
+
+        :param StreamWriter writer: client connection
+        :param int framing: Broadcaster.SSE or Broadcaster.WEBSOCKET
+        :return Subscriber: the new subscriber, None if the maximum number of clients is reached
+        """
+        if len(self.subscribers) >= self.max_subscribers:
+            return None
+        subscriber = Subscriber(writer, framing)
+        self.subscribers.append(subscriber)
+        return subscriber
+
+    def start(self, subscriber):
+        """ Start sending events and queued data to a subscriber """
+        if subscriber.task is None and subscriber.closed.is_set() is False:
+            subscriber.task = asyncio.create_task(self._drain(subscriber))
+
+    def listen(self, function):
+        """ Call function(event, data) for every published event """
+        self.listeners.append(function)
+
+    def unsubscribe(self, subscriber):
+        if subscriber in self.subscribers:
+            self.subscribers.remove(subscriber)
+        subscriber.closed.set()
+        subscriber.wake.set()  # end the drain task
+
+    async def serve(self, subscriber):
+        """ Start a subscriber and wait until it is dropped """
+        self.start(subscriber)
+        try:
+            await subscriber.closed.wait()
+        finally:
+            self.unsubscribe(subscriber)
+
+    def publish(self, event, data):
+        """ Send an event to all subscribers
+
+        The payload is formatted once. A client whose previous event is
+        still being drained skips this one. After max_missed consecutive
+        skips the client is considered dead or too slow and is dropped.
+
+        :param str event: event type
+        :param str data: event data (single line)
+        """
+        for listener in self.listeners:
+            listener(event, data)
+
+        if len(self.subscribers) == 0:
+            return
+
+        payload = [None, None]  # formatted event per framing, made when first needed
+
+        for subscriber in tuple(self.subscribers):
+            if subscriber.task is None:
+                continue  # not started yet
+            if subscriber.busy is True:
+                subscriber.missed += 1
+                if subscriber.missed > self.max_missed:
+                    self._drop(subscriber)
+                continue
+            subscriber.missed = 0
+            if payload[subscriber.framing] is None:
+                if subscriber.framing == Broadcaster.SSE:
+                    payload[subscriber.framing] = f"event: {event}\ndata: {data}\n\n".encode()
+                else:
+                    payload[subscriber.framing] = WebSocket.frame(json.dumps({"event": event, "data": data}))
+            self.send(subscriber, payload[subscriber.framing])
+
+    def send(self, subscriber, data):
+        """ Send data to a single subscriber
+
+        Data is queued and written by the drain task of the subscriber,
+        so it is never written while a drain is in progress. Data sent
+        before the subscriber is started is written when it starts.
+
+        :param Subscriber subscriber: client to send to
+        :param bytes data: formatted data
+        """
+        subscriber.pending = data if subscriber.pending is None else subscriber.pending + data
+        subscriber.busy = True
+        subscriber.wake.set()
+
+    async def _drain(self, subscriber):
+        """ Write queued data to a subscriber until it is closed """
+        try:
+            while subscriber.closed.is_set() is False:
+                if subscriber.pending is None:
+                    subscriber.busy = False
+                    await subscriber.wake.wait()
+                    subscriber.wake.clear()
+                    continue
+                data = subscriber.pending
+                subscriber.pending = None
+                subscriber.writer.write(data)
+                await asyncio.wait_for(subscriber.writer.drain(), Broadcaster.DRAIN_TIMEOUT)
+        except Exception:
+            self._drop(subscriber)  # client closed connection or did not respond in time
+        subscriber.busy = False
+        subscriber.pending = None
+
+    def _drop(self, subscriber):
+        if subscriber in self.subscribers:
+            self.subscribers.remove(subscriber)
+            self.dropped += 1
+        subscriber.closed.set()
+        subscriber.wake.set()  # end the drain task
+
+
+if __name__ == "__main__":
+    # Measure the cost of publishing one event to 1, 10 and 50 simulated subscribers
+
+    import gc
+    import time
+
+    class NullWriter:
+        def write(self, data):
+            pass
+
+        async def drain(self):
+            pass
+
+    async def benchmark(clients, rounds=100):
+        hub = Broadcaster(max_subscribers=clients)
+        for _ in range(clients):
+            asyncio.create_task(hub.serve(hub.subscribe(NullWriter())))
+        await asyncio.sleep_ms(0)  # let the subscribers register
+
+        gc.collect()
+        alloc = gc.mem_alloc()
+        start = time.ticks_us()
+        for i in range(rounds):
+            hub.publish("datetime", f"01-01-2022 00:00:{i % 60:02d}")
+            await asyncio.sleep_ms(0)  # let the drain tasks run
+        elapsed = time.ticks_diff(time.ticks_us(), start)
+        alloc = gc.mem_alloc() - alloc
+
+        print(f"{clients:3d} subscribers: {elapsed // rounds:6d} us per event,"
+              f" {elapsed // rounds // clients:5d} us per client, {alloc // rounds:6d} bytes per event")
+
+        for subscriber in tuple(hub.subscribers):
+            hub._drop(subscriber)
+        await asyncio.sleep_ms(0)
+
+    for clients in (1, 10, 50):
+        asyncio.run(benchmark(clients))
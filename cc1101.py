@@ -9,16 +9,13 @@
 # Copyright 2021 (c) Erik de Lange
 # Released under MIT license
 
-import time
-
-from machine import SPI, Pin
-from micropython import const
-
 import config  # hardware dependent configuration
+from hal import const, time
 
 
 class CC1101:
     FIFO_BUFFER_SIZE = const(64)
+    F_XOSC = const(26000000)  # Hz, crystal frequency
 
     # Transfer types
     WRITE_SINGLE_BYTE = const(0x00)
@@ -171,56 +168,77 @@ class CC1101:
     STATE_RXFIFO_OVERFLOW = const(0x60)  # RX FIFO has overflowed
     STATE_TXFIFO_UNDERFLOW = const(0x70)  # TX FIFO has underflowed
 
-    def __init__(self, spi_id, ss, gd02):
+    def __init__(self, spi_id=None, ss=None, gd02=None, bus=None):
         """ Create a CC1101 object connected to a microcontroller SPI channel
 
         This class assumes the usage of SPI hardware channels and the
         corresponding (hardwired) pins. Software SPI is not supported.
         Pin gd02 is only used when receiving messages, not when sending.
+        Alternatively pass a bus from hal.py, e.g. a SpidevBus on Linux.
 
         :param int spi_id: microcontroller SPI channel id
         :param int ss: microcontroller pin number used for slave select (SS)
         :param int gd02: microcontroller pin number connected to port GD02 of the CC1101
+        :param bus: hal.MachineBus or hal.SpidevBus, replaces spi_id, ss and gd02
         """
-        if spi_id not in config.SPI_ID_LIST:
-            raise ValueError(f"invalid SPI id {spi_id} for {config.BOARD}")
-
-        self.miso = Pin(config.MISO_PIN_PER_SPI_ID[str(spi_id)])
-        self.ss = Pin(ss, mode=Pin.OUT)
-        self.gd02 = Pin(gd02, mode=Pin.IN)
-        self.deselect()
-        self.spi = SPI(spi_id, baudrate=8000000, polarity=0, phase=0, bits=8,
-                       firstbit=SPI.MSB)  # use default pins for mosi, miso and sclk
+        if bus is None:
+            if spi_id not in config.SPI_ID_LIST:
+                raise ValueError(f"invalid SPI id {spi_id} for {config.BOARD}")
+
+            from hal import MachineBus
+            bus = MachineBus(spi_id, ss, gd02, config.MISO_PIN_PER_SPI_ID[str(spi_id)])
+
+        self.bus = bus
+        self.gd02 = bus.gd02
+        self.batch = None  # transactions collected between start_batch() and end_batch()
         self.reset()
 
-    def select(self):
-        """ CC1101 chip select """
-        self.ss.value(0)
+    def start_batch(self):
+        """ Collect command strobes and register writes instead of performing them
+
+        The collected transactions are passed to the bus together, which
+        on Linux takes a single system call instead of one per register.
+        A register read first performs the transactions collected so far.
+        """
+        if self.batch is None:
+            self.batch = list()
+
+    def flush(self):
+        """ Perform the collected transactions, keep collecting """
+        if self.batch:
+            self.bus.transfers(self.batch)
+            self.batch = list()
+
+    def end_batch(self):
+        """ Perform the collected transactions and stop collecting """
+        self.flush()
+        self.batch = None
 
-    def deselect(self):
-        """ CC1101 chip deselect """
-        self.ss.value(1)
+    def write(self, data):
+        """ Perform a write transaction, or collect it when batching
 
-    def spi_wait_miso(self):
-        """ Wait for CC1101 SO to go low """
-        while self.miso.value() != 0:
-            pass
+        :param bytes data: header byte followed by the data bytes
+        :return int: status byte, None when batching
+        """
+        if self.batch is not None:
+            self.batch.append(data)
+            return None
+        return self.bus.transfer(data)[0]
+
+    def read(self, data):
+        """ Perform a read transaction after the collected ones
+
+        :param bytes data: header byte followed by dummy bytes
+        :return bytearray: status byte followed by the bytes read
+        """
+        self.flush()
+        return self.bus.transfer(data)
 
     def reset(self):
         """ CC1101 reset """
-        self.deselect()
-        time.sleep_us(5)
-        self.select()
-        time.sleep_us(10)
-        self.deselect()
-        time.sleep_us(45)
-        self.select()
-
-        self.spi_wait_miso()
+        self.bus.wake()
         self.write_command(CC1101.SRES)
         time.sleep_ms(10)
-        # self.spi_wait_miso()
-        self.deselect()
 
     def write_command(self, command):
         """ Write command strobe
@@ -230,14 +248,9 @@ class CC1101:
         burst bit set to 0.
 
         :param int command: strobe byte
-        :return int: status byte
+        :return int: status byte (None when batching)
         """
-        buf = bytearray((command,))
-        self.select()
-        self.spi_wait_miso()
-        self.spi.write(buf)
-        self.deselect()
-        return buf[0]
+        return self.write(bytes((command,)))
 
     def write_register(self, address, data):
         """ Write single byte to configuration register
@@ -248,13 +261,7 @@ class CC1101:
         :param int address: byte address of register
         :param int data: byte to write to register
          """
-        buf = bytearray(2)
-        buf[0] = address | CC1101.WRITE_SINGLE_BYTE
-        buf[1] = data
-        self.select()
-        self.spi_wait_miso()
-        self.spi.write(buf)
-        self.deselect()
+        self.write(bytes((address | CC1101.WRITE_SINGLE_BYTE, data)))
 
     def read_register(self, address, register_type=0x80):
         """ Read value from configuration or status register
@@ -267,27 +274,34 @@ class CC1101:
         :param int register_type: C1101.CONFIG_REGISTER (default) or STATUS_REGISTER
         :return int: register value (byte)
         """
-        read_buf = bytearray(2)
-        write_buf = bytearray(2)
-        write_buf[0] = address | register_type
-        self.select()
-        self.spi_wait_miso()
-        self.spi.write_readinto(write_buf, read_buf)
+        header = bytes((address | register_type, 0))
+        value = self.read(header)[1]
 
         """ CC1101 SPI/26 Mhz synchronization bug - see CC1101 errata
             When reading the following registers two consecutive reads
             must give the same result to be OK. """
         if address in [CC1101.FREQEST, CC1101.MARCSTATE, CC1101.RXBYTES,
                        CC1101.TXBYTES, CC1101.WORTIME0, CC1101.WORTIME1]:
-            value = read_buf[1]
             while True:
-                self.spi.write_readinto(write_buf, read_buf)
-                if value == read_buf[1]:
+                again = self.bus.transfer(header)[1]
+                if value == again:
                     break
-                value = read_buf[1]
+                value = again
 
-        self.deselect()
-        return read_buf[1]
+        return value
+
+    def rssi(self):
+        """ Return the received signal strength in dBm
+
+        The RSSI register keeps its value when the CC1101 leaves RX,
+        so after receiving a packet it holds the strength of the packet.
+        The offset of 74 dB applies to 868 MHz at 38.4 kBaud (datasheet
+        section 17.3).
+
+        :return int: RSSI in dBm
+        """
+        raw = self.read_register(CC1101.RSSI, CC1101.STATUS_REGISTER)
+        return (raw - 256 if raw >= 128 else raw) // 2 - 74
 
     def read_register_median_of_3(self, address):
         """ Read register 3 times and return median value """
@@ -306,11 +320,7 @@ class CC1101:
         """
         buf = bytearray(length + 1)
         buf[0] = address | CC1101.READ_BURST
-        self.select()
-        self.spi_wait_miso()
-        self.spi.write_readinto(buf, buf)
-        self.deselect()
-        return buf[1:]
+        return self.read(buf)[1:]
 
     def write_burst(self, address, data):
         """ Write data to consecutive registers
@@ -321,10 +331,7 @@ class CC1101:
         buf = bytearray(1)
         buf[0] = address | CC1101.WRITE_BURST
         buf[1:1] = data  # append data
-        self.select()
-        self.spi_wait_miso()
-        self.spi.write(buf)
-        self.deselect()
+        self.write(buf)
 
     def receive_data(self, length):
         """ Read available bytes from the FIFO
@@ -340,9 +347,11 @@ class CC1101:
         else:
             buf = self.read_burst(CC1101.RXFIFO, rx_bytes)
 
+        self.start_batch()
         self.write_command(CC1101.SIDLE)
         self.write_command(CC1101.SFRX)  # Flush RX buffer
         self.write_command(CC1101.SRX)  # Switch to RX state
+        self.end_batch()
 
         return buf
 
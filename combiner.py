@@ -0,0 +1,183 @@
+# Soft decision combining of repeated Itho messages
+#
+# A remote sends every command several times. In a noisy environment
+# each copy may contain bit errors, in which case ITHO.parse_message()
+# marks it UNKNOWN as a command byte differs from its check byte. Each
+# copy however contains every command bit twice (as data and as
+# inverted check bit), so with a few copies the correct value of most
+# bits can be found by majority voting. The FrameCombiner groups the
+# copies with the same remote type, id and counter which arrive within
+# a short time window and votes on the command bytes. A bit needs a
+# strict majority; on a tie it is undecided and nothing is delivered.
+# A single copy never decides, as its data and check bit would tie on
+# every error, so at least MIN_COPIES copies are needed.
+#
+# Copyright 2022 (c) Erik de Lange
+# Released under MIT license
+
+from hal import const, time
+from itho import ITHOCOMMAND
+
+
+class FrameCombiner:
+    WINDOW = const(500)  # ms in which copies of a message are expected
+    GROUPS = const(4)  # number of messages combined simultaneously
+    COPIES = const(8)  # maximum number of copies per message
+    MIN_COPIES = const(2)  # copies needed before a command is voted
+    KEY = const(5)  # bytes identifying a message: remote type, remote id and counter
+
+    def __init__(self):
+        # Preallocated storage per group: key, time of first copy, number of copies,
+        # command bytes and check bytes of every copy
+        self.key = bytearray(FrameCombiner.KEY * FrameCombiner.GROUPS)
+        self.start = [0] * FrameCombiner.GROUPS
+        self.copies = bytearray(FrameCombiner.GROUPS)
+        self.delivered = bytearray(FrameCombiner.GROUPS)
+        self.data = [bytearray(6 * FrameCombiner.COPIES) for _ in range(FrameCombiner.GROUPS)]
+        self.chk = [bytearray(6 * FrameCombiner.COPIES) for _ in range(FrameCombiner.GROUPS)]
+        self.commands = {bytes(value): key for key, value in ITHOCOMMAND.default.items()}
+        self.recovered = 0  # number of messages recovered by combining
+
+    def add(self, packet, now=None):
+        """ Add a copy which could not be decoded
+
+        :param ITHOPACKET packet: packet with command UNKNOWN
+        :param int now: time.ticks_ms() of reception
+        :return ITHOPACKET: packet with recovered command, None if not (yet) recovered
+        """
+        if now is None:
+            now = time.ticks_ms()
+
+        group = self._group(packet.data_decoded, now)
+        if self.delivered[group] == 1 or self.copies[group] == FrameCombiner.COPIES:
+            return None
+
+        offset = 7 if packet.remote_type in [24, 28] else 5
+        base = self.copies[group] * 6
+        self.data[group][base:base + 6] = packet.data_decoded[offset:offset + 6]
+        self.chk[group][base:base + 6] = packet.data_decoded_chk[offset:offset + 6]
+        self.copies[group] += 1
+        if self.copies[group] < FrameCombiner.MIN_COPIES:
+            return None
+
+        voted = self.vote(group)
+        if voted is None:
+            return None
+        command = self.commands.get(bytes(voted), ITHOCOMMAND.UNKNOWN)
+        if command == ITHOCOMMAND.UNKNOWN:
+            return None
+
+        self.delivered[group] = 1
+        self.recovered += 1
+        packet.data_decoded[offset:offset + 6] = voted
+        packet.data_decoded_chk[offset:offset + 6] = voted
+        packet.command = command
+        return packet
+
+    def _match(self, group, data):
+        """ Check if the first KEY bytes of data are the key of group """
+        base = group * FrameCombiner.KEY
+        for i in range(FrameCombiner.KEY):
+            if self.key[base + i] != data[i]:
+                return False
+        return True
+
+    def _group(self, data, now):
+        """ Return the group for the key in data, reusing an expired or the oldest group if new """
+        oldest = 0
+        for i in range(FrameCombiner.GROUPS):
+            if self.copies[i] > 0 and self._match(i, data) \
+                    and time.ticks_diff(now, self.start[i]) < FrameCombiner.WINDOW:
+                return i
+            if time.ticks_diff(self.start[oldest], self.start[i]) > 0:
+                oldest = i
+        base = oldest * FrameCombiner.KEY
+        for i in range(FrameCombiner.KEY):
+            self.key[base + i] = data[i]
+        self.start[oldest] = now
+        self.copies[oldest] = 0
+        self.delivered[oldest] = 0
+        return oldest
+
+    def vote(self, group):
+        """ Majority vote over all data and check copies of the command bytes
+
+        :return bytearray: 6 voted command bytes, None if a bit is undecided (tie)
+        """
+        copies = self.copies[group]
+        data = self.data[group]
+        chk = self.chk[group]
+        voted = bytearray(6)
+
+        for i in range(6):
+            value = 0
+            for bit in range(8):
+                mask = 1 << bit
+                ones = 0
+                for copy in range(i, copies * 6, 6):
+                    if data[copy] & mask:
+                        ones += 1
+                    if chk[copy] & mask:
+                        ones += 1
+                if ones == copies:
+                    return None
+                if ones > copies:
+                    value |= mask
+            voted[i] = value
+
+        return voted
+
+
+if __name__ == "__main__":
+    # Simulate repeated transmissions with random bit errors and compare the number
+    # of commands decoded from single copies with the number decoded by combining.
+
+    import random
+
+    from itho import ITHO
+
+    itho = ITHO(None, 22, (116, 233, 94))
+    itho.duplicates = None  # every copy is parsed
+    combiner = FrameCombiner()
+
+    COPIES_PER_PRESS = 3
+    PRESSES = 200
+    START = 12  # received data starts after sync word 179, 42 at message positions 10 and 11
+
+    # a single copy with a bit error is never delivered, not even when its data byte is a valid command
+    message = itho.create_message_command(ITHOCOMMAND.LOW)
+    received = message[START:START + 63] + bytearray(max(0, 63 - len(message) + START))
+    packet = itho.parse_message(received)
+    packet.data_decoded[5] ^= 0x01
+    print("single copy with a bit error not delivered:", FrameCombiner().add(packet, 0) is None)
+
+    for error_rate in (0.002, 0.005, 0.01, 0.02):
+        single = combined = wrong = 0
+        for press in range(PRESSES):
+            itho.counter = press & 0xFF
+            command = ITHOCOMMAND.LOW + press % 6
+            message = itho.create_message_command(command)
+            message = message[START:START + 63] + bytearray(max(0, 63 - len(message) + START))
+
+            decoded = recovered = False
+            for copy in range(COPIES_PER_PRESS):
+                received = bytearray(message)
+                for i in range(len(received)):
+                    for bit in range(8):
+                        if random.random() < error_rate:
+                            received[i] ^= 1 << bit
+                packet = itho.parse_message(received)
+                if packet.command == command:
+                    decoded = True
+                elif packet.command == ITHOCOMMAND.UNKNOWN:
+                    packet = combiner.add(packet, press * FrameCombiner.WINDOW * 2 + copy * 40)
+                    if packet is not None:
+                        if packet.command == command:
+                            recovered = True
+                        else:
+                            wrong += 1
+            single += decoded
+            combined += decoded or recovered
+
+        print(f"bit error rate {error_rate}: {single} of {PRESSES} presses decoded from a single copy,"
+              f" {combined} with combining, {wrong} wrong commands delivered")
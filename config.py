@@ -19,6 +19,16 @@ SPI_ID = 1  # Hardware SPI channel ID to use for communication with your CC1101
 SS_PIN = 34  # Slave select pin connected to CC1101's CSn. Dependent on your hardware design
 GD02_PIN = 38  # Pin connected to CC101's GD02 pin. Dependent on your hardware design
 
+# The CC1101's used by the controller. Every radio has its own SPI channel
+# ID (from SPI_ID_LIST) or slave select pin, its own GD02 pin and a role:
+# "tx" (only transmit), "rx" (only receive) or "both". With one radio for
+# transmitting and one for receiving the controller keeps listening to the
+# physical remote while sending a command. Example for two radios:
+# RADIOS = ({"spi_id": 1, "ss": 34, "gd02": 38, "role": "tx"},
+#           {"spi_id": 1, "ss": 33, "gd02": 37, "role": "rx"})
+
+RADIOS = ({"spi_id": SPI_ID, "ss": SS_PIN, "gd02": GD02_PIN, "role": "both"},)
+
 # The constants below can be set later, after discovering their values by
 # running itho.py via the repl
 
@@ -38,3 +48,65 @@ ITHO_HIGH_BYTES = (34, 241, 3, 99, 4, 4)
 ITHO_TIMER1_BYTES = (34, 243, 3, 99, 0, 10)
 ITHO_TIMER2_BYTES = (34, 243, 3, 99, 0, 20)
 ITHO_TIMER3_BYTES = (34, 243, 3, 99, 0, 30)
+
+# NTP servers queried simultaneously to synchronize the clock
+
+NTP_SERVERS = ("0.pool.ntp.org", "1.pool.ntp.org", "2.pool.ntp.org")
+
+# Timezone. The RTC runs in UTC, local time uses these offsets from UTC
+# in seconds. Daylight saving time follows the EU rule, set both offsets
+# to the same value if your timezone has no daylight saving time.
+
+TZ_STANDARD_OFFSET = 3600  # CET
+TZ_DAYLIGHT_OFFSET = 7200  # CEST
+TZ_FIRST_YEAR = 2022  # first year of the precomputed transition table
+TZ_YEARS = 30  # number of years in the transition table
+
+# Desired accuracy of the clock in ms. The interval between time
+# synchronizations adapts to the measured drift of the RTC to reach it.
+
+CLOCK_TARGET_MS = 250
+
+# Maximum airtime of the transmitter in ms per hour. Itho uses the 868.0 -
+# 868.6 MHz sub-band where the duty cycle is limited to 1% (36 seconds
+# per hour). Commands which would exceed it are delayed or rejected.
+
+AIRTIME_BUDGET_MS = 36000
+
+# Wake-on-Radio. If WOR_INTERVAL_MS is above 0 the receiver sleeps and
+# wakes up every WOR_INTERVAL_MS to listen for WOR_RX_TIME, where 0 is
+# 12.5% of the interval and every next value halves it. Itho messages
+# have a short preamble, so only about this fraction of the messages is
+# received. 0 keeps the receiver on continuously.
+
+WOR_INTERVAL_MS = 0
+WOR_RX_TIME = 0
+
+# MQTT. If MQTT_BROKER is not None the controller keeps a connection to
+# this broker. It publishes the fan state, scheduler settings and metrics
+# as retained messages under MQTT_PREFIX (e.g. itho/fanstate), and accepts
+# commands on MQTT_PREFIX/command ("low", "medium", "high", "timer10",
+# "timer20", "timer30", "join" or "leave") and new scheduler settings on
+# MQTT_PREFIX/scheduler/set ({"start_low": "22:30"}).
+
+MQTT_BROKER = None  # host name or IP address
+MQTT_PORT = 1883
+MQTT_USER = None
+MQTT_PASSWORD = None
+MQTT_PREFIX = "itho"
+
+# Log. Records are kept in a ring buffer of LOG_SLOTS records in RAM and
+# can be read via /api/log. Records below LOG_LEVEL (10 debug, 20 info,
+# 30 warning, 40 error, 50 critical) are discarded. If LOG_ECHO is True
+# every record is also printed on the console.
+
+LOG_LEVEL = 20
+LOG_SLOTS = 128
+LOG_ECHO = False
+
+# Watchdog. If WDT_TIMEOUT_MS is above 0 the microcontroller resets when
+# the event loop is blocked for this long (see lag.py). Once started the
+# watchdog cannot be stopped, so leave it at 0 when stopping the
+# controller from the REPL or via /api/stop during development.
+
+WDT_TIMEOUT_MS = 0
@@ -0,0 +1,323 @@
+# Conformance of the Itho message codec
+#
+# A corpus of reference frames covers every command, several remote
+# types and remote ids, and all counter values. The SHA-256 digests of
+# the frames produced by the reference encoder (ITHO.create_message)
+# and of the results of the reference decoder (ITHO.parse_message) are
+# recorded below, so a change in the codec output is detected without
+# storing the corpus. The decoder is fed the frames as remotes send
+# them (remote_message()): remote types 24 and 28 have the command
+# bytes at offset 7, a layout create_message() does not build. Every
+# frame must decode to the command it was built for.
+#
+# The reference is always the portable codec (itho.PORTABLE), also when
+# itho.py has replaced it by the native/viper version from accel.py.
+# run() checks any alternative encoder and decoder frame by frame
+# against the reference and reports mismatches and speed; encoder() and
+# decoder() turn a codec into these. properties() checks encode/decode
+# round trips on random data, partial decoding, the checksum and the DC
+# balance of the encoding. transfer() compares the native version of
+# MachineBus.transfer with the portable one on a mock SPI bus.
+#
+# Copyright 2022 (c) Erik de Lange
+# Released under MIT license
+
+import hashlib
+import random
+from binascii import hexlify
+
+import itho
+from hal import PORTABLE_TRANSFER, MachineBus, time
+from itho import CC1101MESSAGE, ITHO, ITHOCOMMAND, ITHOPACKET, PORTABLE
+
+REMOTE_TYPES = (22, 24, 28)
+REMOTE_IDS = ((116, 233, 94), (0, 0, 0), (255, 255, 255), (1, 128, 254))
+COMMANDS = (ITHOCOMMAND.JOIN, ITHOCOMMAND.LEAVE, ITHOCOMMAND.LOW, ITHOCOMMAND.MEDIUM, ITHOCOMMAND.HIGH,
+            ITHOCOMMAND.TIMER1, ITHOCOMMAND.TIMER2, ITHOCOMMAND.TIMER3)
+
+# (message_encode, message_decode, checksum) of accel.py, None if not available
+ACCELERATED = None if itho.accel is None else \
+    (itho.accel.message_encode, itho.accel.message_decode, itho.accel.checksum)
+
+# SHA-256 of the default corpus, created with the reference implementation
+GOLDEN_ENCODE = "6cb04e21b859b632376f786b4f28128cebbfab7aa7cbd47f03bf3aae6e96a430"
+GOLDEN_DECODE = "2b606e233c98987d781e9a36b031c8a3112ebc7776f4ea81ebeb6305c11ece05"
+
+
+def corpus(remote_types=REMOTE_TYPES, remote_ids=REMOTE_IDS, counters=range(256), commands=COMMANDS):
+    """ Yield the parameters of every message in the corpus
+
+    :return tuple: (remote type, remote id, counter, command)
+    """
+    for remote_type in remote_types:
+        for remote_id in remote_ids:
+            for command in commands:
+                for counter in counters:
+                    yield remote_type, remote_id, counter, command
+
+
+def install(codec):
+    """ Make ITHOPACKET and ITHO use codec (message_encode, message_decode, checksum)
+
+    :return tuple: the codec used before
+    """
+    previous = (ITHOPACKET.message_encode, ITHOPACKET.message_decode, ITHO.checksum)
+    ITHOPACKET.message_encode = codec[0]
+    ITHOPACKET.message_decode = codec[1]
+    ITHO.checksum = staticmethod(codec[2])
+    return previous
+
+
+def encoder(codec):
+    """ Return a function which returns the message sent for command using codec, including preamble and sync word """
+    def encode(remote_type, remote_id, counter, command):
+        previous = install(codec)
+        try:
+            remote = ITHO(None, remote_type, remote_id)
+            remote.counter = counter
+            return remote.create_message(command)
+        finally:
+            install(previous)
+    return encode
+
+
+def decoder(codec):
+    """ Return a function which returns (remote type, remote id, counter, command) of a received frame using codec
+
+    The frame is ITHO.RECEIVE_LENGTH bytes following the sync word.
+    """
+    def decode(frame):
+        previous = install(codec)
+        try:
+            receiver = ITHO(None)
+            receiver.duplicates = None
+            packet = receiver.parse_message(frame)
+            return packet.remote_type, tuple(packet.remote_id), packet.counter, packet.command
+        finally:
+            install(previous)
+    return decode
+
+
+reference_encode = encoder(PORTABLE)
+reference_decode = decoder(PORTABLE)
+
+
+def remote_message(remote_type, remote_id, counter, command):
+    """ Return the message a remote of remote_type sends for command, using the reference codec
+
+    Remote types 24 and 28 send two more bytes before the command
+    bytes, so these are at offset 7 and the checksum at offset 13.
+    Other types send what ITHO.create_message() builds.
+    """
+    if remote_type not in (24, 28):
+        return reference_encode(remote_type, remote_id, counter, command)
+
+    previous = install(PORTABLE)
+    try:
+        packet = ITHOPACKET()
+        message = CC1101MESSAGE()
+        ITHO.create_message_start(message)
+
+        data = packet.data_decoded
+        data[0] = remote_type
+        data[1], data[2], data[3] = remote_id
+        data[4] = counter
+        data[5] = data[6] = 0
+        command_bytes = ITHOCOMMAND.commandbytes(command)
+        for i in range(len(command_bytes)):
+            data[i + 7] = command_bytes[i]
+        data[13] = ITHO.checksum(packet, 13)
+        packet.data_length = 14
+
+        message.length = packet.message_encode(message)
+        message.length += 1
+        message.data[message.length] = 172
+        message.length += 1
+        for i in range(message.length, message.length + 7):
+            message.data[i] = 170
+        message.length += 7
+        return message.data[:message.length]
+    finally:
+        install(previous)
+
+
+def frame(message):
+    """ Return the bytes of message a receiver delivers: the fixed length after the sync word, padded with preamble """
+    received = bytearray(message[12:12 + ITHO.RECEIVE_LENGTH])
+    while len(received) < ITHO.RECEIVE_LENGTH:
+        received.append(170)
+    return received
+
+
+def digest(h):
+    return hexlify(h.digest()).decode()
+
+
+def run(encode=reference_encode, decode=reference_decode, counters=range(256), verbose=True):
+    """ Check an encoder and decoder against the reference implementation
+
+    :param function encode: (remote type, remote id, counter, command) -> message
+    :param function decode: frame -> (remote type, remote id, counter, command)
+    :param counters: counter values to include, the digests only apply to range(256)
+    :return dict: mismatches per function, frames the reference decodes wrong, digests and us per call
+    """
+    result = {"frames": 0, "encode_mismatch": 0, "decode_mismatch": 0, "decode_wrong": 0, "encode_us": 0,
+              "decode_us": 0}
+    encoded = hashlib.sha256()
+    decoded = hashlib.sha256()
+
+    for remote_type, remote_id, counter, command in corpus(counters=counters):
+        expected = reference_encode(remote_type, remote_id, counter, command)
+        start = time.ticks_us()
+        message = encode(remote_type, remote_id, counter, command)
+        result["encode_us"] += time.ticks_diff(time.ticks_us(), start)
+        if bytes(message) != bytes(expected):
+            result["encode_mismatch"] += 1
+            if verbose and result["encode_mismatch"] == 1:
+                print("first encode mismatch", remote_type, remote_id, counter, command)
+        encoded.update(message)
+
+        received = frame(remote_message(remote_type, remote_id, counter, command))
+        reference = reference_decode(received)
+        if reference != (remote_type, remote_id, counter, command):
+            result["decode_wrong"] += 1
+            if verbose and result["decode_wrong"] == 1:
+                print("first wrong decode", remote_type, remote_id, counter, command, reference)
+        start = time.ticks_us()
+        values = decode(received)
+        result["decode_us"] += time.ticks_diff(time.ticks_us(), start)
+        if tuple(values) != reference:
+            result["decode_mismatch"] += 1
+            if verbose and result["decode_mismatch"] == 1:
+                print("first decode mismatch", remote_type, remote_id, counter, command, values, reference)
+        decoded.update(bytes((values[0],) + tuple(values[1]) + (values[2], values[3])))
+
+        result["frames"] += 1
+
+    result["encode_digest"] = digest(encoded)
+    result["decode_digest"] = digest(decoded)
+    if len(counters) == 256:
+        result["golden"] = result["encode_digest"] == GOLDEN_ENCODE and result["decode_digest"] == GOLDEN_DECODE
+    result["encode_us"] //= result["frames"]
+    result["decode_us"] //= result["frames"]
+    return result
+
+
+def properties(codec=PORTABLE, rounds=200, seed=1):
+    """ Check codec properties on random data
+
+    :return dict: number of failures per property
+    """
+    previous = install(codec)
+    try:
+        return _properties(rounds, seed)
+    finally:
+        install(previous)
+
+
+def _properties(rounds, seed):
+    random.seed(seed)
+    failures = {"round_trip": 0, "partial_decode": 0, "checksum": 0, "dc_balance": 0}
+
+    for _ in range(rounds):
+        length = random.randint(ITHOPACKET.HEADER_LENGTH, 21)
+        data = bytes(random.getrandbits(8) for _ in range(length))
+
+        # decoding an encoded packet returns the data, also in the check bytes
+        packet = ITHOPACKET()
+        packet.data_decoded[:length] = data
+        packet.data_length = length
+        message = CC1101MESSAGE()
+        end = packet.message_encode(message)
+        received = bytes(message.data[12:end + 1])
+        decoded = ITHOPACKET()
+        decoded.message_decode(received)
+        if bytes(decoded.data_decoded[:length]) != data or bytes(decoded.data_decoded_chk[:length]) != data:
+            failures["round_trip"] += 1
+
+        # decoding the header first and then the rest gives the same result
+        split = ITHOPACKET()
+        split.message_decode(received, 0, ITHOPACKET.HEADER_LENGTH)
+        split.message_decode(received, ITHOPACKET.HEADER_LENGTH)
+        if split.data_decoded != decoded.data_decoded or split.data_decoded_chk != decoded.data_decoded_chk:
+            failures["partial_decode"] += 1
+
+        # the checksum makes the sum of all bytes 0
+        value = ITHO.checksum(packet, length - 1)
+        if not 0 <= value <= 255 or (sum(packet.data_decoded[:length - 1]) + value) & 0xFF != 0:
+            failures["checksum"] += 1
+
+        # every bit pair of the encoding holds one 1 (bit and inverted bit, or the 1 0 pattern)
+        ones = sum(bin(b).count("1") for b in message.data[14:end + 1])
+        if ones * 2 != (end - 13) * 8:
+            failures["dc_balance"] += 1
+
+    return failures
+
+
+class _Pin:
+    """ Mock pin, records the values set; value() returns 1 for the first busy reads """
+
+    def __init__(self, log, busy=0):
+        self.log = log
+        self.busy = busy
+
+    def value(self, value=None):
+        if value is None:
+            if self.busy > 0:
+                self.busy -= 1
+                return 1
+            return 0
+        self.log.append(value)
+
+
+class _SPI:
+    """ Mock SPI bus, answers every byte with its complement XOR the position """
+
+    def __init__(self, log):
+        self.log = log
+
+    def write_readinto(self, data, buf):
+        self.log.append(bytes(data))
+        for i in range(len(data)):
+            buf[i] = (~data[i] ^ i) & 0xFF
+
+
+def transfer(function, rounds=200, seed=1):
+    """ Compare a MachineBus.transfer function with the portable one on a mock bus
+
+    :return int: number of transactions with different results or pin and bus activity
+    """
+    random.seed(seed)
+    mismatches = 0
+
+    for _ in range(rounds):
+        data = bytes(random.getrandbits(8) for _ in range(random.randint(1, 64)))
+        busy = random.randint(0, 3)
+        results = list()
+        for f in (PORTABLE_TRANSFER, function):
+            log = list()
+            bus = MachineBus.__new__(MachineBus)  # without hardware
+            bus.ss = _Pin(log)
+            bus.miso = _Pin(log, busy)
+            bus.spi = _SPI(log)
+            results.append((bytes(f(bus, data)), log, bus.miso.busy))
+        if results[0] != results[1]:
+            mismatches += 1
+
+    return mismatches
+
+
+if __name__ == "__main__":
+    # Check the reference implementation against the golden digests and the properties,
+    # and the accelerated versions (on a microcontroller) against the reference.
+    # On a microcontroller use e.g. run(counters=range(0, 256, 51)) to limit the duration.
+
+    print("properties", properties())
+    print("reference", run())
+    if ACCELERATED is None:
+        print("accelerated codec not available")
+    else:
+        print("accelerated properties", properties(ACCELERATED))
+        print("accelerated", run(encoder(ACCELERATED), decoder(ACCELERATED)))
+        print("accelerated transfer mismatches", transfer(itho.accel.transfer))
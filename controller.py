@@ -1,112 +1,656 @@
 import gc
 import json
-import logging
 import time
+from binascii import hexlify
 
 import machine
 import uasyncio as asyncio
 from machine import Pin
 
-import abutton
-import ntp
-from ahttpserver import HTTPResponse, HTTPServer, sendfile
+import timeline
+import tz
+from ahttpserver import HTTPResponse, HTTPServer
 from ahttpserver.sse import EventSource
-from cc1101 import CC1101
-from config import GD02_PIN, ITHO_REMOTE_ID, ITHO_REMOTE_TYPE, SPI_ID, SS_PIN, BUTTON
-from itho import ITHOREMOTE
+
+import ringlog
+from airtime import AirtimeExceeded, AirtimeLedger, data_rate
+from assets import Assets
+from broadcast import Broadcaster
+from combiner import FrameCombiner
+from config import ITHO_REMOTE_ID, ITHO_REMOTE_TYPE, RADIOS, WOR_INTERVAL_MS, WOR_RX_TIME, BUTTON
+from config import MQTT_BROKER, MQTT_PASSWORD, MQTT_PORT, MQTT_PREFIX, MQTT_USER
+from config import LOG_ECHO, LOG_LEVEL, LOG_SLOTS, WDT_TIMEOUT_MS
+from dedup import DuplicateFilter
+from drift import ClockDiscipline
+from fanstate import FanState
+from itho import ITHO, ITHOCOMMAND
+from jobs import Jobs
+from lag import LagMonitor
+from macros import Macros
+from memory import MemoryManager
+from mqtt import MQTTClient
+from ota import Updater
+from radios import Radio, select
+from scheduler import Scheduler
 from tasks import Tasks
+from traffic import TrafficTable
+from websocket import WebSocket
+from wor import CaptureStatistics, duty_cycle, expected_capture
 
+timeline.mark("import")
 
-logger = logging.getLogger(__name__)
+ringlog.configure(LOG_SLOTS, LOG_LEVEL, LOG_ECHO)
+logger = ringlog.getLogger(__name__)
 
 # Controller
 tasks = Tasks()
-cc1101 = CC1101(SPI_ID, SS_PIN, GD02_PIN)
-remote = ITHOREMOTE(cc1101, ITHO_REMOTE_TYPE, ITHO_REMOTE_ID)
+radios = [Radio(**radio) for radio in RADIOS]  # CC1101's are started by radio_task, as resetting blocks
+transmitter, receivers = select(radios)
+duplicates = DuplicateFilter()  # shared by all receivers
+radio_ready = asyncio.Event()  # set when all radios are started
+fanstate = FanState()
+discipline = ClockDiscipline()
+hub = Broadcaster()  # server sent events to all connected browsers
+airtime = AirtimeLedger(data_rate(ITHO.MDMCFG4, ITHO.MDMCFG3))
+capture = CaptureStatistics(ITHO.SEND_TRIES)
+traffic = TrafficTable()  # all remotes heard by the receivers
+lag = LagMonitor(WDT_TIMEOUT_MS)  # call lag.mark() before code which may block the event loop
+updater = Updater(feed=lag.feed)  # over the air update, see main.py for the boot part
+
+# Command names as used by the user interface, batched jobs and macros
+COMMANDS = {
+    "Low": ITHOCOMMAND.LOW,
+    "Medium": ITHOCOMMAND.MEDIUM,
+    "High": ITHOCOMMAND.HIGH,
+    "10 Min": ITHOCOMMAND.TIMER1,
+    "20 Min": ITHOCOMMAND.TIMER2,
+    "30 Min": ITHOCOMMAND.TIMER3,
+    "Join": ITHOCOMMAND.JOIN,
+    "Leave": ITHOCOMMAND.LEAVE
+}
+COMMAND_NAME = {command: name for name, command in COMMANDS.items()}
+
+# Commands accepted via MQTT, named after the ITHOREMOTE methods
+REMOTE_COMMANDS = {
+    "low": ITHOCOMMAND.LOW,
+    "medium": ITHOCOMMAND.MEDIUM,
+    "high": ITHOCOMMAND.HIGH,
+    "timer10": ITHOCOMMAND.TIMER1,
+    "timer20": ITHOCOMMAND.TIMER2,
+    "timer30": ITHOCOMMAND.TIMER3,
+    "join": ITHOCOMMAND.JOIN,
+    "leave": ITHOCOMMAND.LEAVE
+}
+
+
+async def send(command, force=True, max_wait=AirtimeLedger.MAX_WAIT):
+    """ Transmit command to the CVU, waiting until the airtime budget allows it and the radio is free
+
+    :param int command: ITHOCOMMAND to send
+    :param bool force: if False skip the transmission when it would not change the fan state
+    :param int max_wait: seconds the airtime budget may delay the command, 0 for interactive requests
+    :return bool: True if the command was transmitted
+    """
+    if force is False and fanstate.would_change(command) is False:
+        return False
+
+    try:
+        reservation = await reserve([command], max_wait)
+    except AirtimeExceeded as e:
+        logger.warning("command %d not sent: %s", command, e)
+        return False
+
+    sent = False
+    try:
+        async with transmitter.lock:
+            sent = await transmit(command, force)
+    finally:
+        if sent is False:
+            release(reservation)
+    return sent
+
+
+async def reserve(commands, max_wait=AirtimeLedger.MAX_WAIT):
+    """ Wait until the airtime budget allows sending commands, and book their airtime
+
+    Called before taking the lock of the transmitter, so a command delayed
+    by the budget does not block the radio.
+
+    :param list commands: ITHOCOMMANDs to send
+    :param int max_wait: seconds the commands may be delayed
+    :return tuple: reservation, us of airtime booked per command and the booking of the ledger
+    :raises AirtimeExceeded: if the budget does not allow sending within max_wait
+    """
+    await radio_ready.wait()
+
+    needed = []
+    for command in commands:
+        frames, length = transmitter.itho.transmission(command)
+        needed.append(frames * airtime.airtime(length))
+    booking = await airtime.reserve(sum(needed), max_wait)
+    return needed, booking
+
+
+def release(reservation, sent=0):
+    """ Give back the airtime booked by reserve() for the commands which were not sent
+
+    :param tuple reservation: value returned by reserve()
+    :param int sent: number of commands, from the start of the list, which were sent
+    """
+    needed, booking = reservation
+    airtime.release(sum(needed[sent:]), booking)
+
+
+async def transmit(command, force=True):
+    """ Transmit command to the CVU and update the fan state
+
+    The caller must hold the lock of the transmitter and have reserved
+    the airtime (see reserve()). A separate receiver keeps listening
+    during the transmission. If the transmitter also receives, it returns
+    to receive mode between and after the copies of the message by itself.
+
+    :param int command: ITHOCOMMAND to send
+    :param bool force: if False skip the transmission when it would not change the fan state
+    :return bool: True if the command was transmitted
+    """
+    if force is False and fanstate.would_change(command) is False:
+        return False
+
+    await radio_ready.wait()
+
+    lag.mark("send_command")
+    transmitter.itho.send_command(command)
+    airtime.record(ITHO.tries(command))
+    # a separate receiver hears the transmission, handle it as already delivered
+    duplicates.check(ITHO_REMOTE_TYPE, ITHO_REMOTE_ID, transmitter.itho.counter & 0xFF, command)
+    hub.publish("command", COMMAND_NAME.get(command, str(command)))
+    if fanstate.update(command) is True:
+        hub.publish("fanstate", json.dumps(fanstate.as_dict()))
+
+    transmitter.rx_pending = False  # GD02 also signals the end of a transmitted packet
+    return True
+
+
+jobs = Jobs(transmit, transmitter.lock, COMMANDS, reserve, release)
+macros = Macros(jobs.parse)
+memory = MemoryManager(idle=lambda: not any(radio.lock.locked() for radio in radios))
+scheduler = Scheduler(tasks, macros, send, lambda steps: jobs.submit(jobs.parse(steps)))
+
+
+def settings():
+    """ Return the scheduler settings as shown in the user interface """
+    return {
+        "start_low": f"{tasks.task['start_low'][0]:02d}:{tasks.task['start_low'][1]:02d}",
+        "start_medium": f"{tasks.task['start_medium'][0]:02d}:{tasks.task['start_medium'][1]:02d}"
+    }
+
+
+def apply_settings(values):
+    """ Change and save scheduler settings
+
+    :param dict values: new run-times in format "hh:mm", keys as returned by settings()
+    """
+    if "start_low" in values:
+        tasks.task["start_low"][0] = int(values["start_low"][:2])
+        tasks.task["start_low"][1] = int(values["start_low"][3:])
+    if "start_medium" in values:
+        tasks.task["start_medium"][0] = int(values["start_medium"][:2])
+        tasks.task["start_medium"][1] = int(values["start_medium"][3:])
+    lag.mark("tasks.save")
+    tasks.save()
+    hub.publish("scheduler", json.dumps(settings()))
+
+
+def mqtt_message(topic, payload):
+    """ Handle a message on a subscribed MQTT topic
+
+    MQTT_PREFIX/command carries the name of an ITHOREMOTE method,
+    MQTT_PREFIX/scheduler/set new scheduler settings as JSON.
+    """
+    try:
+        if topic == f"{MQTT_PREFIX}/command":
+            asyncio.create_task(send(REMOTE_COMMANDS[payload.decode().strip().lower()]))
+        elif topic == f"{MQTT_PREFIX}/scheduler/set":
+            apply_settings(json.loads(payload))
+    except (ValueError, KeyError, TypeError, IndexError, UnicodeError) as e:
+        logger.warning("mqtt %s: %s", topic, repr(e))
+
+
+def mqtt_event(event, data):
+    """ Forward hub events to MQTT, fan state and scheduler settings as retained state """
+    if event in ("fanstate", "scheduler"):
+        mqtt.publish(f"{MQTT_PREFIX}/{event}", data, retain=True)
+    elif event == "command":
+        mqtt.publish(f"{MQTT_PREFIX}/sent", data)
+
+
+def mqtt_metrics():
+    return json.dumps({
+        "airtime_ms": airtime.used() // 1000,
+        "frames": airtime.frames,
+        "rejected": airtime.rejected,
+        "delivered": duplicates.delivered,
+        "duplicates": duplicates.duplicates,
+        "missed": capture.missed,
+        "mqtt_dropped": mqtt.dropped
+    })
+
+
+def mqtt_connected():
+    """ Publish the complete state after every (re)connect, as QoS 0 messages may have been lost """
+    mqtt.publish(f"{MQTT_PREFIX}/fanstate", json.dumps(fanstate.as_dict()), retain=True)
+    mqtt.publish(f"{MQTT_PREFIX}/scheduler", json.dumps(settings()), retain=True)
+    mqtt.publish(f"{MQTT_PREFIX}/metrics", mqtt_metrics(), retain=True)
+
+
+mqtt = None
+if MQTT_BROKER is not None:
+    mqtt = MQTTClient(f"itho-{hexlify(machine.unique_id()).decode()}", MQTT_BROKER, MQTT_PORT, MQTT_USER,
+                      MQTT_PASSWORD, f"{MQTT_PREFIX}/status", callback=mqtt_message, on_connect=mqtt_connected)
+    mqtt.subscribe(f"{MQTT_PREFIX}/command")
+    mqtt.subscribe(f"{MQTT_PREFIX}/scheduler/set")
+    hub.listen(mqtt_event)
+
+
+def header(request, name, default=None):
+    """ Return the value of a request header, name is case insensitive """
+    name = name.lower()
+    for key, value in request.header.items():
+        if key.lower() == name:
+            return value
+    return default
+
+
+async def read_json(reader, request, max_length=1024):
+    """ Read and decode the JSON body of a request
+
+    :return: decoded body
+    :raises ValueError: body missing, too large or not valid JSON
+    """
+    length = int(header(request, "Content-Length", "0"))
+    if not 0 < length <= max_length:
+        raise ValueError(f"expected body of 1 to {max_length} bytes")
+    return json.loads(await reader.readexactly(length))
+
+
+async def send_json(writer, status, data):
+    response = HTTPResponse(status, "application/json")
+    await response.send(writer)
+    writer.write(json.dumps(data))
+
 
 # User interface
 app = HTTPServer()
 
+assets = Assets()
+assets.add("/", "index.html", "text/html")  # always revalidate, answered with 304 if unchanged
+assets.add("/favicon.ico", "favicon.ico", "image/x-icon", "max-age=604800")
+
 
 @app.route("GET", "/")
+@memory.track("root")
 async def root(reader, writer, request):
-    response = HTTPResponse(200, "text/html")
-    await response.send(writer)
-    await sendfile(writer, "index.html")
+    await assets.send(writer, "/", header(request, "If-None-Match"), header(request, "Accept-Encoding", ""))
 
 
 @app.route("GET", "/favicon.ico")
+@memory.track("favicon")
 async def favicon(reader, writer, request):
-    response = HTTPResponse(200, "image/x-icon")
-    await response.send(writer)
-    await sendfile(writer, "favicon.ico")
+    await assets.send(writer, "/favicon.ico", header(request, "If-None-Match"), header(request, "Accept-Encoding", ""))
 
 
 @app.route("GET", "/api/init")
+@memory.track("api_init")
 async def api_init(reader, writer, request):
     response = HTTPResponse(200, "application/json")
     await response.send(writer)
-    settings = dict()
-    settings["start_low"] = f"{tasks.task['start_low'][0]:02d}:{tasks.task['start_low'][1]:02d}"
-    settings["start_medium"] = f"{tasks.task['start_medium'][0]:02d}:{tasks.task['start_medium'][1]:02d}"
-    writer.write(json.dumps(settings))
+    writer.write(json.dumps(settings()))
 
 
 @app.route("GET", "/api/datetime")
 async def api_datetime(reader, writer, request):
-    """ Setup a server sent event connection to the client continuously updating the date and time """
-    eventsource = await EventSource(reader, writer)
-    while True:
-        await asyncio.sleep(1)
-        t = time.localtime()
-        try:
-            await eventsource.send(event="datetime", data=f"{t[2]:02d}-{t[1]:02d}-{t[0]:04d} {t[3]:02d}:{t[4]:02d}:{t[5]:02d}")
-        except Exception:
-            break  # close connection
+    """ Setup a server sent event connection to the client
+
+    The client is subscribed to the broadcast hub which sends the date
+    and time every second, plus scheduler, command and fan state events.
+    """
+    subscriber = hub.subscribe(writer)
+    if subscriber is None:
+        response = HTTPResponse(503)
+        await response.send(writer)
+        return
+    try:
+        eventsource = await EventSource(reader, writer)
+        await eventsource.send(event="fanstate", data=json.dumps(fanstate.as_dict()))
+    except Exception:
+        hub.unsubscribe(subscriber)
+        return  # close connection
+    await hub.serve(subscriber)
 
 
 @app.route("GET", "/api/set")
+@memory.track("api_set")
 async def api_set(reader, writer, request):
     response = HTTPResponse(200)
     await response.send(writer)
-    parameters = request.parameters
-    if "start_low" in parameters:
-        tasks.task["start_low"][0] = int(parameters["start_low"][:2])
-        tasks.task["start_low"][1] = int(parameters["start_low"][3:])
-    if "start_medium" in parameters:
-        tasks.task["start_medium"][0] = int(parameters["start_medium"][:2])
-        tasks.task["start_medium"][1] = int(parameters["start_medium"][3:])
-    tasks.save()
+    apply_settings(request.parameters)
 
 
 @app.route("GET", "/api/click")
+@memory.track("api_button")
 async def api_button(reader, writer, request):
     response = HTTPResponse(200)
     await response.send(writer)
     parameters = request.parameters
     if "button" in parameters:
-        value = parameters["button"]
-        if value == "Low":
-            remote.low()
-        elif value == "Medium":
-            remote.medium()
-        elif value == "High":
-            remote.high()
-        elif value == "10%20Min":
-            remote.timer10()
-        elif value == "20%20Min":
-            remote.timer20()
-        elif value == "30%20Min":
-            remote.timer30()
-        elif value == "Join":
-            remote.join()
-        elif value == "Leave":
-            remote.leave()
+        command = COMMANDS.get(parameters["button"].replace("%20", " "))
+        if command is not None:
+            await send(command, max_wait=0)  # the user does not wait for a delayed command
+
+
+@app.route("GET", "/api/ws")
+async def api_ws(reader, writer, request):
+    """ WebSocket carrying all traffic between user interface and controller
+
+    Messages from the client are JSON objects with an id and a type:
+        {"id": 1, "type": "click", "button": "High"}
+        {"id": 2, "type": "set", "start_low": "22:30"}
+        {"id": 3, "type": "batch", "steps": ["Join", "Low"]}
+    Every message is handled by a task of its own, so the connection
+    keeps being read (and pinged) while a command is sent. At most
+    WebSocket.MAX_HANDLERS messages are handled at the same time, more
+    are acknowledged with an error at once. When it is done the message
+    is acknowledged with event "ack" containing the
+    id, ok, and ms (time spent handling the message, including sending
+    the command). The client also receives the same events as the
+    server sent event clients of /api/datetime.
+    """
+    key = header(request, "Sec-WebSocket-Key")
+    subscriber = None if key is None else hub.subscribe(writer, Broadcaster.WEBSOCKET)
+    if subscriber is None:
+        response = HTTPResponse(400 if key is None else 503)
+        await response.send(writer)
+        return
+
+    try:
+        await WebSocket.handshake(writer, key)
+    except Exception:
+        hub.unsubscribe(subscriber)
+        return  # close connection
+    hub.start(subscriber)
+    websocket = WebSocket(reader, lambda frame: hub.send(subscriber, frame))
+
+    def reply(event, data):
+        hub.send(subscriber, WebSocket.frame(json.dumps({"event": event, "data": data})))
+
+    async def handle(message, start):
+        ack = {"id": None, "ok": True}
+        try:
+            message = json.loads(message)
+            ack["id"] = message.get("id")
+            if message["type"] == "click":
+                if await send(COMMANDS[message["button"]], max_wait=0) is False:
+                    raise ValueError("airtime budget exceeded")
+            elif message["type"] == "set":
+                apply_settings(message)
+            elif message["type"] == "batch":
+                ack["job"] = jobs.submit(jobs.parse(message["steps"])).id
+            else:
+                raise ValueError(f"unknown type {message['type']}")
+        except (ValueError, KeyError, TypeError, AttributeError, OSError) as e:
+            ack["ok"] = False
+            ack["error"] = f"{e.__class__.__name__} {e}"
+        finally:
+            websocket.handlers -= 1
+        ack["ms"] = time.ticks_diff(time.ticks_ms(), start)
+        if subscriber.closed.is_set() is False:
+            reply("ack", json.dumps(ack))
+
+    def reject(message):
+        ack = {"id": None, "ok": False, "error": "busy, too many messages pending", "ms": 0}
+        try:
+            ack["id"] = json.loads(message).get("id")
+        except (ValueError, AttributeError):
+            pass
+        reply("ack", json.dumps(ack))
+
+    reply("fanstate", json.dumps(fanstate.as_dict()))
+    reply("scheduler", json.dumps(settings()))
+
+    try:
+        while subscriber.closed.is_set() is False:
+            message = await websocket.receive()
+            if message is None:
+                break
+            if websocket.handlers >= WebSocket.MAX_HANDLERS:
+                reject(message)
+                continue
+            websocket.handlers += 1
+            asyncio.create_task(handle(message, time.ticks_ms()))
+    except (OSError, EOFError):
+        pass  # connection lost
+    finally:
+        hub.unsubscribe(subscriber)
+
+
+@app.route("POST", "/api/batch")
+@memory.track("api_batch")
+async def api_batch(reader, writer, request):
+    """ Run a list of commands as one job, e.g. ["High", {"command": "30 Min", "delay": 1}] """
+    try:
+        steps = jobs.parse(await read_json(reader, request))
+    except ValueError as e:
+        await send_json(writer, 400, {"error": str(e)})
+        return
+    job = jobs.submit(steps)
+    await send_json(writer, 202, job.as_dict())
+
+
+@app.route("GET", "/api/job")
+@memory.track("api_job")
+async def api_job(reader, writer, request):
+    """ Return state and per step timing of a job """
+    job = None
+    if "id" in request.parameters:
+        try:
+            job = jobs.get(int(request.parameters["id"]))
+        except ValueError:
+            pass
+    if job is None:
+        await send_json(writer, 404, {"error": "unknown job"})
+    else:
+        await send_json(writer, 200, job.as_dict())
+
+
+@app.route("GET", "/api/macros")
+@memory.track("api_macros")
+async def api_macros(reader, writer, request):
+    await send_json(writer, 200, macros.macro)
+
+
+@app.route("POST", "/api/macro")
+@memory.track("api_macro_save")
+async def api_macro_save(reader, writer, request):
+    """ Save (or with no steps delete) a macro: {"name": "Shower", "steps": [...], "at": "hh:mm" or null} """
+    try:
+        body = await read_json(reader, request)
+        name = body["name"]
+        steps = body.get("steps")
+        at = body.get("at")
+        if steps:
+            jobs.parse(steps)
+            if at is not None:
+                at = Macros.run_time(at)
+            macros.macro[name] = {"steps": steps, "at": at}
+        else:
+            macros.macro.pop(name, None)
+    except (ValueError, KeyError, TypeError) as e:
+        await send_json(writer, 400, {"error": f"{e.__class__.__name__} {e}"})
+        return
+    lag.mark("macros.save")
+    macros.save()
+    await send_json(writer, 200, macros.macro)
+
+
+@app.route("GET", "/api/macro")
+@memory.track("api_macro_run")
+async def api_macro_run(reader, writer, request):
+    """ Run a saved macro: /api/macro?name=Shower """
+    macro = macros.macro.get(request.parameters.get("name", "").replace("%20", " "))
+    if macro is None:
+        await send_json(writer, 404, {"error": "unknown macro"})
+        return
+    try:
+        steps = jobs.parse(macro["steps"])
+    except ValueError as e:  # the macro was saved with an older command table
+        await send_json(writer, 500, {"error": f"invalid macro: {e}"})
+        return
+    job = jobs.submit(steps)
+    await send_json(writer, 202, job.as_dict())
+
+
+@app.route("GET", "/api/diag/memory")
+async def api_diag_memory(reader, writer, request):
+    """ Heap usage, garbage collection statistics and allocations per handler and task """
+    await send_json(writer, 200, memory.as_dict())
+
+
+@app.route("GET", "/api/diag/boot")
+async def api_diag_boot(reader, writer, request):
+    """ Milliseconds after start of main.py at which the boot phases completed """
+    await send_json(writer, 200, timeline.as_dict())
+
+
+@app.route("GET", "/api/diag/ntp")
+async def api_diag_ntp(reader, writer, request):
+    """ Offset, round trip delay and stratum of the last time synchronization """
+    import ntp
+
+    await send_json(writer, 200, None if ntp.last_sample is None else ntp.last_sample.as_dict())
+
+
+@app.route("GET", "/api/diag/clock")
+async def api_diag_clock(reader, writer, request):
+    """ Drift model of the RTC and the current time synchronization interval """
+    await send_json(writer, 200, discipline.as_dict())
+
+
+@app.route("GET", "/api/diag/airtime")
+async def api_diag_airtime(reader, writer, request):
+    """ Transmitter airtime used in the last hour and the budget """
+    await send_json(writer, 200, airtime.as_dict())
+
+
+@app.route("GET", "/api/diag/receiver")
+async def api_diag_receiver(reader, writer, request):
+    """ Receive mode and the fraction of messages from remotes received """
+    result = {"mode": "continuous"}
+    if WOR_INTERVAL_MS > 0:
+        copy, press = expected_capture(WOR_INTERVAL_MS, WOR_RX_TIME, ITHO.SEND_TRIES)
+        result = {
+            "mode": "wake-on-radio",
+            "interval_ms": WOR_INTERVAL_MS,
+            "duty_cycle": duty_cycle(WOR_RX_TIME),
+            "expected": {"copy_capture": copy, "press_capture": press}
+        }
+    result["measured"] = capture.as_dict(duplicates)
+    result["radios"] = [radio.as_dict() for radio in radios]
+    await send_json(writer, 200, result)
+
+
+@app.route("GET", "/api/diag/traffic")
+async def api_diag_traffic(reader, writer, request):
+    """ Remotes heard, the top talkers or one remote: /api/diag/traffic?remote=22-116-233-94 """
+    if "remote" in request.parameters:
+        try:
+            remote = [int(value) for value in request.parameters["remote"].split("-")]
+            record = traffic.get(remote[0], remote[1:4])
+        except (ValueError, IndexError):
+            await send_json(writer, 400, {"error": "expected remote=type-id-id-id"})
+            return
+        if record is None:
+            await send_json(writer, 404, {"error": "unknown remote"})
+        else:
+            await send_json(writer, 200, record)
+    else:
+        await send_json(writer, 200, traffic.as_dict())
+
+
+@app.route("GET", "/api/diag/lag")
+async def api_diag_lag(reader, writer, request):
+    """ Event loop lag histogram and the worst stalls with the activity causing them """
+    await send_json(writer, 200, lag.as_dict())
+
+
+@app.route("GET", "/api/diag/mqtt")
+async def api_diag_mqtt(reader, writer, request):
+    """ MQTT connection state and message counts """
+    await send_json(writer, 200, None if mqtt is None else mqtt.as_dict())
+
+
+@app.route("GET", "/api/log")
+async def api_log(reader, writer, request):
+    """ Log records as text, one per line
+
+    /api/log?since=120&level=30 returns the kept records from sequence
+    number 120 on with at least level warning. With follow=1 the
+    connection is kept open and new records are sent when written,
+    like tail -f.
+    """
+    try:
+        since = int(request.parameters.get("since", 0))
+        level = int(request.parameters.get("level", ringlog.DEBUG))
+    except ValueError:
+        await send_json(writer, 400, {"error": "expected integer since and level"})
+        return
+    log = ringlog.log
+    response = HTTPResponse(200, "text/plain")
+    await response.send(writer)
+    try:
+        while True:
+            for seq in log.records(since, level):
+                writer.write(log.format(seq))
+                writer.write("\n")
+                await writer.drain()
+            since = log.seq
+            if request.parameters.get("follow") != "1":
+                break
+            await asyncio.sleep_ms(250)
+    except OSError:
+        pass  # client closed the connection
+
+
+@app.route("POST", "/api/ota")
+async def api_ota(reader, writer, request):
+    """ Upload a bundle of files (see ota.py), on success reset to start the new version
+
+    The SHA-256 digest of the bundle is expected in header X-SHA256.
+    """
+    lag.mark("ota")
+    try:
+        length = int(header(request, "Content-Length", "0"))
+        result = await updater.receive(reader, length, header(request, "X-SHA256", ""))
+    except ValueError as e:
+        await send_json(writer, 400, {"error": str(e)})
+        return
+    except OSError as e:
+        await send_json(writer, 507, {"error": f"writing to flash failed: {e}"})
+        return
+    await send_json(writer, 200, result)
+    await writer.drain()
+    await asyncio.sleep_ms(500)
+    machine.reset()
+
+
+@app.route("GET", "/api/ota")
+async def api_ota_state(reader, writer, request):
+    """ State of the last update (trial, confirmed, rolled back) and its throughput """
+    await send_json(writer, 200, updater.as_dict())
 
 
 @app.route("GET", "/api/reset")
 async def api_reset(reader, writer, request):
-    """ Hard reset, useful after remote software update via FTP """
+    """ Hard reset, useful after remote software update via FTP (/api/ota resets by itself) """
     response = HTTPResponse(200)
     await response.send(writer)
     machine.reset()
@@ -123,66 +667,174 @@ async def api_stop(reader, writer, request):
 # End of user interface code
 
 async def scheduler_task():
-    """ Run scheduled tasks at specific times """
-
-    def eligible(scheduled_time):
-        """ Check if scheduled time lies between now and the last time the scheduler ran """
-        s_mins = scheduled_time[0] * 60 + scheduled_time[1]
-
-        if prev_mins < s_mins <= curr_mins:
-            return True
-        return False
-
-    tm = time.localtime()[3:5]
-    prev_mins = tm[0] * 60 + tm[1]
+    """ Run scheduled tasks at specific times, see scheduler.py """
+    while True:
+        before = gc.mem_alloc()
+        lag.mark("scheduler")
+        await scheduler.check()
+        memory.record("scheduler_task", gc.mem_alloc() - before)
+        await asyncio.sleep(Scheduler.INTERVAL)  # wakeup every minute (at most)
+
+
+async def receiver_task(radio):
+    """ Mirror the fan state by listening to the physical remote
+
+    Only messages from the remote the controller is paired with
+    (ITHO_REMOTE_TYPE and ITHO_REMOTE_ID) are used. A remote sends
+    every command several times with the same counter, only the
+    first valid copy is delivered by get_new_packet(), also when
+    several radios receive it. Copies which cannot be decoded by
+    themselves are combined to recover the command.
+
+    :param Radio radio: radio to receive with
+    """
+    await radio_ready.wait()
+    itho = radio.itho
+    combiner = FrameCombiner()
+
+    radio.cc1101.gd02.irq(handler=radio.gd02_handler, trigger=Pin.IRQ_FALLING)
+    if WOR_INTERVAL_MS > 0:
+        itho.init_wor()
+    else:
+        itho.init_receive()
 
     while True:
-        tm = time.localtime()[3:5]
-        curr_mins = tm[0] * 60 + tm[1]
-
-        # just three tasks, no complex data structures needed
-        # check tasks one by one to see if they are eligible to run
-        if eligible(tasks.task["start_low"]) is True:
-            remote.low()
-        if eligible(tasks.task["start_medium"]) is True:
-            remote.medium()
-        if eligible(tasks.task["ntp_time_sync"]) is True:
-            asyncio.create_task(ntp.sync())
-        prev_mins = curr_mins
-        await asyncio.sleep(60)  # wakeup every minute (at most)
-
-async def free_memory_task():
-    """ Free memory every 60 seconds """
+        await asyncio.sleep_ms(20)
+        if radio.rx_pending is False:
+            continue
+        radio.rx_pending = False
+
+        before = gc.mem_alloc()
+        lag.mark("get_new_packet")
+        packet = itho.get_new_packet()
+        memory.record("receiver_task", gc.mem_alloc() - before)
+        if packet is None:
+            continue
+        if packet.command == ITHOCOMMAND.UNKNOWN:
+            packet = combiner.add(packet)
+            if packet is None:
+                continue
+            if itho.duplicates.check(packet.remote_type, packet.remote_id, packet.counter, packet.command) is True:
+                continue  # a valid copy was already delivered
+        capture.record(packet)
+        logger.debug("rx counter %d command %d rssi %d", packet.counter, packet.command, packet.rssi)
+        if packet.remote_type != ITHO_REMOTE_TYPE or tuple(packet.remote_id) != tuple(ITHO_REMOTE_ID):
+            continue
+        if fanstate.update(packet.command) is True:
+            logger.info("remote sent command %d", packet.command)
+            hub.publish("fanstate", json.dumps(fanstate.as_dict()))
+
+
+async def clock_task():
+    """ Broadcast the date and time every second
+
+    The timestamp is formatted once, regardless of the number of
+    subscribed clients. The expiry of a high speed timer is also
+    detected here.
+    """
+    while True:
+        await asyncio.sleep(1)
+        if len(hub.subscribers) == 0 and len(hub.listeners) == 0:
+            continue
+        before = gc.mem_alloc()
+        t = tz.localtime()
+        hub.publish("datetime", f"{t[2]:02d}-{t[1]:02d}-{t[0]:04d} {t[3]:02d}:{t[4]:02d}:{t[5]:02d}")
+        version = fanstate.version
+        state = fanstate.as_dict()  # increments version when a timer has expired
+        if version != fanstate.version:
+            hub.publish("fanstate", json.dumps(state))
+        memory.record("clock_task", gc.mem_alloc() - before)
+
+
+async def radio_task():
+    """ Initialize the CC1101's after the HTTP server is up """
+    for radio in radios:
+        await asyncio.sleep_ms(0)
+        lag.mark("radio.start")
+        radio.start(ITHO_REMOTE_TYPE, ITHO_REMOTE_ID, duplicates)
+        if radio.receives():
+            radio.itho.traffic = traffic
+    timeline.mark("radio")
+    radio_ready.set()
+
+
+async def ntp_task():
+    """ Keep the clock synchronized
+
+    The interval between synchronizations adapts to the drift of the
+    RTC. Module ntp is imported on first use as it needs the network.
+    """
+    import ntp
+
+    async def sync():
+        lag.mark("ntp.sync")
+        return await ntp.sync(correct=False)
+
+    await discipline.sync_task(sync, lambda: timeline.mark("ntp"))
+
+
+async def mqtt_task():
+    """ Publish the metrics when they have changed, checked every minute """
+    previous = None
     while True:
-        gc.collect()
-        gc.threshold(gc.mem_free() // 4 + gc.mem_alloc())
         await asyncio.sleep(60)
-
-try:
-    def handle_exception(loop, context):
-        # uncaught exceptions end up here
-        import sys
-        logger.exception(context["exception"], "global exception handler")
-        sys.exit()
-
-    # the user button on the microcontroller stops the asyncio scheduler
-    def _keyboardinterrupt():
-        raise(KeyboardInterrupt)
-
-    pb = abutton.Pushbutton(Pin(BUTTON, Pin.IN, Pin.PULL_UP), suppress=True)
-    pb.press_func(_keyboardinterrupt, ())
-
-    loop = asyncio.get_event_loop()
-    loop.set_exception_handler(handle_exception)
-
-    loop.create_task(ntp.sync())  # initial time synchronization
-    loop.create_task(scheduler_task())
-    loop.create_task(free_memory_task())
-    loop.create_task(app.start())
-
-    loop.run_forever()
-except KeyboardInterrupt:
-    pass
-finally:
-    asyncio.run(app.stop())
-    asyncio.new_event_loop()
+        metrics = mqtt_metrics()
+        if metrics != previous:
+            mqtt.publish(f"{MQTT_PREFIX}/metrics", metrics, retain=True)
+            previous = metrics
+
+
+async def http_task():
+    await app.start()
+    timeline.mark("http")
+    updater.confirm()  # the new version of an update started successfully
+
+
+def run():
+    """ Start the controller
+
+    The HTTP server is started first, the radio and the (network
+    dependent) time synchronization are initialized in the background.
+    """
+    import abutton
+
+    try:
+        def handle_exception(loop, context):
+            # uncaught exceptions end up here
+            import sys
+            logger.exception(context["exception"], "global exception handler")
+            print(ringlog.log.format(ringlog.log.seq - 1))
+            if updater.failed() is True:  # the update failed before it was confirmed, restore the previous version
+                machine.reset()
+            sys.exit()
+
+        # the user button on the microcontroller stops the asyncio scheduler
+        def _keyboardinterrupt():
+            raise(KeyboardInterrupt)
+
+        pb = abutton.Pushbutton(Pin(BUTTON, Pin.IN, Pin.PULL_UP), suppress=True)
+        pb.press_func(_keyboardinterrupt, ())
+
+        loop = asyncio.get_event_loop()
+        loop.set_exception_handler(handle_exception)
+
+        loop.create_task(lag.task())  # first, to also measure the boot
+        loop.create_task(http_task())
+        loop.create_task(radio_task())
+        loop.create_task(ntp_task())
+        loop.create_task(discipline.slew_task())
+        loop.create_task(scheduler_task())
+        for radio in receivers:
+            loop.create_task(receiver_task(radio))
+        loop.create_task(clock_task())
+        loop.create_task(memory.task())
+        if mqtt is not None:
+            loop.create_task(mqtt.run())
+            loop.create_task(mqtt_task())
+
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        asyncio.run(app.stop())
+        asyncio.new_event_loop()
@@ -0,0 +1,75 @@
+# Suppression of repeated Itho messages
+#
+# A remote sends every button press several times (30 times for a
+# LEAVE), all copies with the same remote type, id and counter. The
+# DuplicateFilter remembers the most recently received messages in a
+# small least recently used cache, so every button press is delivered
+# only once. Repeated copies are counted. The cache is stored in
+# preallocated arrays, receiving a message does not allocate memory.
+#
+# Copyright 2022 (c) Erik de Lange
+# Released under MIT license
+
+from array import array
+
+from hal import const, time
+
+
+class DuplicateFilter:
+    SLOTS = const(8)  # number of messages remembered
+    WINDOW = const(2000)  # ms after the last copy in which a message counts as duplicate
+
+    def __init__(self):
+        # Per slot: remote type and id, counter and command, time of the last copy.
+        # A tag of 0 marks an empty slot (command UNKNOWN is never stored).
+        # The remote type is kept apart, shifted into source it would not fit a small int.
+        self.remote_type = bytearray(DuplicateFilter.SLOTS)
+        self.source = array("L", [0] * DuplicateFilter.SLOTS)  # remote id
+        self.tag = array("H", [0] * DuplicateFilter.SLOTS)  # counter << 8 | command
+        self.stamp = array("L", [0] * DuplicateFilter.SLOTS)  # time.ticks_ms()
+        self.delivered = 0
+        self.duplicates = 0
+
+    def check(self, remote_type, remote_id, counter, command, now=None):
+        """ Register a message and tell if it is a repeated copy
+
+        :param int remote_type: remote type
+        :param bytearray remote_id: 3 byte remote id
+        :param int counter: message counter
+        :param int command: ITHOCOMMAND, not UNKNOWN
+        :param int now: time.ticks_ms() of reception
+        :return bool: True if a copy of this message was received within WINDOW ms
+        """
+        if now is None:
+            now = time.ticks_ms()
+
+        source = (remote_id[0] << 16) | (remote_id[1] << 8) | remote_id[2]
+        tag = (counter << 8) | command
+
+        oldest = 0
+        for i in range(DuplicateFilter.SLOTS):
+            if self.tag[i] == 0:
+                oldest = i
+                break
+            if self.tag[i] == tag and self.source[i] == source and self.remote_type[i] == remote_type:
+                if time.ticks_diff(now, self.stamp[i]) < DuplicateFilter.WINDOW:
+                    self.stamp[i] = now
+                    self.duplicates += 1
+                    return True
+                oldest = i  # expired, reuse the slot
+                break
+            if time.ticks_diff(self.stamp[oldest], self.stamp[i]) > 0:
+                oldest = i
+
+        self.remote_type[oldest] = remote_type
+        self.source[oldest] = source
+        self.tag[oldest] = tag
+        self.stamp[oldest] = now
+        self.delivered += 1
+        return False
+
+    def as_dict(self):
+        return {
+            "delivered": self.delivered,
+            "duplicates": self.duplicates
+        }
@@ -0,0 +1,123 @@
+# RTC drift estimation
+#
+# The offset measured at every time synchronization is used to
+# estimate the drift of the RTC in ppm. Between synchronizations the
+# clock is corrected for the estimated drift in small steps (slewing)
+# instead of one large step at the next synchronization. The interval
+# between synchronizations adapts to the uncertainty of the estimate:
+# short while the drift is unknown or varies, long when the clock is
+# stable, so fewer WiFi wakeups are needed.
+#
+# Copyright 2022 (c) Erik de Lange
+# Released under MIT license
+
+import time
+
+import uasyncio as asyncio
+
+import sntp
+from config import CLOCK_TARGET_MS
+from hal import const
+
+
+class ClockDiscipline:
+    STEP_THRESHOLD = const(128000000)  # ns, larger offsets are corrected in one step
+    MAX_SLEW = const(5000000)  # ns, maximum correction of a measured offset per slew interval
+    SLEW_INTERVAL = const(60)  # seconds
+    MIN_ELAPSED = const(600)  # seconds between syncs needed to estimate the drift
+    MIN_INTERVAL = const(900)  # seconds, shortest sync interval
+    MAX_INTERVAL = const(604800)  # seconds, longest sync interval (1 week)
+    MIN_UNCERTAINTY = 0.5  # ppm, floor for the uncertainty of the estimate
+
+    def __init__(self, target_ms=CLOCK_TARGET_MS):
+        """ Create a clock discipline
+
+        :param int target_ms: desired accuracy of the clock in ms
+        """
+        self.target = target_ms * 1000000  # ns
+        self.drift = 0.0  # ppm, positive if the RTC runs slow
+        self.uncertainty = None  # ppm, None until the drift has been estimated
+        self.last_sync = None  # time.time() of the last synchronization
+        self.pending = 0  # ns of measured offset not yet slewed
+        self.syncs = 0
+        self.steps = 0
+        self.history = list()  # last (time.time(), offset in ms, drift in ppm)
+
+    def update(self, offset):
+        """ Process the offset measured by a time synchronization
+
+        :param int offset: ns to add to the RTC to get the correct time
+        """
+        now = time.time()
+        self.syncs += 1
+
+        if self.last_sync is None or abs(offset) > ClockDiscipline.STEP_THRESHOLD:
+            sntp.step(offset)
+            self.steps += 1
+            self.pending = 0
+            self.last_sync = time.time()
+        else:
+            elapsed = now - self.last_sync
+            if elapsed >= ClockDiscipline.MIN_ELAPSED:
+                # the part of the offset which was not already planned to be slewed is
+                # caused by the error in the drift estimate (ns/s = ppb)
+                residual = (offset - self.pending) / elapsed / 1000
+                if self.uncertainty is None:
+                    self.drift += residual
+                    self.uncertainty = abs(residual)
+                else:
+                    self.drift += residual / 2
+                    self.uncertainty = (self.uncertainty + abs(residual)) / 2
+                self.last_sync = now
+            self.pending = offset
+
+        self.history.append((now, offset / 1000000, self.drift))
+        if len(self.history) > 8:
+            self.history.pop(0)
+
+    def interval(self):
+        """ Return the number of seconds until the next synchronization """
+        if self.uncertainty is None:
+            return ClockDiscipline.MIN_INTERVAL
+        rate = max(self.uncertainty, ClockDiscipline.MIN_UNCERTAINTY) + abs(self.drift) / 10  # ppm
+        seconds = int(self.target / 1000 / rate)
+        return min(max(seconds, ClockDiscipline.MIN_INTERVAL), ClockDiscipline.MAX_INTERVAL)
+
+    async def sync_task(self, sync, synced=None):
+        """ Synchronize the clock repeatedly, at the interval adapted to the drift
+
+        :param function sync: coroutine returning an sntp.Sample without correcting the RTC, None if it failed
+        :param function synced: called after every successful synchronization
+        """
+        while True:
+            sample = await sync()
+            if sample is None:
+                await asyncio.sleep(ClockDiscipline.MIN_INTERVAL)
+                continue
+            self.update(sample.offset)
+            if synced is not None:
+                synced()
+            await asyncio.sleep(self.interval())
+
+    async def slew_task(self):
+        """ Correct the RTC for the estimated drift and pending offset in small steps """
+        while True:
+            await asyncio.sleep(ClockDiscipline.SLEW_INTERVAL)
+            if self.last_sync is None:
+                continue
+            correction = min(max(self.pending, -ClockDiscipline.MAX_SLEW), ClockDiscipline.MAX_SLEW)
+            self.pending -= correction
+            correction += int(self.drift * ClockDiscipline.SLEW_INTERVAL * 1000)  # ppm * s = us
+            if correction != 0:
+                sntp.step(correction)
+
+    def as_dict(self):
+        return {
+            "drift_ppm": self.drift,
+            "uncertainty_ppm": self.uncertainty,
+            "pending_ms": self.pending / 1000000,
+            "interval_s": self.interval(),
+            "syncs": self.syncs,
+            "steps": self.steps,
+            "history": [{"time": t, "offset_ms": offset, "drift_ppm": drift} for t, offset, drift in self.history]
+        }
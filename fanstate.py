@@ -0,0 +1,80 @@
+# Fan state mirror
+#
+# The CVU does not report its state. The FanState class keeps track
+# of it by remembering the commands sent by the controller and the
+# commands overheard from the physical remote which shares the
+# controller's remote type and id.
+#
+# Copyright 2022 (c) Erik de Lange
+# Released under MIT license
+
+import time
+
+from itho import ITHOCOMMAND
+
+
+class FanState:
+    # Duration in seconds of the high speed timers
+    TIMER_DURATION = {
+        ITHOCOMMAND.TIMER1: 10 * 60,
+        ITHOCOMMAND.TIMER2: 20 * 60,
+        ITHOCOMMAND.TIMER3: 30 * 60
+    }
+
+    SPEED_NAME = {
+        ITHOCOMMAND.UNKNOWN: "Unknown",
+        ITHOCOMMAND.LOW: "Low",
+        ITHOCOMMAND.MEDIUM: "Medium",
+        ITHOCOMMAND.HIGH: "High"
+    }
+
+    def __init__(self):
+        self.speed = ITHOCOMMAND.UNKNOWN  # LOW, MEDIUM or HIGH, UNKNOWN until the first command is seen
+        self.timer_expiry = 0  # time.time() at which a running timer ends, 0 if no timer runs
+        self.version = 0  # incremented on every change so clients can detect updates
+
+    def timer_remaining(self):
+        """ Return number of seconds the high speed timer still runs (0 if none) """
+        if self.timer_expiry == 0:
+            return 0
+        remaining = self.timer_expiry - time.time()
+        if remaining <= 0:
+            self.timer_expiry = 0
+            self.version += 1
+            return 0
+        return remaining
+
+    def would_change(self, command):
+        """ Check if sending command changes the state of the CVU
+
+        :param int command: ITHOCOMMAND to check
+        :return bool: False if the CVU is known to already be in the requested state
+        """
+        if command in (ITHOCOMMAND.LOW, ITHOCOMMAND.MEDIUM, ITHOCOMMAND.HIGH):
+            return self.speed != command or self.timer_remaining() > 0
+        return True  # timers restart, join and leave always have effect
+
+    def update(self, command):
+        """ Record command as sent to (or overheard by) the CVU
+
+        :param int command: ITHOCOMMAND sent
+        :return bool: True if the state changed
+        """
+        if command in (ITHOCOMMAND.LOW, ITHOCOMMAND.MEDIUM, ITHOCOMMAND.HIGH):
+            if self.speed == command and self.timer_expiry == 0:
+                return False
+            self.speed = command
+            self.timer_expiry = 0  # selecting a speed cancels a running timer
+        elif command in FanState.TIMER_DURATION:
+            self.timer_expiry = time.time() + FanState.TIMER_DURATION[command]
+        else:
+            return False
+
+        self.version += 1
+        return True
+
+    def as_dict(self):
+        return {
+            "speed": FanState.SPEED_NAME.get(self.speed, "Unknown"),
+            "timer": self.timer_remaining()
+        }
@@ -0,0 +1,441 @@
+# Hardware abstraction layer for the CC1101 driver
+#
+# The CC1101 driver talks to the chip via a bus object which performs
+# SPI transactions (one per chip select period) and provides the GD02
+# pin. MachineBus uses machine.SPI and machine.Pin on a MicroPython
+# microcontroller. SpidevBus runs on Linux (e.g. a Raspberry Pi) and
+# uses spidev, where several transactions are submitted with a single
+# ioctl() system call, and gpiod for the GD02 edge events.
+#
+# Also provides const and time for code shared between MicroPython and
+# CPython: on MicroPython these are the builtin ones.
+#
+# Copyright 2022 (c) Erik de Lange
+# Released under MIT license
+
+try:
+    from micropython import const
+except ImportError:  # CPython
+    def const(value):
+        return value
+
+import time
+
+if not hasattr(time, "ticks_ms"):  # CPython, add the MicroPython specific functions
+    import time as _time
+
+    class time:
+        sleep = staticmethod(_time.sleep)
+        time_ns = staticmethod(_time.time_ns)
+        gmtime = staticmethod(_time.gmtime)
+        localtime = staticmethod(_time.localtime)
+        mktime = staticmethod(_time.mktime)
+
+        @staticmethod
+        def time():
+            return int(_time.time())  # MicroPython has integer seconds
+
+        @staticmethod
+        def sleep_ms(ms):
+            _time.sleep(ms / 1000)
+
+        @staticmethod
+        def sleep_us(us):
+            _time.sleep(us / 1000000)
+
+        @staticmethod
+        def ticks_ms():
+            return _time.monotonic_ns() // 1000000
+
+        @staticmethod
+        def ticks_us():
+            return _time.monotonic_ns() // 1000
+
+        @staticmethod
+        def ticks_add(ticks, delta):
+            return ticks + delta
+
+        @staticmethod
+        def ticks_diff(ticks1, ticks2):
+            return ticks1 - ticks2
+
+try:
+    from machine import Pin
+    IRQ_FALLING = Pin.IRQ_FALLING
+except ImportError:  # Linux, see GpiodPin
+    IRQ_FALLING = const(2)
+
+
+class MachineBus:
+
+    def __init__(self, spi_id, ss, gd02, miso):
+        """ SPI bus of a MicroPython microcontroller
+
+        Uses a hardware SPI channel with its default pins for MOSI,
+        MISO and SCLK. Chip select is done by hand, as the CC1101
+        requires waiting for MISO to go low after selecting it.
+
+        :param int spi_id: microcontroller SPI channel id
+        :param int ss: pin number used for slave select (SS)
+        :param int gd02: pin number connected to port GD02 of the CC1101
+        :param int miso: pin number of MISO of the SPI channel
+        """
+        from machine import SPI, Pin
+
+        self.miso = Pin(miso)
+        self.ss = Pin(ss, mode=Pin.OUT)
+        self.gd02 = Pin(gd02, mode=Pin.IN)
+        self.deselect()
+        self.spi = SPI(spi_id, baudrate=8000000, polarity=0, phase=0, bits=8,
+                       firstbit=SPI.MSB)  # use default pins for mosi, miso and sclk
+
+    def select(self):
+        """ CC1101 chip select """
+        self.ss.value(0)
+
+    def deselect(self):
+        """ CC1101 chip deselect """
+        self.ss.value(1)
+
+    def spi_wait_miso(self):
+        """ Wait for CC1101 SO to go low """
+        while self.miso.value() != 0:
+            pass
+
+    def wake(self):
+        """ Strobe chip select to wake up the CC1101 before a reset, leaves it selected """
+        self.deselect()
+        time.sleep_us(5)
+        self.select()
+        time.sleep_us(10)
+        self.deselect()
+        time.sleep_us(45)
+        self.select()
+        self.spi_wait_miso()
+
+    def transfer(self, data):
+        """ Perform one SPI transaction
+
+        :param bytes data: bytes to write
+        :return bytearray: bytes read, the first is the CC1101 status byte
+        """
+        buf = bytearray(len(data))
+        self.select()
+        self.spi_wait_miso()
+        self.spi.write_readinto(data, buf)
+        self.deselect()
+        return buf
+
+    def transfers(self, messages):
+        """ Perform several SPI transactions
+
+        :param list messages: bytes to write per transaction
+        :return list: bytes read per transaction
+        """
+        return [self.transfer(data) for data in messages]
+
+
+PORTABLE_TRANSFER = MachineBus.transfer  # kept for comparison with the native version
+
+try:  # native code version of transfer(), see accel.py
+    from accel import transfer
+
+    MachineBus.transfer = transfer
+except (ImportError, SyntaxError, NameError, AttributeError):
+    pass
+
+
+class GpiodPin:
+
+    def __init__(self, chip, offset):
+        """ GPIO input line with falling edge events, behaving like machine.Pin
+
+        :param str chip: gpio chip device, e.g. "/dev/gpiochip0"
+        :param int offset: line number on the chip
+        """
+        import gpiod
+
+        self.offset = offset
+        self.handler = None
+        self.thread = None
+
+        if hasattr(gpiod, "request_lines"):  # libgpiod 2
+            from gpiod.line import Direction, Edge
+
+            settings = gpiod.LineSettings(direction=Direction.INPUT, edge_detection=Edge.FALLING)
+            self.request = gpiod.request_lines(chip, consumer="cc1101", config={offset: settings})
+            self.line = None
+        else:  # libgpiod 1
+            self.request = None
+            self.line = gpiod.Chip(chip).get_line(offset)
+            self.line.request(consumer="cc1101", type=gpiod.LINE_REQ_EV_FALLING_EDGE)
+
+    def value(self):
+        if self.line is not None:
+            return self.line.get_value()
+        return 1 if self.request.get_value(self.offset).value else 0
+
+    def _wait(self):
+        """ Return True if an edge event occurred within a second (and consume it) """
+        if self.line is not None:
+            if self.line.event_wait(sec=1):
+                self.line.event_read()
+                return True
+        elif self.request.wait_edge_events(1):
+            self.request.read_edge_events()
+            return True
+        return False
+
+    def _run(self):
+        while self.handler is not None:
+            if self._wait() is True and self.handler is not None:
+                self.handler(self)
+
+    def irq(self, handler=None, trigger=IRQ_FALLING):
+        """ Call handler(pin) from a background thread on every falling edge, None to stop """
+        import _thread
+
+        self.handler = handler
+        if handler is not None and self.thread is None:
+            self.thread = _thread.start_new_thread(self._run, ())
+
+
+class SpidevBus:
+    SPI_IOC_MAGIC = const(0x6B)  # "k"
+    TRANSFER_SIZE = const(32)  # sizeof(struct spi_ioc_transfer)
+    MAX_TRANSFERS = const(128)  # per ioctl, also keeps the total below the spidev buffer size (4096)
+    READY_TRIES = const(100)  # polls while the CC1101 is not ready (CHIP_RDYn high)
+    SNOP = const(0x3D)  # no operation strobe, returns the status byte
+    FIFO = const(0x3F)
+    SLEEP_STROBES = (0x30, 0x32, 0x38, 0x39)  # SRES, SXOFF, SWOR, SPWD: the chip is not ready afterwards
+
+    def __init__(self, device="/dev/spidev0.0", gd02=None, gpiochip="/dev/gpiochip0", speed=5000000, ioctl=None):
+        """ SPI bus via the Linux spidev driver
+
+        The kernel controls chip select. Several transactions are sent
+        in one SPI_IOC_MESSAGE ioctl, with chip select released between
+        them (cs_change). Chip select cannot be held until MISO is low,
+        instead the status byte of no operation strobes is polled until
+        the CC1101 is ready before a batch is sent. A batch ends after a
+        strobe which makes the chip not ready (e.g. SPWD), so the chip
+        stays ready during a batch and no transaction is repeated.
+
+        :param device: spidev device name, or an open file descriptor
+        :param int gd02: gpio line connected to GD02, None if not used
+        :param str gpiochip: gpio chip device of the GD02 line
+        :param int speed: SPI clock in Hz
+        :param function ioctl: replacement for fcntl.ioctl (e.g. to test with a mock device)
+        """
+        import os
+        import struct
+
+        if ioctl is None:
+            import fcntl
+            ioctl = fcntl.ioctl
+
+        self.struct = struct
+        self.ioctl = ioctl
+        self.speed = speed
+        self.fd = os.open(device, os.O_RDWR) if isinstance(device, str) else device
+        self.gd02 = None if gd02 is None else GpiodPin(gpiochip, gd02)
+        self.syscalls = 0
+        self.ready = False  # the last status byte showed the chip ready, and it was not put to sleep since
+
+        ioctl(self.fd, SpidevBus._iow(1, 1), struct.pack("B", 0))  # SPI_IOC_WR_MODE: mode 0
+        ioctl(self.fd, SpidevBus._iow(3, 1), struct.pack("B", 8))  # SPI_IOC_WR_BITS_PER_WORD
+        ioctl(self.fd, SpidevBus._iow(4, 4), struct.pack("I", speed))  # SPI_IOC_WR_MAX_SPEED_HZ
+
+    @staticmethod
+    def _iow(number, size):
+        """ Linux _IOW(SPI_IOC_MAGIC, number, size) """
+        return (1 << 30) | (size << 16) | (SpidevBus.SPI_IOC_MAGIC << 8) | number
+
+    def wake(self):
+        """ Wait until the CC1101 is ready, using no operation strobes """
+        self.ready = False
+        self._wait_ready()
+
+    def _wait_ready(self):
+        for _ in range(SpidevBus.READY_TRIES):
+            if self._submit([bytes((SpidevBus.SNOP,))])[0][0] & 0x80 == 0:
+                self.ready = True
+                return
+            time.sleep_us(100)
+        raise OSError("CC1101 not ready")
+
+    @staticmethod
+    def _sleeps(data):
+        """ Return True if the transaction is a strobe after which the chip is not ready """
+        return len(data) == 1 and data[0] & 0x3F in SpidevBus.SLEEP_STROBES
+
+    @staticmethod
+    def _idempotent(data):
+        """ Return True if performing the transaction twice has the same effect as once """
+        address = data[0] & 0x3F
+        if len(data) == 1 and 0x30 <= address <= 0x3D:
+            return address == SpidevBus.SNOP  # command strobe
+        return address != SpidevBus.FIFO
+
+    def transfer(self, data):
+        return self.transfers([data])[0]
+
+    def transfers(self, messages):
+        """ Perform several SPI transactions with as few system calls as possible
+
+        :param list messages: bytes to write per transaction
+        :return list: bytes read per transaction
+        :raises OSError: if the chip does not become ready, or is not ready in the middle of a batch
+        """
+        results = list()
+        index = 0
+
+        while index < len(messages):
+            if self.ready is False:
+                self._wait_ready()
+            end = index
+            while end < len(messages) and end - index < SpidevBus.MAX_TRANSFERS:
+                end += 1
+                if SpidevBus._sleeps(messages[end - 1]):
+                    break
+            batch = messages[index:end]
+
+            for i, received in enumerate(self._submit(batch)):
+                if received[0] & 0x80:  # CHIP_RDYn: this transaction was not performed
+                    self.ready = False
+                    if not all(SpidevBus._idempotent(data) for data in batch[i + 1:]):
+                        raise OSError("CC1101 not ready in the middle of a batch")
+                    break  # repeat from this transaction when ready
+                results.append(received)
+                index += 1
+            else:
+                self.ready = not SpidevBus._sleeps(batch[-1])
+
+        return results
+
+    def _submit(self, batch):
+        """ Send the transactions in a single SPI_IOC_MESSAGE ioctl, return the bytes read per transaction """
+        from array import array
+
+        tx = array("B", b"".join(batch))
+        rx = array("B", bytes(len(tx)))
+        tx_address = tx.buffer_info()[0]
+        rx_address = rx.buffer_info()[0]
+
+        descriptors = bytearray(SpidevBus.TRANSFER_SIZE * len(batch))
+        offset = 0
+        for i, data in enumerate(batch):
+            cs_change = 1 if i < len(batch) - 1 else 0  # release chip select between transactions
+            self.struct.pack_into("QQIIHBBBBBB", descriptors, i * SpidevBus.TRANSFER_SIZE,
+                                  tx_address + offset, rx_address + offset, len(data), self.speed,
+                                  0, 8, cs_change, 0, 0, 0, 0)
+            offset += len(data)
+
+        self.ioctl(self.fd, SpidevBus._iow(0, len(descriptors)), descriptors)  # SPI_IOC_MESSAGE(n)
+        self.syscalls += 1
+
+        received = list()
+        offset = 0
+        for data in batch:
+            received.append(bytearray(rx[offset:offset + len(data)]))
+            offset += len(data)
+        return received
+
+    def close(self):
+        import os
+
+        if self.gd02 is not None:
+            self.gd02.irq(None)
+        os.close(self.fd)
+
+
+if __name__ == "__main__":
+    # Run ITHO receive and transmit initialization against a mock CC1101 behind a
+    # mock spidev device (CPython only), and count the system calls needed.
+
+    import ctypes
+    import struct
+
+    from cc1101 import CC1101
+    from itho import ITHO
+
+    class MockSpidev:
+        """ Decodes SPI_IOC_MESSAGE descriptors and emulates the CC1101 registers and states """
+
+        def __init__(self):
+            self.registers = bytearray(0x3F)
+            self.state = CC1101.MARCSTATE_IDLE
+            self.transactions = 0
+            self.wake_time = 0  # transactions answered with CHIP_RDYn high after a sleep strobe
+            self.waking = 0
+            self.performed = list()  # transactions which are not idempotent, in order
+
+        def __call__(self, fd, request, argument):
+            if request & 0xFF != 0:
+                return 0  # mode, bits per word or speed
+            for i in range(len(argument) // SpidevBus.TRANSFER_SIZE):
+                tx, rx, length = struct.unpack_from("QQI", argument, i * SpidevBus.TRANSFER_SIZE)
+                ctypes.memmove(rx, self.transaction(ctypes.string_at(tx, length)), length)
+            return 0
+
+        def transaction(self, data):
+            self.transactions += 1
+            header = data[0]
+            address = header & 0x3F
+            response = bytearray(len(data))
+            if self.waking > 0:
+                self.waking -= 1
+                response[0] = 0x8F  # status byte, CHIP_RDYn high, the transaction is ignored
+                return bytes(response)
+            response[0] = 0x0F  # status byte, CHIP_RDYn low
+            if not SpidevBus._idempotent(data):
+                self.performed.append(bytes(data))
+            if SpidevBus._sleeps(data):
+                self.waking = self.wake_time
+            if len(data) == 1 and 0x30 <= address <= 0x3D:  # command strobe
+                if address == CC1101.SRES:
+                    self.registers = bytearray(0x3F)
+                self.state = {CC1101.SRX: CC1101.MARCSTATE_RX, CC1101.SWOR: CC1101.MARCSTATE_SLEEP,
+                              CC1101.SPWD: CC1101.MARCSTATE_SLEEP}.get(address, CC1101.MARCSTATE_IDLE)
+            elif header & 0x80:  # read
+                for i in range(1, len(data)):
+                    if address == CC1101.MARCSTATE and header & 0x40:
+                        response[i] = self.state
+                    elif address + i - 1 < len(self.registers):
+                        response[i] = self.registers[address + i - 1]
+            else:  # write
+                for i in range(1, len(data)):
+                    if address + i - 1 < len(self.registers):
+                        self.registers[address + i - 1] = data[i]
+            return bytes(response)
+
+    mock = MockSpidev()
+    bus = SpidevBus(-1, ioctl=mock)
+    itho = ITHO(CC1101(bus=bus), 22, (116, 233, 94))
+
+    requested = list()  # transactions which are not idempotent, as requested by the driver
+    submit = bus.transfers
+
+    def transfers(messages):
+        requested.extend(bytes(data) for data in messages if not SpidevBus._idempotent(data))
+        return submit(messages)
+
+    bus.transfers = transfers
+
+    for name, function in (("init_receive (first, calibrates)", itho.init_receive),
+                           ("init_transfer (first, calibrates)", lambda: itho.init_transfer(52)),
+                           ("finish_transfer (back to receive)", itho.finish_transfer),
+                           ("init_transfer", lambda: itho.init_transfer(52))):
+        transactions, syscalls = mock.transactions, bus.syscalls
+        function()
+        print(f"{name}: {mock.transactions - transactions} SPI transactions in {bus.syscalls - syscalls} ioctl calls")
+
+    # the chip is not ready for a while after SRES, SWOR and SPWD, strobes and FIFO access must not be repeated
+    mock.wake_time = 3
+    mock.performed.clear()
+    requested.clear()
+    itho.configure()
+    itho.init_wor(1000, 0)
+    itho.init_receive()
+    itho.init_transfer(52)
+    itho.finish_transfer()
+    print("strobes and FIFO accesses performed once each:", mock.performed == requested)
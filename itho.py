@@ -4,14 +4,11 @@
 # https://github.com/letscontrolit/ESPEasyPluginPlayground/tree/master/libraries%20_PLUGIN145%20ITHO%20FAN/Itho
 #
 
-import time
-
-from machine import Pin
-from micropython import const
-
 import config
 from cc1101 import CC1101
-from config import GD02_PIN, SPI_ID, SS_PIN
+from config import GD02_PIN, SPI_ID, SS_PIN, WOR_INTERVAL_MS, WOR_RX_TIME
+from dedup import DuplicateFilter
+from hal import IRQ_FALLING, const, time
 
 
 class CC1101MESSAGE:
@@ -62,11 +59,14 @@ class ITHOCOMMAND:
 
 class ITHOPACKET:
 
+    HEADER_LENGTH = const(14)  # remote type, id, counter and command bytes (even, see message_decode)
+
     def __init__(self):
         self.command = ITHOCOMMAND.UNKNOWN  # used for incoming message only
         self.remote_type = 0  # used for incoming message only
         self.remote_id = bytearray(3)  # used for incoming message only
         self.counter = 0  # used for incoming message only
+        self.rssi = 0  # dBm, used for incoming message only
 
         self.data_decoded = bytearray(32)
         self.data_decoded_chk = bytearray(32)
@@ -90,6 +90,7 @@ class ITHOPACKET:
             print(self.data_decoded_chk[i], end=' ')
         print()
         print("    counter", self.counter)
+        print("       rssi", self.rssi)
         print()
 
     def message_encode(self, message):
@@ -161,15 +162,25 @@ class ITHOPACKET:
 
         return out_bytecounter
 
-    def message_decode(self, message):
+    def message_decode(self, message, first=0, length=None):
         """ Decode message into this ITHOPACKET (= self)
 
+        A message can be decoded in parts. Every 5 message bytes contain
+        2 decoded bytes, so a part must start at an even decoded byte.
+
         :param bytearray message: message to decode
+        :param int first: first decoded byte to produce (even)
+        :param int length: number of decoded bytes to produce, None for all
         """
         STARTBYTE = 2  # Relevant data starts 2 bytes after the sync pattern bytes SYNC1/SYNC0 = 179/42
 
+        start = STARTBYTE + first * 5 // 2
+        end = len(message)
+        if length is not None:
+            end = min(end, start + (length * 5 + 1) // 2)
+
         self.data_length = 0
-        len_in_buf = len(message) - STARTBYTE  # Correct for sync byte pos
+        len_in_buf = end - STARTBYTE  # Correct for sync byte pos
 
         while len_in_buf >= 5:
             len_in_buf -= 5
@@ -178,13 +189,13 @@ class ITHOPACKET:
         if len_in_buf >= 3:
             self.data_length += 1
 
-        out_i = 0
+        out_i = first
         out_j = 4
-        out_i_chk = 0
+        out_i_chk = first
         out_j_chk = 4
         in_bitcounter = 0
 
-        for i in range(STARTBYTE, len(message)):
+        for i in range(start, end):
             for j in range(7, -1, -1):
                 if in_bitcounter in [0, 2, 4, 6]:
                     x = message[i]
@@ -207,7 +218,7 @@ class ITHOPACKET:
                     if out_j_chk > 7:
                         out_j_chk = 0
                     if out_j_chk == 4:
-                        self.data_decoded_chk[out_i_chk] = ~self.data_decoded_chk[out_i_chk]
+                        self.data_decoded_chk[out_i_chk] = ~self.data_decoded_chk[out_i_chk] & 0xFF
                         out_i_chk += 1
                 in_bitcounter += 1
                 if in_bitcounter > 9:
@@ -217,6 +228,54 @@ class ITHOPACKET:
 class ITHO:
 
     SEND_TRIES = const(3)
+    MDMCFG4 = const(0x5A)  # channel bandwidth and data rate exponent
+    MDMCFG3 = const(0x83)  # data rate mantissa, with MDMCFG4 38.4 kBaud
+
+    TX = const(0)
+    RX = const(1)
+    CALIBRATION_AGE = const(600000)  # ms after which the frequency synthesizer is calibrated again
+    RECEIVE_LENGTH = const(63)  # message length after the sync word 179/42
+
+    # Registers with the same value when transmitting and receiving. Values only
+    # used by the receiver (e.g. AGC) do not influence the transmitter and vice versa.
+    CONFIGURATION = (
+        (CC1101.IOCFG2, 0x06),  # GD02 Assert when sync word has been sent/received, and de-asserts at end of packet
+        (CC1101.IOCFG1, 0x2E),  # GD01 High impedance (3-state)
+        (CC1101.FREQ2, 0x21),  # 00100001  878MHz-927.8MHz
+        (CC1101.FREQ1, 0x65),  # 01100101
+        (CC1101.FREQ0, 0x6A),  # 01101010
+        (CC1101.FSCTRL1, 0x06),
+        (CC1101.FSCTRL0, 0x00),
+        (CC1101.MDMCFG4, MDMCFG4),
+        (CC1101.MDMCFG3, MDMCFG3),
+        (CC1101.MDMCFG1, 0x22),  # Disable FEC
+        (CC1101.MDMCFG0, 0xF8),
+        (CC1101.CHANNR, 0x00),
+        (CC1101.DEVIATN, 0x50),
+        (CC1101.FREND1, 0x56),
+        (CC1101.FREND0, 0x17),  # 00010111 use index 7 in PA table
+        (CC1101.MCSM0, 0x08),  # No auto calibrate, calibration is done by _switch()
+        (CC1101.FOCCFG, 0x16),
+        (CC1101.BSCFG, 0x6C),
+        (CC1101.AGCCTRL2, 0x43),
+        (CC1101.AGCCTRL1, 0x40),
+        (CC1101.AGCCTRL0, 0x91),
+        (CC1101.FSCAL0, 0x11),
+        (CC1101.FSTEST, 0x59),
+        (CC1101.TEST2, 0x81),
+        (CC1101.TEST1, 0x35),
+        (CC1101.PKTCTRL1, 0x00),  # No address check, no status bytes appended
+        (CC1101.PKTCTRL0, 0x00),  # Fixed packet length, CRC disabled, no data whitening, FIFO mode
+        (CC1101.ADDR, 0x00),
+        (CC1101.SYNC1, 179),
+        (CC1101.SYNC0, 42)
+    )
+
+    # Registers which differ per direction: (IOCFG0, MDMCFG2, TEST0, FSCAL3 before calibration)
+    DIRECTION = (
+        (0x2E, 0x00, 0x0B, 0xA9),  # TX: GD00 3-state, 2-FSK without preamble/sync (part of the message)
+        (0x0D, 0x02, 0x09, 0xE9)  # RX: GD00 serial data output, 2-FSK with 16 bit sync word
+    )
 
     def __init__(self, rf, remote_type=None, remote_id=None):
         """ Create ITHO CVU controller
@@ -235,182 +294,147 @@ class ITHO:
 
         self.counter = 0  # 0-255 counter, incremented every remote button press / command sent
 
-    def init_transfer(self, length):
-        self.rf.write_command(CC1101.SIDLE)
-        time.sleep_us(1)
+        self.duplicates = DuplicateFilter()  # None to receive every copy of a message
+        self.traffic = None  # TrafficTable accounting every received frame, None if not used
+        self.rssi = 0  # dBm of the last received message
 
-        self.rf.write_register(CC1101.IOCFG0, 0x2E)
-        time.sleep_us(1)
-        self.rf.write_register(CC1101.IOCFG1, 0x2E)
-        time.sleep_us(1)
+        self.configured = False  # CONFIGURATION written since the last reset or power down
+        self.receiving = False  # set by init_receive(), return to receive mode after transmitting
+        self.wor = None  # (EVENT0, RX_TIME) when receiving in Wake-on-Radio mode
+        self.calibration = [None, None]  # FSCAL3, FSCAL2, FSCAL1 after calibration per direction
+        self.calibrated = [0, 0]  # time.ticks_ms() of the calibration per direction
+        self.calibrations = 0
 
+    def configure(self):
+        """ Reset the CC1101 and write the registers shared by transmitter and receiver """
         self.rf.write_command(CC1101.SIDLE)
-        self.rf.write_command(CC1101.SPWD)
-        time.sleep_us(2)
-
         self.rf.write_command(CC1101.SRES)
-        time.sleep_us(1)
-
-        self.rf.write_register(CC1101.IOCFG0, 0x2E)  # High impedance (3-state)
-        self.rf.write_register(CC1101.FREQ2, 0x21)  # 00100001  878MHz-927.8MHz
-        self.rf.write_register(CC1101.FREQ1, 0x65)  # 01100101
-        self.rf.write_register(CC1101.FREQ0, 0x6A)  # 01101010
-        self.rf.write_register(CC1101.MDMCFG4, 0x5A)
-        self.rf.write_register(CC1101.MDMCFG3, 0x83)
-        self.rf.write_register(CC1101.MDMCFG2, 0x00)  # 00000000 2-FSK, no manchester encoding/decoding, no preamble/sync
-        self.rf.write_register(CC1101.MDMCFG1, 0x22)  # 00100010
-        self.rf.write_register(CC1101.MDMCFG0, 0xF8)  # 11111000
-        self.rf.write_register(CC1101.CHANNR, 0x00)  # 00000000
-        self.rf.write_register(CC1101.DEVIATN, 0x50)
-        self.rf.write_register(CC1101.FREND0, 0x17)  # 00010111 use index 7 in PA table
-        self.rf.write_register(CC1101.MCSM0, 0x18)  # 00011000  PO timeout Approx. 146microseconds - 171microseconds, Auto calibrate When going from IDLE to RX or TX (or FSTXON)
-        self.rf.write_register(CC1101.FSCAL3, 0xA9)  # 10101001
-        self.rf.write_register(CC1101.FSCAL2, 0x2A)  # 00101010
-        self.rf.write_register(CC1101.FSCAL1, 0x00)  # 00000000
-        self.rf.write_register(CC1101.FSCAL0, 0x11)  # 00010001
-        self.rf.write_register(CC1101.FSTEST, 0x59)  # 01011001 For test only. Do not write to this register.
-        self.rf.write_register(CC1101.TEST2, 0x81)  # 10000001 For test only. Do not write to this register.
-        self.rf.write_register(CC1101.TEST1, 0x35)  # 00110101 For test only. Do not write to this register.
-        self.rf.write_register(CC1101.TEST0, 0x0B)  # 00001011 For test only. Do not write to this register.
-        self.rf.write_register(CC1101.PKTCTRL0, 0x12)  # 00010010 Enable infinite length packets, CRC disabled, Turn data whitening off, Serial Synchronous mode
-        self.rf.write_register(CC1101.ADDR, 0x00)  # 00000000
-        self.rf.write_register(CC1101.PKTLEN, 0xFF)  # 11111111  Not used, no hardware packet handling
+        self.rf.flush()
+        time.sleep_us(50)
+
+        for address, value in ITHO.CONFIGURATION:
+            self.rf.write_register(address, value)
 
         self.rf.write_burst(CC1101.PATABLE | CC1101.WRITE_BURST, bytearray(
             (0x6F, 0x26, 0x2E, 0x8C, 0x87, 0xCD, 0xC7, 0xC0)))
 
-        self.rf.write_command(CC1101.SIDLE)
-        self.rf.write_command(CC1101.SIDLE)
+        self.configured = True
 
-        self.rf.write_register(CC1101.MDMCFG4, 0x5A)
-        self.rf.write_register(CC1101.MDMCFG3, 0x83)
-        self.rf.write_register(CC1101.DEVIATN, 0x50)
-        self.rf.write_register(CC1101.IOCFG0, 0x2D)  # GDO0_Z_EN_N. When this output is 0, GDO0 is configured as input (for serial TX data).
-        self.rf.write_register(CC1101.IOCFG1, 0x0B)  # Serial Clock. Synchronous to the data in synchronous serial mode.
+    def _switch(self, direction, length):
+        """ Prepare the CC1101 for transmitting or receiving
 
-        self.rf.write_command(CC1101.STX)
-        self.rf.write_command(CC1101.SIDLE)
+        Only the registers which differ per direction are written. The
+        frequency synthesizer is calibrated the first time, and after
+        CALIBRATION_AGE ms. Otherwise the calibration results are
+        restored, which is much faster than calibrating. The register
+        writes are batched, see CC1101.start_batch().
 
-        self.rf.write_register(CC1101.MDMCFG4, 0x5A)
-        self.rf.write_register(CC1101.MDMCFG3, 0x83)
-        self.rf.write_register(CC1101.DEVIATN, 0x50)
+        :param int direction: ITHO.TX or ITHO.RX
+        :param int length: packet length
+        """
+        self.rf.start_batch()
+        self.rf.write_command(CC1101.SIDLE)
 
-        # Itho is using serial mode for transmit. We want to use the TX FIFO with fixed packet length for simplicity.
-        self.rf.write_register(CC1101.IOCFG0, 0x2E)
-        self.rf.write_register(CC1101.IOCFG1, 0x2E)
-        self.rf.write_register(CC1101.PKTCTRL0, 0x00)
-        self.rf.write_register(CC1101.PKTCTRL1, 0x00)
+        if self.configured is False:
+            self.configure()
 
+        iocfg0, mdmcfg2, test0, fscal3 = ITHO.DIRECTION[direction]
+        self.rf.write_register(CC1101.IOCFG0, iocfg0)
+        self.rf.write_register(CC1101.MDMCFG2, mdmcfg2)
+        self.rf.write_register(CC1101.TEST0, test0)
         self.rf.write_register(CC1101.PKTLEN, length)
 
-    def finish_transfer(self):
-        self.rf.write_command(CC1101.SIDLE)
-        time.sleep_us(1)
-
-        # GD00 High impedance (3-state)
-        self.rf.write_register(CC1101.IOCFG0, 0x2E)
-        # GD01 High impedance (3-state)
-        self.rf.write_register(CC1101.IOCFG1, 0x2E)
-
-        self.rf.write_command(CC1101.SIDLE)
-        self.rf.write_command(CC1101.SPWD)
+        calibration = self.calibration[direction]
+        if calibration is None or time.ticks_diff(time.ticks_ms(), self.calibrated[direction]) > ITHO.CALIBRATION_AGE:
+            self.rf.write_register(CC1101.FSCAL3, fscal3)
+            self.rf.write_register(CC1101.FSCAL2, 0x2A)
+            self.rf.write_register(CC1101.FSCAL1, 0x00)
+            self.rf.write_command(CC1101.SCAL)
+            # wait for calibration to finish
+            while self.rf.read_register(CC1101.MARCSTATE, CC1101.STATUS_REGISTER) != CC1101.MARCSTATE_IDLE:
+                pass
+            self.calibration[direction] = self.rf.read_burst(CC1101.FSCAL3, 3)
+            self.calibrated[direction] = time.ticks_ms()
+            self.calibrations += 1
+        else:
+            self.rf.write_burst(CC1101.FSCAL3 | CC1101.WRITE_BURST, calibration)
+        self.rf.end_batch()
 
-    def init_receive(self):
-        self.rf.write_command(CC1101.SRES)
+    def init_transfer(self, length):
+        """ Prepare the CC1101 for transmitting a message of length bytes from the TX FIFO """
+        self._switch(ITHO.TX, length)
 
-        self.rf.write_register(CC1101.TEST0, 0x09)
-        self.rf.write_register(CC1101.FSCAL2, 0x00)
+    def finish_transfer(self):
+        """ Return to receive mode, or power down when not receiving
 
-        self.rf.write_burst(CC1101.PATABLE | CC1101.WRITE_BURST, bytearray(
-            (0x6F, 0x26, 0x2E, 0x7F, 0x8A, 0x84, 0xCA, 0xC4)))
-
-        self.rf.write_command(CC1101.SCAL)
-        # wait for calibration to finish
-        while self.rf.read_register(CC1101.MARCSTATE, CC1101.STATUS_REGISTER) != CC1101.MARCSTATE_IDLE:
-            pass
-
-        self.rf.write_register(CC1101.FSCAL2, 0x00)
-        self.rf.write_register(CC1101.MCSM0, 0x18)  # No auto calibrate
-        self.rf.write_register(CC1101.FREQ2, 0x21)
-        self.rf.write_register(CC1101.FREQ1, 0x65)
-        self.rf.write_register(CC1101.FREQ0, 0x6A)
-        self.rf.write_register(CC1101.IOCFG0, 0x2E)  # GD00 High impedance (3-state)
-        self.rf.write_register(CC1101.IOCFG2, 0x06)  # GD02 Assert when sync word has been sent/received, and de-asserts at end of packet
-        self.rf.write_register(CC1101.FSCTRL1, 0x06)
-        self.rf.write_register(CC1101.FSCTRL0, 0x00)
-        self.rf.write_register(CC1101.MDMCFG4, 0x5A)
-        self.rf.write_register(CC1101.MDMCFG3, 0x83)
-        self.rf.write_register(CC1101.MDMCFG2, 0x00)  # Enable digital DC blocking filter before demodulator, 2-FSK, Disable Manchester encoding/decoding, No preamble/sync
-        self.rf.write_register(CC1101.MDMCFG1, 0x22)  # Disable FEC
-        self.rf.write_register(CC1101.MDMCFG0, 0xF8)
-        self.rf.write_register(CC1101.CHANNR, 0x00)
-        self.rf.write_register(CC1101.DEVIATN, 0x50)
-        self.rf.write_register(CC1101.FREND1, 0x56)
-        self.rf.write_register(CC1101.FREND0, 0x17)
-        self.rf.write_register(CC1101.MCSM0, 0x18)  # No auto calibrate
-        self.rf.write_register(CC1101.FOCCFG, 0x16)
-        self.rf.write_register(CC1101.BSCFG, 0x6C)
-        self.rf.write_register(CC1101.AGCCTRL2, 0x43)
-        self.rf.write_register(CC1101.AGCCTRL1, 0x40)
-        self.rf.write_register(CC1101.AGCCTRL0, 0x91)
-        self.rf.write_register(CC1101.FSCAL3, 0xE9)
-        self.rf.write_register(CC1101.FSCAL2, 0x2A)
-        self.rf.write_register(CC1101.FSCAL1, 0x00)
-        self.rf.write_register(CC1101.FSCAL0, 0x11)
-        self.rf.write_register(CC1101.FSTEST, 0x59)
-        self.rf.write_register(CC1101.TEST2, 0x81)
-        self.rf.write_register(CC1101.TEST1, 0x35)
-        self.rf.write_register(CC1101.TEST0, 0x0B)
-        self.rf.write_register(CC1101.PKTCTRL1, 0x04)  # No address check, append two bytes with status RSSI/LQI/CRC OK,
-        # Infinite packet length mode, CRC disabled for TX and RX, No data whitening, Asynchronous serial mode, Data in on GDO0 and data out on either of the GDOx pins
-        self.rf.write_register(CC1101.PKTCTRL0, 0x32)
-        self.rf.write_register(CC1101.ADDR, 0x00)
-        self.rf.write_register(CC1101.PKTLEN, 0xFF)
-        self.rf.write_register(CC1101.TEST0, 0x09)
-
-        self.rf.write_command(CC1101.SCAL)
-        # wait for calibration to finish
-        while self.rf.read_register(CC1101.MARCSTATE, CC1101.STATUS_REGISTER) != CC1101.MARCSTATE_IDLE:
-            pass
-
-        self.rf.write_register(CC1101.MCSM0, 0x18)  # No auto calibrate
+        In power down the test registers and PA table are lost, so the
+        CC1101 is configured again before the next transmission.
+        """
+        if self.receiving is True:
+            self._switch(ITHO.RX, ITHO.RECEIVE_LENGTH)
+            self.init_receive_message()
+        else:
+            self.rf.start_batch()
+            self.rf.write_command(CC1101.SIDLE)
+            self.rf.write_command(CC1101.SPWD)
+            self.rf.end_batch()
+            self.configured = False
 
-        self.rf.write_command(CC1101.SIDLE)
-        self.rf.write_command(CC1101.SIDLE)
+    def init_receive(self):
+        """ Switch to receive mode
 
-        # Enable digital DC blocking filter before demodulator, 2-FSK, Disable Manchester encoding/decoding, No preamble/sync
-        self.rf.write_register(CC1101.MDMCFG2, 0x00)
-        # Serial Data Output. Used for asynchronous serial mode.
-        self.rf.write_register(CC1101.IOCFG0, 0x0D)
+        The CC1101 receives messages with a fixed length of 63 bytes
+        following the sync word 179/42 (which is removed by the CC1101).
+        After transmitting it returns to receive mode by itself, until
+        attribute receiving is set to False.
+        """
+        self.receiving = True
+        self.wor = None
+        self._switch(ITHO.RX, ITHO.RECEIVE_LENGTH)
+        self.init_receive_message()
 
-        self.rf.write_command(CC1101.SRX)
+    def init_wor(self, interval=WOR_INTERVAL_MS, rx_time=WOR_RX_TIME):
+        """ Switch to Wake-on-Radio receive mode
 
-        while self.rf.read_register(CC1101.MARCSTATE, CC1101.STATUS_REGISTER) != CC1101.MARCSTATE_RX:
-            pass
+        The CC1101 sleeps and wakes up every interval ms to listen for a
+        sync word during a fraction of the interval set by rx_time. If
+        no sync word is found it goes back to sleep, else the message is
+        received and signalled on GD02 as in continuous receive mode.
+        The test registers are lost in SLEEP, so the receiver runs with
+        their default values.
 
+        :param int interval: ms between polls, 1 to 1890
+        :param int rx_time: MCSM2.RX_TIME, receive during 12.5% (0) to 0.195% (6) of the interval
+        """
+        event0 = interval * CC1101.F_XOSC // 750000  # WOR_RES = 0: EVENT0 period is 750 / F_XOSC
+        if not (0 < event0 <= 0xFFFF and 0 <= rx_time <= 6):
+            raise ValueError(f"invalid WOR interval {interval} ms or rx_time {rx_time}")
+        self.receiving = True
+        self.wor = (event0, rx_time)
+        self._switch(ITHO.RX, ITHO.RECEIVE_LENGTH)
         self.init_receive_message()
 
     def init_receive_message(self):
+        """ Flush the RX FIFO and wait for the next message """
+        self.rf.start_batch()
         self.rf.write_command(CC1101.SIDLE)
 
-        # Set datarate
-        self.rf.write_register(CC1101.MDMCFG4, 0x5A)  # Set kBaud
-        self.rf.write_register(CC1101.MDMCFG3, 0x83)  # Set kBaud
-        self.rf.write_register(CC1101.DEVIATN, 0x50)
-
-        # Set fifo mode with fixed packet length and sync bytes
-        # 63 bytes message (sync at beginning of message is removed by CC1101)
-        self.rf.write_register(CC1101.PKTLEN, 63)
-
-        # Set fifo mode with fixed packet length and sync bytes
-        self.rf.write_register(CC1101.PKTCTRL0, 0x00)
-        self.rf.write_register(CC1101.SYNC1, 179)
-        self.rf.write_register(CC1101.SYNC0, 42)
-        # 16bit sync word / 16bit specific
-        self.rf.write_register(CC1101.MDMCFG2, 0x02)
-        self.rf.write_register(CC1101.PKTCTRL1, 0x00)
-
+        if self.wor is not None:
+            event0, rx_time = self.wor
+            self.rf.write_register(CC1101.MCSM2, rx_time)  # RX_TIME_QUAL = 0: stay in RX if a sync word was found
+            self.rf.write_register(CC1101.WOREVT1, event0 >> 8)
+            self.rf.write_register(CC1101.WOREVT0, event0 & 0xFF)
+            self.rf.write_register(CC1101.WORCTRL, 0x78)  # RC oscillator on, EVENT1 = 7, RC_CAL = 1, WOR_RES = 0
+            self.rf.write_command(CC1101.SFRX)  # Flush RX buffer
+            self.rf.write_command(CC1101.SWORRST)
+            self.rf.write_command(CC1101.SWOR)  # Start polling
+            self.rf.end_batch()
+            self.configured = False  # test registers and PA table are lost in SLEEP
+            return
+
+        self.rf.write_command(CC1101.SFRX)  # Flush RX buffer
         self.rf.write_command(CC1101.SRX)  # Switch to RX state
+        self.rf.end_batch()
 
         # Wait until RX state is entered
         while True:
@@ -424,10 +448,11 @@ class ITHO:
     def get_new_packet(self):
         """ Receive message and convert into ITHOPACKET
 
-        :return ITHOPACKET: packet received, None if invalid packet was received
+        :return ITHOPACKET: packet received, None if invalid or duplicate packet was received
         """
-        message = self.rf.receive_data(63)
-        if len(message) == 63:
+        self.rssi = self.rf.rssi()  # read before receive_data() returns to RX
+        message = self.rf.receive_data(ITHO.RECEIVE_LENGTH)
+        if len(message) == ITHO.RECEIVE_LENGTH:
             itho_packet = self.parse_message(message)
             self.init_receive_message()
             return itho_packet
@@ -436,18 +461,24 @@ class ITHO:
     def parse_message(self, message):
         """ Extract information from message into ITHOPACKET
 
+        First only the header and command bytes are decoded. A repeated
+        copy of a message already received is counted and not decoded
+        any further. Every frame, also a repeated copy, is accounted in
+        the traffic table (if any).
+
         :param bytearray message: message to parse
-        :return ITHOPACKET: parsed message
+        :return ITHOPACKET: parsed message, None if a duplicate
         """
         itho_packet = ITHOPACKET()
 
-        itho_packet.message_decode(message)
+        itho_packet.message_decode(message, 0, ITHOPACKET.HEADER_LENGTH)
 
         itho_packet.remote_type = itho_packet.data_decoded[0]
         itho_packet.remote_id[0] = itho_packet.data_decoded[1]
         itho_packet.remote_id[1] = itho_packet.data_decoded[2]
         itho_packet.remote_id[2] = itho_packet.data_decoded[3]
         itho_packet.counter = itho_packet.data_decoded[4]
+        itho_packet.rssi = self.rssi
 
         commandbytes = list()
         offset = 7 if itho_packet.remote_type in [24, 28] else 5
@@ -462,6 +493,17 @@ class ITHO:
         else:
             itho_packet.command = ITHOCOMMAND.find_command(commandbytes)
 
+        if self.traffic is not None:
+            self.traffic.update(itho_packet.remote_type, itho_packet.remote_id, itho_packet.counter,
+                                itho_packet.command, itho_packet.rssi)
+
+        if itho_packet.command != ITHOCOMMAND.UNKNOWN and self.duplicates is not None:
+            if self.duplicates.check(itho_packet.remote_type, itho_packet.remote_id,
+                                     itho_packet.counter, itho_packet.command) is True:
+                return None
+
+        itho_packet.message_decode(message, ITHOPACKET.HEADER_LENGTH)
+
         return itho_packet
 
     def send_command(self, command):
@@ -471,15 +513,9 @@ class ITHO:
         """
         self.counter += 1
 
-        # create message
-        if command == ITHOCOMMAND.JOIN:
-            message = self.create_message_join()
-        elif command == ITHOCOMMAND.LEAVE:
-            message = self.create_message_leave()
-        else:
-            message = self.create_message_command(command)
+        message = self.create_message(command)
 
-        tries = 30 if command == ITHOCOMMAND.LEAVE else ITHO.SEND_TRIES
+        tries = ITHO.tries(command)
         delay = 4 if command == ITHOCOMMAND.LEAVE else 40
 
         # send message
@@ -489,6 +525,31 @@ class ITHO:
             self.finish_transfer()
             time.sleep_ms(delay)
 
+    def transmission(self, command):
+        """ Return the number of frames and the frame length in bytes sent for command
+
+        :param int command: command to send
+        :return tuple: (frames, length)
+        """
+        return ITHO.tries(command), len(self.create_message(command))
+
+    @staticmethod
+    def tries(command):
+        """ Return the number of times the message for command is sent """
+        return 30 if command == ITHOCOMMAND.LEAVE else ITHO.SEND_TRIES
+
+    def create_message(self, command):
+        """ Prepare message for command
+
+        :param int command: command to send
+        :return bytearray: message ready for sending
+        """
+        if command == ITHOCOMMAND.JOIN:
+            return self.create_message_join()
+        if command == ITHOCOMMAND.LEAVE:
+            return self.create_message_leave()
+        return self.create_message_command(command)
+
     def create_message_command(self, command):
         """ Prepare message for command (except JOIN or LEAVE)
 
@@ -637,7 +698,21 @@ class ITHO:
         for i in range(length):
             value += itho_packet.data_decoded[i]
             value &= 0xFF
-        return 0 - value
+        return (0 - value) & 0xFF
+
+
+# Use the native/viper versions of the codec if the port has these code emitters,
+# see accel.py. The portable versions remain available for comparison.
+PORTABLE = (ITHOPACKET.message_encode, ITHOPACKET.message_decode, ITHO.checksum)
+
+try:
+    import accel
+
+    ITHOPACKET.message_encode = accel.message_encode
+    ITHOPACKET.message_decode = accel.message_decode
+    ITHO.checksum = staticmethod(accel.checksum)
+except (ImportError, SyntaxError, NameError, AttributeError):
+    accel = None
 
 
 class ITHOREMOTE:
@@ -680,6 +755,47 @@ class ITHOREMOTE:
         self.itho.send_command(ITHOCOMMAND.LEAVE)
 
 
+def measure_turnaround(itho, rounds=20):
+    """ Measure the time needed to switch between receiving and transmitting
+
+    The first switch in each direction includes configuring and
+    calibrating the CC1101, later switches restore the calibration.
+    Nothing is transmitted.
+
+    :param ITHO itho: controller with CC1101
+    :param int rounds: number of switches to average
+    :return dict: us per switch
+    """
+    receiving = itho.receiving
+    itho.configured = False
+    itho.calibration = [None, None]
+
+    start = time.ticks_us()
+    itho.init_receive()
+    cold_rx = time.ticks_diff(time.ticks_us(), start)
+
+    start = time.ticks_us()
+    itho.init_transfer(ITHO.RECEIVE_LENGTH)
+    cold_tx = time.ticks_diff(time.ticks_us(), start)
+
+    to_tx = to_rx = 0
+    for _ in range(rounds):
+        start = time.ticks_us()
+        itho.init_transfer(ITHO.RECEIVE_LENGTH)
+        middle = time.ticks_us()
+        itho.finish_transfer()  # back to receive mode
+        to_tx += time.ticks_diff(middle, start)
+        to_rx += time.ticks_diff(time.ticks_us(), middle)
+
+    itho.receiving = receiving
+    return {
+        "first_rx_us": cold_rx,
+        "first_tx_us": cold_tx,
+        "rx_to_tx_us": to_tx // rounds,
+        "tx_to_rx_us": to_rx // rounds
+    }
+
+
 if __name__ == "__main__":
     # Listen for commands
     # Use this to discover the type and id of your remote and
@@ -697,6 +813,8 @@ if __name__ == "__main__":
     # itho.remote_id = [11, 22, 33]  # Your RFT remote ID (or adjust in config.py)
     # itho.send_command(ITHOCOMMAND.HIGH)  # should be audible (else check/adjust ITHO_HIGH_BYTES in config.py)
 
+    print("turnaround", measure_turnaround(itho))
+
     print("listening to remote commands")
 
     itho_has_packet = False
@@ -705,18 +823,42 @@ if __name__ == "__main__":
         global itho_has_packet
         itho_has_packet = True
 
-    itho.rf.gd02.irq(handler=itho_check, trigger=Pin.IRQ_FALLING)
+    itho.rf.gd02.irq(handler=itho_check, trigger=IRQ_FALLING)
 
-    itho.init_receive()
+    statistics = None
 
+    if WOR_INTERVAL_MS > 0:
+        # Wake-on-Radio: the microcontroller light sleeps until the CC1101 finds a sync word
+        from wor import CaptureStatistics, duty_cycle, expected_capture, lightsleep
+
+        statistics = CaptureStatistics(ITHO.SEND_TRIES)
+        itho.init_wor()
+        print("wake-on-radio, receiver duty cycle", duty_cycle(WOR_RX_TIME),
+              "expected capture (copies, presses)", expected_capture(WOR_INTERVAL_MS, WOR_RX_TIME, ITHO.SEND_TRIES))
+    else:
+        itho.init_receive()
+
+    from traffic import TrafficTable
+
+    itho.traffic = TrafficTable()  # all remotes heard, printed every 10 packets
     counter = 0
 
     while True:
+        if statistics is not None and itho_has_packet is False and itho.rf.gd02.value() == 0:
+            lightsleep(itho.rf.gd02, 1000, statistics)
+
         if itho_has_packet is True:
             itho_packet = itho.get_new_packet()
             if itho_packet is not None and itho_packet.command != ITHOCOMMAND.UNKNOWN:
                 counter += 1
-                print("packet", counter)
+                print("packet", counter, "- duplicates suppressed", itho.duplicates.duplicates)
                 itho_packet.print()
+                if statistics is not None:
+                    statistics.record(itho_packet)
+                    print("capture", statistics.as_dict(itho.duplicates))
+                if counter % 10 == 0:
+                    print("top talkers of", itho.traffic.used, "remotes")
+                    for record in itho.traffic.top(5):
+                        print(" ", record["remote_type"], record["remote_id"], record["frames"], "frames, rssi", record["rssi"])
 
             itho_has_packet = False
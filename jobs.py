@@ -0,0 +1,137 @@
+# Batched radio commands
+#
+# A job is a list of commands, each with an optional delay, which is
+# validated up front and then sent in sequence. Consecutive steps
+# without delay are sent while holding the radio lock once; the lock is
+# released while waiting for a delay, and the airtime for these steps is
+# reserved before the lock is taken, so other commands are not blocked
+# by a job. If a step fails the airtime of the steps not sent is given
+# back. The timing of every step is recorded so clients can
+# retrieve it by job id.
+#
+# Copyright 2022 (c) Erik de Lange
+# Released under MIT license
+
+import time
+
+import uasyncio as asyncio
+from micropython import const
+
+
+class Job:
+
+    def __init__(self, id, steps):
+        self.id = id
+        self.steps = steps  # list of (command, delay in ms before sending)
+        self.state = "queued"  # queued, running, done or failed
+        self.error = None
+        self.timing = list()  # per step (ms since job start when sending began, ms spent sending)
+
+    def as_dict(self):
+        return {
+            "job": self.id,
+            "state": self.state,
+            "error": self.error,
+            "steps": [{"start_ms": start, "send_ms": duration} for start, duration in self.timing]
+        }
+
+
+class Jobs:
+    MAX_STEPS = const(16)
+    MAX_DELAY = const(3600)  # seconds
+    MAX_JOBS = const(8)  # number of finished jobs kept for status requests
+
+    def __init__(self, transmit, lock, commands, reserve=None, release=None):
+        """ Create a runner for batched commands
+
+        :param coroutine transmit: function sending a single command, called while holding lock
+        :param Lock lock: radio lock
+        :param dict commands: command table, key is command name, value is ITHOCOMMAND
+        :param coroutine reserve: function waiting until a list of commands may be sent, called before taking lock
+        :param function release: function giving back what reserve returned for the commands not sent
+        """
+        self.transmit = transmit
+        self.lock = lock
+        self.reserve = reserve
+        self.release = release
+        self.commands = commands
+        self.jobs = dict()  # key is job id
+        self.next_id = 1
+
+    def parse(self, steps):
+        """ Validate a list of steps against the command table
+
+        A step is either a command name or a dict {"command": name, "delay": seconds}
+        where delay is the time to wait before sending the command.
+
+        :param list steps: steps to validate
+        :return list: list of (command, delay in ms)
+        """
+        if not (type(steps) is list and 0 < len(steps) <= Jobs.MAX_STEPS):
+            raise ValueError(f"expected list with 1 to {Jobs.MAX_STEPS} steps")
+
+        parsed = list()
+        for index, step in enumerate(steps):
+            if type(step) is str:
+                step = {"command": step}
+            if type(step) is not dict:
+                raise ValueError(f"step {index}: expected command name or object")
+            name = step.get("command")
+            if name not in self.commands:
+                raise ValueError(f"step {index}: unknown command {name}")
+            delay = step.get("delay", 0)
+            if type(delay) not in (int, float) or not 0 <= delay <= Jobs.MAX_DELAY:
+                raise ValueError(f"step {index}: delay must be 0 to {Jobs.MAX_DELAY} seconds")
+            parsed.append((self.commands[name], int(delay * 1000)))
+
+        return parsed
+
+    def submit(self, steps):
+        """ Start a job running the parsed steps
+
+        :param list steps: steps as returned by parse()
+        :return Job: the job started
+        """
+        job = Job(self.next_id, steps)
+        self.next_id += 1
+
+        self.jobs[job.id] = job
+        if len(self.jobs) > Jobs.MAX_JOBS:
+            del self.jobs[min(self.jobs)]  # forget the oldest job
+
+        asyncio.create_task(self._run(job))
+        return job
+
+    def get(self, id):
+        return self.jobs.get(id)
+
+    async def _run(self, job):
+        job.state = "running"
+        start = time.ticks_ms()
+        steps = job.steps
+        i = 0
+        try:
+            while i < len(steps):
+                if steps[i][1] > 0:
+                    await asyncio.sleep_ms(steps[i][1])  # without holding the lock
+                end = i + 1  # this step and the following ones without delay
+                while end < len(steps) and steps[end][1] == 0:
+                    end += 1
+                reservation = None
+                if self.reserve is not None:
+                    reservation = await self.reserve([step[0] for step in steps[i:end]])
+                first = i
+                try:
+                    async with self.lock:
+                        while i < end:
+                            begin = time.ticks_ms()
+                            await self.transmit(steps[i][0])
+                            job.timing.append((time.ticks_diff(begin, start), time.ticks_diff(time.ticks_ms(), begin)))
+                            i += 1
+                finally:
+                    if i < end and reservation is not None and self.release is not None:
+                        self.release(reservation, i - first)
+            job.state = "done"
+        except Exception as e:
+            job.state = "failed"
+            job.error = f"{e.__class__.__name__} {e}"
@@ -0,0 +1,159 @@
+# Event loop lag monitor
+#
+# A task which sleeps for PERIOD ms and measures how much later than
+# requested it wakes up. This lag is the time other code ran without
+# yielding to the event loop (blocking sleeps, busy-waiting on the radio,
+# writing to flash, garbage collection). Lags are counted in a histogram
+# with fixed bucket bounds. Code which may block calls mark() with a
+# label before it starts; a lag above SPIKE_MS is recorded with the last
+# label marked since the previous wakeup, the WORST largest are kept.
+#
+# If a watchdog timeout is given the monitor starts machine.WDT and feeds
+# it at every wakeup, unless more than MAX_UNHEALTHY percent of the last
+# WINDOW wakeups came after a stall. When the loop hangs (e.g. waiting
+# forever for the CC1101 in spi_wait_miso), or keeps stalling most of
+# the time, the microcontroller resets. An occasional long stall does
+# not withhold feeding, nor does a run of a few stalls in a row. Code which blocks for a long time but is known to make
+# progress (e.g. ota.py swapping files) calls feed() in between. A
+# watchdog cannot be stopped, also not by stopping the controller from
+# the REPL.
+#
+# Copyright 2022 (c) Erik de Lange
+# Released under MIT license
+
+import time
+from array import array
+
+import uasyncio as asyncio
+from micropython import const
+
+
+class LagMonitor:
+    PERIOD = const(100)  # ms between wakeups
+    SPIKE_MS = const(100)  # a lag of at least this many ms is recorded as stall
+    WORST = const(8)  # number of stalls kept
+    WINDOW = const(50)  # wakeups in the sliding window judging the health of the loop
+    MAX_UNHEALTHY = const(50)  # percent of wakeups in the window after a stall, above which the watchdog is not fed
+    BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)  # upper bucket bounds in ms, last bucket has none
+
+    def __init__(self, wdt_timeout=0):
+        """ Create a lag monitor
+
+        :param int wdt_timeout: watchdog timeout in ms, 0 for no watchdog
+        """
+        self.wdt_timeout = wdt_timeout
+        self.wdt = None
+        self.histogram = array("L", [0] * (len(LagMonitor.BOUNDS) + 1))
+        self.samples = 0
+        self.max_lag = 0
+        self.label = None  # last activity marked since the previous wakeup
+        self.stall_lag = array("L", [0] * LagMonitor.WORST)  # ms, the WORST largest lags
+        self.stall_label = [None] * LagMonitor.WORST
+        self.stall_time = array("L", [0] * LagMonitor.WORST)  # time.time()
+        self.stalls = 0  # lags of at least SPIKE_MS
+        self.unhealthy = 0  # wakeups after which the watchdog was not fed
+        self.window = bytearray(LagMonitor.WINDOW)  # 1 for a wakeup after a stall, ring buffer
+        self.window_index = 0
+        self.window_stalls = 0  # sum of window
+
+    def mark(self, label):
+        """ Record that an activity which may block the event loop starts """
+        self.label = label
+
+    def record(self, lag):
+        """ Account a lag in ms """
+        i = 0
+        for bound in LagMonitor.BOUNDS:
+            if lag < bound:
+                break
+            i += 1
+        self.histogram[i] += 1
+        self.samples += 1
+        if lag > self.max_lag:
+            self.max_lag = lag
+
+        if lag >= LagMonitor.SPIKE_MS:
+            self.stalls += 1
+            smallest = 0
+            for j in range(1, LagMonitor.WORST):
+                if self.stall_lag[j] < self.stall_lag[smallest]:
+                    smallest = j
+            if lag > self.stall_lag[smallest]:
+                self.stall_lag[smallest] = lag
+                self.stall_label[smallest] = self.label
+                self.stall_time[smallest] = time.time()
+        self.label = None
+
+    async def task(self):
+        """ Measure the lag continuously, and feed the watchdog """
+        if self.wdt_timeout > 0:
+            from machine import WDT
+            self.wdt = WDT(timeout=self.wdt_timeout)
+
+        while True:
+            start = time.ticks_ms()
+            await asyncio.sleep_ms(LagMonitor.PERIOD)
+            lag = max(0, time.ticks_diff(time.ticks_ms(), start) - LagMonitor.PERIOD)
+            self.record(lag)
+            if self.wdt is not None:
+                if self.healthy(lag) is True:
+                    self.wdt.feed()
+                else:
+                    self.unhealthy += 1
+
+    def healthy(self, lag):
+        """ Account a wakeup in the sliding window and tell if the watchdog may be fed
+
+        :param int lag: lag of the wakeup in ms
+        :return bool: True if at most MAX_UNHEALTHY percent of the last WINDOW wakeups came after a stall
+        """
+        stall = 1 if lag >= LagMonitor.SPIKE_MS else 0
+        self.window_stalls += stall - self.window[self.window_index]
+        self.window[self.window_index] = stall
+        self.window_index = (self.window_index + 1) % LagMonitor.WINDOW
+        return self.window_stalls * 100 <= LagMonitor.MAX_UNHEALTHY * LagMonitor.WINDOW
+
+    def feed(self):
+        """ Feed the watchdog (if started) from code which blocks the event loop but makes progress """
+        if self.wdt is not None:
+            self.wdt.feed()
+
+    def worst(self):
+        """ Return the recorded stalls, largest lag first """
+        order = sorted((j for j in range(LagMonitor.WORST) if self.stall_lag[j] > 0),
+                       key=lambda j: self.stall_lag[j], reverse=True)
+        return [{"lag_ms": self.stall_lag[j], "activity": self.stall_label[j], "time": self.stall_time[j]}
+                for j in order]
+
+    def as_dict(self):
+        labels = [f"<{bound}" for bound in LagMonitor.BOUNDS] + [f">={LagMonitor.BOUNDS[-1]}"]
+        return {
+            "period_ms": LagMonitor.PERIOD,
+            "samples": self.samples,
+            "max_ms": self.max_lag,
+            "histogram_ms": {label: count for label, count in zip(labels, self.histogram)},
+            "stalls": self.stalls,
+            "worst": self.worst(),
+            "wdt_timeout_ms": self.wdt_timeout if self.wdt is not None else None,
+            "wdt_not_fed": self.unhealthy,
+            "window_stall_percent": self.window_stalls * 100 // LagMonitor.WINDOW
+        }
+
+
+if __name__ == "__main__":
+    # Show the lag caused by a task which blocks the event loop now and then
+
+    async def blocker(monitor):
+        for duration in (5, 30, 150, 400, 80, 250):
+            await asyncio.sleep_ms(300)
+            monitor.mark(f"sleep_ms({duration})")
+            time.sleep_ms(duration)
+
+    async def main():
+        monitor = LagMonitor()
+        asyncio.create_task(monitor.task())
+        await blocker(monitor)
+        await asyncio.sleep_ms(200)
+        print(monitor.as_dict())
+
+    asyncio.run(main())
@@ -0,0 +1,79 @@
+# Storage for named macros
+#
+# A macro is a named list of steps for a batched command job (see
+# jobs.py), optionally with a time at which the scheduler runs it.
+# The Macros class contains a dict with the macros and functions to
+# load this dict from a json file and store its content to a json file.
+#
+# Copyright 2022 (c) Erik de Lange
+# Released under MIT license
+
+import json
+
+import ringlog
+
+logger = ringlog.getLogger(__name__)
+
+
+class Macros:
+    MACROS_FILE = "macros.json"
+
+    def __init__(self, parse=None):
+        """ Load the macros
+
+        :param function parse: validates the steps of a macro, raises ValueError if invalid (e.g. Jobs.parse)
+        """
+        # key is macro name, value is {"steps": [...], "at": [hh, mm] or None}
+        self.macro = dict()
+        self.parse = parse
+
+        self.load()
+
+    @staticmethod
+    def run_time(text):
+        """ Convert "hh:mm" to [hh, mm], raise ValueError if it is not a valid time of day """
+        if type(text) is not str or len(text) != 5 or text[2] != ":":
+            raise ValueError(f"expected run-time hh:mm, found {text}")
+        at = [int(text[:2]), int(text[3:])]
+        if not Macros.valid(at):
+            raise ValueError(f"invalid run-time {text}")
+        return at
+
+    @staticmethod
+    def valid(at):
+        """ Check if at is a run-time [hh, mm] """
+        return type(at) is list and len(at) == 2 and type(at[0]) is int and type(at[1]) is int \
+            and 0 <= at[0] <= 23 and 0 <= at[1] <= 59
+
+    def load(self, filename=MACROS_FILE):
+        try:
+            with open(filename) as fp:
+                temp = json.loads(fp.read())
+
+            # json format check: reject file if a macro has no steps or an invalid run-time
+            if type(temp) is not dict:
+                raise TypeError(f"expected dict, found {type(temp).__name__}")
+            for name, macro in temp.items():
+                if not (type(macro) is dict and type(macro.get("steps")) is list):
+                    raise TypeError(f"expected steps list for macro '{name}'")
+                at = macro.get("at")
+                if not (at is None or Macros.valid(at)):
+                    raise TypeError(f"expected [hh, mm] or null for 'at' of macro '{name}'")
+                if self.parse is not None:
+                    try:
+                        self.parse(macro["steps"])
+                    except ValueError as e:
+                        raise ValueError(f"macro '{name}': {e}")
+
+            self.macro = temp
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning("%s loading file %s - %s", e.__class__.__name__, filename, e)
+        except OSError as e:
+            logger.warning("%s - loading file %s", e, filename)
+
+    def save(self, filename=MACROS_FILE):
+        try:
+            with open(filename, "w") as fp:
+                json.dump(self.macro, fp)
+        except OSError as e:
+            logger.critical("%s: %s", e, filename)
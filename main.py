@@ -1,5 +1,27 @@
 # main.py -- Put your code here
 
+import timeline  # first import, records the start of the boot timeline
+
+import sys
+
+import ota
+
+ota.Updater().boot()  # complete an interrupted update, or roll back one which failed to start
+
+# Modules precompiled with mpy-cross (cc1101.mpy, itho.mpy, controller.mpy,
+# ntp.mpy, tasks.mpy, ...) in directory /mpy are loaded instead of the .py
+# sources in the root directory, which saves compiling them at every boot.
+# An over the air update moves the .mpy of every module it replaces out of
+# the way (see ota.py); when copying a new .py by hand remove its .mpy too.
+sys.path.insert(0, "/mpy")
+
 import uftpd  # uncomment for autostart of FTP server
 
-import controller  # uncomment for autostart of CVE controller
+try:
+    import controller  # uncomment for autostart of CVE controller
+    controller.run()
+except Exception:
+    if ota.Updater().failed() is True:  # the updated code failed to start, the previous version is restored
+        import machine
+        machine.reset()
+    raise
@@ -0,0 +1,156 @@
+# Memory management
+#
+# Garbage collection is done when the controller is idle, so it does
+# not interrupt a radio transmission or an HTTP response, or right
+# away when the free heap drops below a watermark. Memory allocated by
+# HTTP handlers and tasks is accounted per name to help finding the
+# sources of heap fragmentation. The fragmentation itself is shown as
+# the largest free block of the heap compared to the total free memory.
+# MicroPython only prints this ("max free sz" of micropython.mem_info()),
+# so the output is captured via os.dupterm().
+#
+# Copyright 2022 (c) Erik de Lange
+# Released under MIT license
+
+import gc
+import io
+import os
+import time
+
+import micropython
+import uasyncio as asyncio
+from micropython import const
+
+try:
+    import esp32  # only for the largest free block in the ESP-IDF heap
+except ImportError:
+    esp32 = None
+
+
+class _Capture(io.IOBase):
+    """ Stream for os.dupterm() collecting what is printed """
+
+    def __init__(self):
+        self.data = bytearray()
+
+    def write(self, buf):
+        self.data += buf
+        return len(buf)
+
+    def readinto(self, buf):
+        return None  # no input
+
+
+def largest_free_block():
+    """ Return the size of the largest free block of the heap in bytes, None if unknown """
+    if not hasattr(os, "dupterm"):
+        return None
+    capture = _Capture()
+    previous = os.dupterm(capture)
+    try:
+        micropython.mem_info()
+    finally:
+        os.dupterm(previous)
+    start = capture.data.find(b"max free sz: ")
+    if start < 0:
+        return None
+    start += 13
+    end = start
+    while end < len(capture.data) and 0x30 <= capture.data[end] <= 0x39:
+        end += 1
+    return int(capture.data[start:end]) * MemoryManager.BLOCK if end > start else None
+
+
+class MemoryManager:
+    CHECK_INTERVAL = const(1000)  # ms
+    BLOCK = const(16)  # bytes per block of the heap (4 words on a 32 bit microcontroller)
+
+    def __init__(self, idle=None, watermark=16384, interval=60):
+        """ Create an idle aware garbage collector
+
+        :param function idle: returns True if other parts (e.g. the radio) are idle
+        :param int watermark: collect immediately when fewer bytes are free
+        :param int interval: seconds between collections when idle
+        """
+        self.idle = idle
+        self.watermark = watermark
+        self.interval = interval * 1000
+        self.active = 0  # number of tracked handlers running
+        self.usage = dict()  # key is name, value is [calls, total bytes allocated, max bytes allocated]
+        self.collections = 0
+        self.forced = 0  # collections because free memory dropped below the watermark
+        self.collect_ms = 0  # duration of the last collection
+        self.last_collect = time.ticks_ms()
+
+    def record(self, name, allocated):
+        """ Account memory allocated by name
+
+        A negative value means a collection ran in between, it is
+        counted as a call without allocation.
+        """
+        allocated = max(allocated, 0)
+        usage = self.usage.get(name)
+        if usage is None:
+            self.usage[name] = [1, allocated, allocated]
+        else:
+            usage[0] += 1
+            usage[1] += allocated
+            usage[2] = max(usage[2], allocated)
+
+    def track(self, name):
+        """ Decorator for HTTP handlers: account memory and block idle collection while running
+
+        Other tasks run while a handler awaits, their allocations are
+        included. Do not use for handlers which never end (like event
+        streams) as the controller would never be idle.
+        """
+        def decorator(func):
+            async def wrapper(*args, **kwargs):
+                self.active += 1
+                before = gc.mem_alloc()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self.active -= 1
+                    self.record(name, gc.mem_alloc() - before)
+            return wrapper
+        return decorator
+
+    def collect(self):
+        start = time.ticks_ms()
+        gc.collect()
+        self.collect_ms = time.ticks_diff(time.ticks_ms(), start)
+        self.last_collect = time.ticks_ms()
+        self.collections += 1
+
+    async def task(self):
+        """ Collect garbage when idle or short of memory """
+        while True:
+            await asyncio.sleep_ms(MemoryManager.CHECK_INTERVAL)
+            if gc.mem_free() < self.watermark:
+                self.forced += 1
+                self.collect()
+            elif time.ticks_diff(time.ticks_ms(), self.last_collect) >= self.interval:
+                if self.active == 0 and (self.idle is None or self.idle() is True):
+                    self.collect()
+
+    def as_dict(self):
+        largest_free = None
+        if esp32 is not None:
+            largest_free = max(region[2] for region in esp32.idf_heap_info(esp32.HEAP_DATA))
+        free = gc.mem_free()
+        largest_gc_free = largest_free_block()
+
+        return {
+            "free": free,
+            "allocated": gc.mem_alloc(),
+            "largest_free_block": largest_gc_free,
+            "fragmentation_percent": None if largest_gc_free is None or free == 0 else
+            round(100 - 100 * min(largest_gc_free, free) / free, 1),
+            "idf_largest_free_block": largest_free,
+            "collections": self.collections,
+            "forced": self.forced,
+            "last_collect_ms": self.collect_ms,
+            "usage": {name: {"calls": calls, "total": total, "max": peak}
+                      for name, (calls, total, peak) in self.usage.items()}
+        }
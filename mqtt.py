@@ -0,0 +1,427 @@
+# MQTT client
+#
+# Minimal MQTT 3.1.1 client for uasyncio, using QoS 0 only. It keeps a
+# single connection to the broker open and reconnects with exponential
+# backoff when the connection is lost, without blocking the event loop.
+# Messages to publish are put in a queue with a fixed number of slots.
+# A message for a topic which is already queued replaces the queued
+# one, so only the latest state is sent. When the queue is full the
+# oldest message is dropped. Received messages are passed to a
+# callback. A will message marks the client offline when the
+# connection is lost.
+#
+# Copyright 2022 (c) Erik de Lange
+# Released under MIT license
+
+try:
+    import uasyncio as asyncio
+except ImportError:  # CPython
+    import asyncio
+
+import ringlog
+from hal import const, time
+
+logger = ringlog.getLogger(__name__)
+
+
+class MQTTClient:
+    # Control packet types (with the fixed header flags used)
+    CONNECT = const(0x10)
+    CONNACK = const(0x20)
+    PUBLISH = const(0x30)
+    PUBACK = const(0x40)
+    SUBSCRIBE = const(0x82)
+    SUBACK = const(0x90)
+    PINGREQ = const(0xC0)
+    PINGRESP = const(0xD0)
+    DISCONNECT = const(0xE0)
+
+    KEEPALIVE = const(60)  # seconds
+    TIMEOUT = const(10)  # seconds to connect or to write a packet
+    BACKOFF_MIN = const(1)  # seconds before the first reconnect
+    BACKOFF_MAX = const(300)  # maximum seconds between reconnects
+    QUEUE_SIZE = const(16)  # messages waiting to be published
+    MAX_PACKET = const(1024)  # received packets which are larger are skipped
+
+    def __init__(self, client_id, host, port=1883, user=None, password=None, will_topic=None,
+                 keepalive=KEEPALIVE, queue_size=QUEUE_SIZE, callback=None, on_connect=None):
+        """ Create an MQTT client, the connection is made by run()
+
+        :param str client_id: unique id of this client
+        :param str host: broker host name or IP address
+        :param int port: broker port
+        :param str user: user name, None if the broker needs no login
+        :param str password: password, None if not used
+        :param str will_topic: receives retained "online" after connecting and "offline" when the connection is lost
+        :param int keepalive: seconds, the connection is checked with a ping after half this time
+        :param int queue_size: number of messages waiting to be published
+        :param function callback: called with (topic, payload) for every received message
+        :param function on_connect: called after every (re)connect
+        """
+        self.client_id = client_id
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.will_topic = will_topic
+        self.keepalive = keepalive
+        self.callback = callback
+        self.on_connect = on_connect
+        self.topics = list()  # subscribed after every connect (clean session)
+        self.packet_id = 0
+
+        # Outbound queue: fixed slots used as ring buffer
+        self.size = queue_size
+        self.topic = [None] * queue_size
+        self.payload = [None] * queue_size
+        self.retain = bytearray(queue_size)
+        self.head = 0
+        self.count = 0
+        self.event = asyncio.Event()  # set when a message is queued or the connection is lost
+
+        self.connected = False
+        self.received = 0  # time.ticks_ms() of the last packet from the broker
+        self.connects = 0
+        self.failures = 0
+        self.sent = 0
+        self.messages = 0
+        self.dropped = 0
+
+    def subscribe(self, topic):
+        """ Subscribe to topic (QoS 0) from the next connect on """
+        self.topics.append(topic)
+
+    def publish(self, topic, payload, retain=False):
+        """ Queue a message for publishing
+
+        :param str topic: topic
+        :param payload: str or bytes
+        :param bool retain: broker keeps the message for new subscribers
+        :return bool: False if the oldest queued message was dropped to make room
+        """
+        result = True
+        for i in range(self.count):
+            slot = (self.head + i) % self.size
+            if self.topic[slot] == topic:  # replace, the latest state is what counts
+                self.payload[slot] = payload
+                self.retain[slot] = retain
+                self.event.set()
+                return result
+        if self.count == self.size:
+            self.head = (self.head + 1) % self.size
+            self.count -= 1
+            self.dropped += 1
+            result = False
+        slot = (self.head + self.count) % self.size
+        self.topic[slot] = topic
+        self.payload[slot] = payload
+        self.retain[slot] = retain
+        self.count += 1
+        self.event.set()
+        return result
+
+    def _pop(self):
+        """ Remove and return the oldest queued message as a PUBLISH packet """
+        slot = self.head
+        packet = MQTTClient._publish_packet(self.topic[slot], self.payload[slot], self.retain[slot])
+        self.topic[slot] = self.payload[slot] = None
+        self.head = (self.head + 1) % self.size
+        self.count -= 1
+        return packet
+
+    @staticmethod
+    def _string(s):
+        """ Encode a string (or bytes) with its 2 byte length """
+        b = s.encode() if isinstance(s, str) else s
+        return bytes((len(b) >> 8, len(b) & 0xFF)) + b
+
+    @staticmethod
+    def _packet(kind, body=b""):
+        """ Add the fixed header with the variable length encoded remaining length """
+        header = bytearray((kind,))
+        length = len(body)
+        while True:
+            byte = length & 0x7F
+            length >>= 7
+            header.append(byte | 0x80 if length > 0 else byte)
+            if length == 0:
+                break
+        return bytes(header) + body
+
+    @staticmethod
+    def _publish_packet(topic, payload, retain):
+        body = MQTTClient._string(topic) + (payload.encode() if isinstance(payload, str) else payload)
+        return MQTTClient._packet(MQTTClient.PUBLISH | (1 if retain else 0), body)
+
+    @staticmethod
+    async def _read_packet(reader):
+        """ Read a control packet
+
+        :return tuple: (first byte of fixed header, body), body is None if the packet was skipped as too large
+        :raises EOFError: connection closed by broker
+        """
+        kind = (await reader.readexactly(1))[0]
+        length = 0
+        shift = 0
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length |= (byte & 0x7F) << shift
+            if byte & 0x80 == 0:
+                break
+            shift += 7
+            if shift > 21:
+                raise ValueError("malformed remaining length")
+        if length > MQTTClient.MAX_PACKET:
+            while length > 0:
+                length -= len(await reader.readexactly(min(length, 128)))
+            return kind, None
+        return kind, await reader.readexactly(length) if length > 0 else b""
+
+    async def _connect(self):
+        """ Open the connection, log in and subscribe
+
+        :return tuple: (StreamReader, StreamWriter)
+        """
+        # Note: the host name is resolved by a blocking call
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), MQTTClient.TIMEOUT)
+        try:
+            flags = 0x02  # clean session
+            payload = MQTTClient._string(self.client_id)
+            if self.will_topic is not None:
+                flags |= 0x24  # will flag and will retain, QoS 0
+                payload += MQTTClient._string(self.will_topic) + MQTTClient._string("offline")
+            if self.user is not None:
+                flags |= 0x80
+                payload += MQTTClient._string(self.user)
+                if self.password is not None:
+                    flags |= 0x40
+                    payload += MQTTClient._string(self.password)
+            body = MQTTClient._string("MQTT") + bytes((4, flags, self.keepalive >> 8, self.keepalive & 0xFF)) + payload
+            writer.write(MQTTClient._packet(MQTTClient.CONNECT, body))
+            await asyncio.wait_for(writer.drain(), MQTTClient.TIMEOUT)
+
+            kind, body = await asyncio.wait_for(MQTTClient._read_packet(reader), MQTTClient.TIMEOUT)
+            if kind != MQTTClient.CONNACK or body is None or len(body) != 2:
+                raise ValueError("expected CONNACK")
+            if body[1] != 0:
+                raise OSError(f"connection refused, return code {body[1]}")
+
+            if len(self.topics) > 0:
+                self.packet_id = self.packet_id % 0xFFFF + 1
+                body = bytes((self.packet_id >> 8, self.packet_id & 0xFF))
+                for topic in self.topics:
+                    body += MQTTClient._string(topic) + b"\x00"
+                writer.write(MQTTClient._packet(MQTTClient.SUBSCRIBE, body))
+            if self.will_topic is not None:
+                writer.write(MQTTClient._publish_packet(self.will_topic, "online", True))
+            await asyncio.wait_for(writer.drain(), MQTTClient.TIMEOUT)
+        except Exception:
+            writer.close()
+            raise
+        return reader, writer
+
+    async def _receive(self, reader, writer):
+        """ Handle packets from the broker until the connection is lost """
+        try:
+            while True:
+                kind, body = await MQTTClient._read_packet(reader)
+                self.received = time.ticks_ms()
+                if kind & 0xF0 == MQTTClient.PUBLISH and body is not None:
+                    length = (body[0] << 8) | body[1]
+                    topic = bytes(body[2:2 + length]).decode()
+                    start = 2 + length
+                    if kind & 0x06:  # QoS 1 or 2 although subscribed with QoS 0
+                        if kind & 0x06 == 0x02:
+                            writer.write(MQTTClient._packet(MQTTClient.PUBACK, bytes(body[start:start + 2])))
+                        start += 2
+                    self.messages += 1
+                    if self.callback is not None:
+                        self.callback(topic, bytes(body[start:]))
+                elif kind == MQTTClient.SUBACK and body is not None and 0x80 in body[2:]:
+                    logger.warning("subscription refused by broker")
+        except Exception:
+            pass  # connection lost or malformed packet
+        finally:
+            self.connected = False
+            self.event.set()
+
+    async def _session(self, reader, writer):
+        """ Send queued messages and pings until the connection is lost """
+        receiver = asyncio.create_task(self._receive(reader, writer))
+        pinged = time.ticks_ms()
+        try:
+            while self.connected is True:
+                try:
+                    await asyncio.wait_for(self.event.wait(), self.keepalive // 2)
+                except asyncio.TimeoutError:
+                    pass
+                self.event.clear()
+                if self.connected is False:
+                    break
+                now = time.ticks_ms()
+                if time.ticks_diff(now, self.received) > self.keepalive * 1500:
+                    raise OSError("no response from broker")
+                if time.ticks_diff(now, pinged) >= self.keepalive * 500:
+                    writer.write(MQTTClient._packet(MQTTClient.PINGREQ))
+                    pinged = now
+                while self.count > 0:
+                    writer.write(self._pop())
+                    self.sent += 1
+                    await asyncio.wait_for(writer.drain(), MQTTClient.TIMEOUT)
+                await asyncio.wait_for(writer.drain(), MQTTClient.TIMEOUT)
+        finally:
+            receiver.cancel()
+
+    async def run(self):
+        """ Keep connected to the broker, run as task """
+        backoff = MQTTClient.BACKOFF_MIN
+
+        while True:
+            try:
+                reader, writer = await self._connect()
+            except Exception as e:
+                self.failures += 1
+                logger.warning("connect to %s failed: %s, retry in %d s", self.host, repr(e), backoff)
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, MQTTClient.BACKOFF_MAX)
+                continue
+
+            backoff = MQTTClient.BACKOFF_MIN
+            self.connected = True
+            self.connects += 1
+            self.received = time.ticks_ms()
+            if self.on_connect is not None:
+                self.on_connect()
+            try:
+                await self._session(reader, writer)
+            except Exception as e:
+                logger.warning("connection lost: %s", repr(e))
+            finally:
+                self.connected = False
+                writer.close()
+            await asyncio.sleep(MQTTClient.BACKOFF_MIN)
+
+    def as_dict(self):
+        return {
+            "connected": self.connected,
+            "connects": self.connects,
+            "failures": self.failures,
+            "sent": self.sent,
+            "received": self.messages,
+            "queued": self.count,
+            "dropped": self.dropped
+        }
+
+
+if __name__ == "__main__":
+    # Run two clients against a broker stand-in on localhost. The controller subscribes and
+    # queues more messages than fit while it is not connected, a second client publishes a
+    # command which the broker routes to the controller. Then the broker is down for a few
+    # seconds; the controller reconnects with backoff, publishes its latest state and is
+    # subscribed again.
+
+    PORT = 18830
+
+    class Broker:
+        """ Routes messages to the subscribed clients, keeps retained messages """
+
+        def __init__(self):
+            self.retained = dict()
+            self.clients = dict()  # key is StreamWriter, value is list of subscribed topics
+            self.server = None
+
+        async def start(self):
+            self.server = await asyncio.start_server(self.handle, "127.0.0.1", PORT)
+
+        async def stop(self):
+            self.server.close()
+            await self.server.wait_closed()
+            for writer in tuple(self.clients):
+                writer.close()
+            self.clients = dict()
+
+        async def handle(self, reader, writer):
+            self.clients[writer] = list()
+            try:
+                while True:
+                    kind, body = await MQTTClient._read_packet(reader)
+                    if kind == MQTTClient.CONNECT:
+                        writer.write(MQTTClient._packet(MQTTClient.CONNACK, b"\x00\x00"))
+                    elif kind == MQTTClient.SUBSCRIBE:
+                        i = 2
+                        while i < len(body):
+                            length = (body[i] << 8) | body[i + 1]
+                            self.clients[writer].append(bytes(body[i + 2:i + 2 + length]).decode())
+                            i += 3 + length
+                        writer.write(MQTTClient._packet(MQTTClient.SUBACK, bytes(body[:2]) + b"\x00"))
+                    elif kind & 0xF0 == MQTTClient.PUBLISH:
+                        length = (body[0] << 8) | body[1]
+                        topic = bytes(body[2:2 + length]).decode()
+                        payload = bytes(body[2 + length:])
+                        if kind & 0x01:
+                            self.retained[topic] = payload.decode()
+                        for client, topics in self.clients.items():
+                            if topic in topics:
+                                client.write(MQTTClient._publish_packet(topic, payload, False))
+                    elif kind == MQTTClient.PINGREQ:
+                        writer.write(MQTTClient._packet(MQTTClient.PINGRESP))
+                    await writer.drain()
+            except Exception:
+                pass
+            self.clients.pop(writer, None)
+            writer.close()
+
+    async def wait_for(condition, seconds):
+        """ Wait until condition() is True, at most seconds """
+        for _ in range(seconds * 10):
+            if condition():
+                return True
+            await asyncio.sleep(0.1)
+        return condition()
+
+    async def demo():
+        broker = Broker()
+        await broker.start()
+        received = list()
+
+        controller = MQTTClient("controller", "127.0.0.1", PORT, will_topic="itho/status", queue_size=8,
+                                callback=lambda topic, payload: received.append((topic, payload)))
+        controller.subscribe("itho/command")
+        for i in range(12):  # before connecting: 4 are dropped
+            controller.publish(f"itho/metric{i}", str(i), retain=True)
+        controller.publish("itho/metric11", "latest", retain=True)  # replaces the queued one
+        remote = MQTTClient("remote", "127.0.0.1", PORT)
+
+        tasks = [asyncio.create_task(controller.run()), asyncio.create_task(remote.run())]
+        await wait_for(lambda: controller.connected and remote.connected and len(broker.clients) == 2, 5)
+        await asyncio.sleep(0.2)  # subscription processed
+        remote.publish("itho/command", "high")
+        await wait_for(lambda: len(received) > 0, 5)
+        print("command delivered:", received == [("itho/command", b"high")])
+        print("latest state retained, oldest dropped:",
+              broker.retained.get("itho/metric11") == "latest" and "itho/metric3" not in broker.retained
+              and broker.retained.get("itho/metric4") == "4" and controller.dropped == 4)
+        print("online:", broker.retained.get("itho/status") == "online")
+
+        await broker.stop()  # broker down, the first reconnect attempts fail
+        await wait_for(lambda: controller.failures > 0, 5)
+        controller.publish("itho/fanstate", '{"speed": "high"}', retain=True)
+        await asyncio.sleep(2)
+        await broker.start()
+        reconnected = await wait_for(lambda: controller.connects == 2 and remote.connects == 2
+                                     and len(broker.clients) == 2, 10)
+        print("reconnected after", controller.failures, "failed attempts:", reconnected and controller.failures > 0)
+        await wait_for(lambda: "itho/fanstate" in broker.retained, 5)
+        print("state published after reconnect:", broker.retained.get("itho/fanstate") == '{"speed": "high"}')
+        await asyncio.sleep(0.2)
+        remote.publish("itho/command", "low")
+        await wait_for(lambda: len(received) > 1, 5)
+        print("subscribed again after reconnect:", received[1:] == [("itho/command", b"low")])
+        print(controller.as_dict())
+
+        for task in tasks:
+            task.cancel()
+        await broker.stop()
+        await asyncio.sleep(0.1)
+
+    asyncio.run(demo())
@@ -1,55 +1,46 @@
-import time
-
-import machine
-import ntptime
 import uasyncio as asyncio
 
+import ringlog
+import sntp
+from config import NTP_SERVERS
+
+logger = ringlog.getLogger(__name__)
+
+last_sample = None  # sntp.Sample used for the last successful synchronization
+
 
-async def sync(tries=5, winter_offset=+1, summer_offset=+2):
-    """ Synchronize RTC with NTP and adjust to timezone
+async def sync(tries=5, correct=True):
+    """ Synchronize RTC with NTP, the RTC is kept in UTC (see tz.py for local time)
 
-    From https://forum.micropython.org/viewtopic.php?f=2&t=4034
+    All servers in config.NTP_SERVERS are queried at the same time
+    without blocking the event loop. The answer with the lowest round
+    trip delay is used.
 
-    :param int tries: number of retries if NTP server cannot be reached
-    :param int winter_offset: offset from UTC for local winter time (default is for CET)
-    :param int summer_offset: offset from UTC for local summer time (default is for CET)
-    :return bool: True if sync successful else False
+    :param int tries: number of retries if no NTP server can be reached
+    :param bool correct: if False only measure the offset, leave correcting the RTC to the caller
+    :return sntp.Sample: sample used, None if sync failed
     """
-    print("Synchronize time with", ntptime.host, end="")
+    global last_sample
 
     while tries > 0:
-        try:
-            ntptime.settime()  # UTC
-            print()
+        sample = sntp.best(await sntp.query(NTP_SERVERS))
+        if sample is not None:
             break
-        except OSError:
-            print(".", end="")
-            tries -= 1
-            await asyncio.sleep(0.5)
+        tries -= 1
+        await asyncio.sleep(0.5)
     else:
-        print("\nNTP time synchronization failed")
-        return False
+        logger.warning("time synchronization with %s failed", NTP_SERVERS)
+        return None
 
-    t = time.time()
-
-    tm = list(time.localtime(t))
-    tm = tm[0:3] + [0, ] + tm[3:6] + [0, ]
-    year = tm[0]
-
-    # datetime of change to summer time for the current year
-    t1 = time.mktime((year, 3, (31 - (int(5 * year / 4 + 4)) % 7), 1, 0, 0, 0, 0))
-    # datetime of change to winter time for the current year
-    t2 = time.mktime((year, 10, (31 - (int(5 * year / 4 + 1)) % 7), 2, 0, 0, 0, 0))
-
-    if t >= t1 and t < t2:
-        tm[4] += summer_offset  # local time offset from UTC in summer
-    else:
-        tm[4] += winter_offset  # local time offset from UTC in winter
+    if correct is True:
+        sntp.step(sample.offset)
 
-    machine.RTC().datetime(tm)
+    last_sample = sample
+    logger.info("offset %d ms, delay %d ms from %s", sample.offset // 1000000, sample.delay // 1000000, sample.server)
 
-    return True
+    return sample
 
 
 if __name__ == "__main__":
+    ringlog.log.echo = True
     asyncio.run(sync())
@@ -0,0 +1,318 @@
+# Over the air update
+#
+# A bundle of files (modules, index.html, ...) is uploaded via HTTP and
+# written in CHUNK size pieces to the staging directory while it is
+# received, so it never has to fit in RAM. The SHA-256 digest of the
+# bundle must match the one sent with it, otherwise the staged files
+# are discarded. Then the files are swapped: the current version of
+# every file is moved to the backup directory and the new one takes its
+# place. A journal records the progress, so a swap interrupted by a
+# reset is completed at the next boot. A module precompiled with
+# mpy-cross (/mpy/<name>.mpy, see main.py) would shadow its updated
+# source, so it is moved to the backup directory as well, unless the
+# bundle contains a new one.
+#
+# The first boot after a swap is a trial. When the new code reaches the
+# "http" milestone of the boot timeline the update is confirmed. If it
+# raises an exception while starting (in main.py, or in one of the tasks
+# of the controller), or the microcontroller resets before that, the
+# backup is restored. A version which hangs before the http milestone is
+# only caught when the watchdog is enabled (WDT_TIMEOUT_MS in config.py),
+# otherwise it keeps hanging until it is reset by hand. The backup is
+# kept until the next update.
+#
+# Bundle format, repeated for every file:
+#   1 byte length of the name, name (utf-8, relative path), 4 bytes size (big endian), data
+#
+# Create and upload a bundle from a PC: python ota.py 192.168.1.10 itho.py controller.py
+#
+# Copyright 2022 (c) Erik de Lange
+# Released under MIT license
+
+import hashlib
+import json
+import os
+import struct
+from binascii import hexlify
+
+from hal import const, time
+
+
+def _exists(path):
+    try:
+        os.stat(path)
+        return True
+    except OSError:
+        return False
+
+
+def _remove_tree(path):
+    """ Remove a file or a directory with everything in it, if it exists """
+    try:
+        mode = os.stat(path)[0]
+    except OSError:
+        return
+    if mode & 0x4000:  # directory
+        for name in os.listdir(path):
+            _remove_tree(f"{path}/{name}")
+        os.rmdir(path)
+    else:
+        os.remove(path)
+
+
+def _make_dirs(path):
+    """ Create the directories leading to file path """
+    parts = path.split("/")[:-1]
+    for i in range(len(parts)):
+        directory = "/".join(parts[:i + 1])
+        if directory and not _exists(directory):
+            os.mkdir(directory)
+
+
+class Updater:
+    CHUNK = const(1024)  # bytes read and written at a time
+    MAX_NAME = const(64)
+    TRIALS = const(1)  # boots allowed to reach the http milestone
+
+    def __init__(self, root="", feed=None):
+        """ Updater for the files in directory root ("" is the current directory)
+
+        :param function feed: called between the files while swapping, e.g. to feed the watchdog
+        """
+        self.root = root
+        self.feed = feed
+        self.directory = f"{root}ota" if root == "" or root.endswith("/") else f"{root}/ota"
+        self.staging = f"{self.directory}/new"
+        self.backup = f"{self.directory}/old"
+        self.journal_file = f"{self.directory}/journal.json"
+        self.journal = {"state": "idle", "files": [], "added": [], "stale": [], "trials": 0, "upload": None}
+        try:
+            with open(self.journal_file) as fp:
+                self.journal.update(json.loads(fp.read()))
+        except (OSError, ValueError):
+            pass
+
+    def path(self, name):
+        return name if self.root == "" else f"{self.root.rstrip('/')}/{name}"
+
+    @staticmethod
+    def compiled(name):
+        """ Return the name of the precompiled version of source file name, None if it has none """
+        if name.endswith(".py") and name not in ("main.py", "boot.py"):
+            return f"mpy/{name[:-3]}.mpy"
+        return None
+
+    def save(self):
+        """ Write the journal, replacing the previous one in a single rename """
+        temp = f"{self.journal_file}.tmp"
+        with open(temp, "w") as fp:
+            json.dump(self.journal, fp)
+        os.rename(temp, self.journal_file)
+
+    @staticmethod
+    def check_name(name):
+        """ Return name if it is a safe relative path, raise ValueError if not """
+        if not 0 < len(name) <= Updater.MAX_NAME or name.startswith("/") or name.startswith("ota/") \
+                or ".." in name or "//" in name or name.endswith("/"):
+            raise ValueError(f"invalid file name {name}")
+        for c in name:
+            if not (c.isalpha() or c.isdigit() or c in "_-./"):
+                raise ValueError(f"invalid file name {name}")
+        return name
+
+    async def receive(self, reader, length, sha256):
+        """ Receive a bundle into the staging directory, verify and swap it
+
+        :param StreamReader reader: request body
+        :param int length: bytes in the body
+        :param str sha256: expected digest of the body (64 hex digits)
+        :return dict: files received and throughput
+        :raises ValueError: invalid bundle or digest mismatch, nothing is changed
+        :raises OSError: writing to flash failed (e.g. full), nothing is changed
+        """
+        if self.journal["state"] in ("swapping", "trial"):
+            raise ValueError(f"previous update is {self.journal['state']}")
+        if len(sha256) != 64:
+            raise ValueError("expected X-SHA256 header with 64 hex digits")
+        if length <= 0:
+            raise ValueError("expected a bundle")
+        if hasattr(os, "statvfs"):
+            stat = os.statvfs(self.root or "/")
+            if stat[0] * stat[3] < length + 4 * Updater.CHUNK:
+                raise OSError(28, "not enough free space on flash")
+
+        _remove_tree(self.staging)
+        _make_dirs(f"{self.staging}/")
+        start = time.ticks_ms()
+        h = hashlib.sha256()
+        files = list()
+        header = bytearray()  # name length, name and size of the next file
+        fp = None
+        remaining = 0  # bytes of the current file still to come
+        received = 0
+
+        try:
+            while received < length:
+                chunk = await reader.readexactly(min(Updater.CHUNK, length - received))
+                received += len(chunk)
+                h.update(chunk)
+                i = 0
+                while i < len(chunk):
+                    if fp is None:
+                        header.append(chunk[i])
+                        i += 1
+                        if len(header) < 5 or len(header) < header[0] + 5:
+                            continue
+                        name = Updater.check_name(bytes(header[1:header[0] + 1]).decode())
+                        remaining = struct.unpack(">I", header[header[0] + 1:])[0]
+                        header = bytearray()
+                        if name in files:
+                            raise ValueError(f"duplicate file {name}")
+                        files.append(name)
+                        _make_dirs(f"{self.staging}/{name}")
+                        fp = open(f"{self.staging}/{name}", "wb")
+                    take = min(remaining, len(chunk) - i)
+                    if take > 0:
+                        fp.write(chunk[i:i + take])
+                        i += take
+                        remaining -= take
+                    if remaining == 0:
+                        fp.close()
+                        fp = None
+            if fp is not None or len(header) > 0 or len(files) == 0:
+                raise ValueError("bundle incomplete")
+            digest = hexlify(h.digest()).decode()
+            if digest != sha256.lower():
+                raise ValueError(f"SHA-256 mismatch, received {digest}")
+        except (ValueError, OSError, EOFError) as e:
+            if fp is not None:
+                fp.close()
+            _remove_tree(self.staging)
+            if isinstance(e, EOFError):
+                raise ValueError("bundle incomplete")
+            raise
+
+        ms = max(1, time.ticks_diff(time.ticks_ms(), start))
+        upload = {"files": len(files), "bytes": length, "ms": ms, "kbyte_per_s": round(length / ms, 1),
+                  "sha256": digest}
+
+        _remove_tree(self.backup)
+        _make_dirs(f"{self.backup}/")
+        self.journal = {"state": "swapping", "files": files, "added": [], "stale": [], "trials": 0,
+                        "upload": upload}
+        self.save()
+        self.swap()
+        return upload
+
+    def swap(self):
+        """ Replace the files by the staged ones, continuing a swap which was interrupted """
+        for name in self.journal["files"]:
+            if self.feed is not None:
+                self.feed()
+            compiled = Updater.compiled(name)
+            if compiled is None or compiled in self.journal["files"] or not _exists(self.path(compiled)):
+                continue
+            if compiled not in self.journal["stale"]:
+                self.journal["stale"].append(compiled)
+                self.save()
+            _make_dirs(f"{self.backup}/{compiled}")
+            _remove_tree(f"{self.backup}/{compiled}")
+            os.rename(self.path(compiled), f"{self.backup}/{compiled}")
+        for name in self.journal["files"]:
+            if self.feed is not None:
+                self.feed()
+            staged = f"{self.staging}/{name}"
+            if not _exists(staged):
+                continue  # already swapped
+            target = self.path(name)
+            if _exists(target):
+                _make_dirs(f"{self.backup}/{name}")
+                _remove_tree(f"{self.backup}/{name}")
+                os.rename(target, f"{self.backup}/{name}")
+            elif name not in self.journal["added"]:
+                self.journal["added"].append(name)
+                self.save()
+            _make_dirs(target)
+            os.rename(staged, target)
+        _remove_tree(self.staging)
+        self.journal["state"] = "trial"
+        self.journal["trials"] = 0
+        self.save()
+
+    def rollback(self):
+        """ Restore the backup of the last update """
+        for name in self.journal["files"]:
+            target = self.path(name)
+            if _exists(f"{self.backup}/{name}"):
+                _remove_tree(target)
+                os.rename(f"{self.backup}/{name}", target)
+            elif name in self.journal["added"]:
+                _remove_tree(target)
+        for name in self.journal.get("stale", []):  # precompiled versions of the restored sources
+            if _exists(f"{self.backup}/{name}"):
+                _make_dirs(self.path(name))
+                os.rename(f"{self.backup}/{name}", self.path(name))
+        self.journal["state"] = "rolled back"
+        self.save()
+
+    def boot(self):
+        """ Call at boot before importing updated modules: complete a swap, count or end a trial """
+        state = self.journal["state"]
+        if state == "swapping":
+            self.swap()
+        if self.journal["state"] == "trial":
+            self.journal["trials"] += 1
+            if self.journal["trials"] > Updater.TRIALS:
+                self.rollback()
+            else:
+                self.save()
+
+    def confirm(self):
+        """ Call when the new code reached the http milestone, it is kept """
+        if self.journal["state"] == "trial":
+            self.journal["state"] = "confirmed"
+            self.save()
+
+    def failed(self):
+        """ Call when starting the code failed; during a trial the backup is restored
+
+        :return bool: True if rolled back, the caller should reset
+        """
+        if self.journal["state"] == "trial":
+            self.rollback()
+            return True
+        return False
+
+    def as_dict(self):
+        return {
+            "state": self.journal["state"],
+            "files": self.journal["files"],
+            "trials": self.journal["trials"],
+            "upload": self.journal["upload"]
+        }
+
+
+def bundle(files):
+    """ Return a bundle with the files, named as given (relative paths) """
+    data = bytearray()
+    for name in files:
+        with open(name, "rb") as fp:
+            content = fp.read()
+        encoded = Updater.check_name(name).encode()
+        data += bytes((len(encoded),)) + encoded + struct.pack(">I", len(content)) + content
+    return bytes(data)
+
+
+if __name__ == "__main__":
+    # Upload files to the controller (on a PC): python ota.py host file ...
+
+    import http.client
+    import sys
+
+    data = bundle(sys.argv[2:])
+    digest = hashlib.sha256(data).hexdigest()
+    connection = http.client.HTTPConnection(sys.argv[1], 80, timeout=60)
+    connection.request("POST", "/api/ota", body=data,
+                       headers={"Content-Type": "application/octet-stream", "X-SHA256": digest})
+    response = connection.getresponse()
+    print(response.status, response.read().decode())
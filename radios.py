@@ -0,0 +1,97 @@
+# Radios
+#
+# The controller can use several CC1101's, each on its own SPI channel
+# or slave select pin, with a role: only transmit, only receive, or
+# both. With a separate receiver the controller keeps listening to the
+# physical remote while a command is being sent. Every radio has its own
+# lock, when a single CC1101 does both the lock keeps a job's commands
+# together.
+#
+# Copyright 2022 (c) Erik de Lange
+# Released under MIT license
+
+import uasyncio as asyncio
+
+
+class Radio:
+    TX = "tx"
+    RX = "rx"
+    BOTH = "both"
+
+    def __init__(self, spi_id, ss, gd02, role=BOTH):
+        """ Describe a CC1101, the hardware is initialized by start()
+
+        :param int spi_id: microcontroller SPI channel id
+        :param int ss: pin number connected to CSn
+        :param int gd02: pin number connected to GD02
+        :param str role: Radio.TX, Radio.RX or Radio.BOTH
+        """
+        if role not in (Radio.TX, Radio.RX, Radio.BOTH):
+            raise ValueError(f"invalid radio role {role}")
+
+        self.spi_id = spi_id
+        self.ss = ss
+        self.gd02 = gd02
+        self.role = role
+        self.lock = asyncio.Lock()  # held while transmitting a command or running a job
+        self.cc1101 = None
+        self.itho = None
+        self.rx_pending = False  # set by the GD02 interrupt when the CC1101 has received a message
+
+    def transmits(self):
+        return self.role != Radio.RX
+
+    def receives(self):
+        return self.role != Radio.TX
+
+    def start(self, remote_type=None, remote_id=None, duplicates=None):
+        """ Initialize the CC1101 (blocking)
+
+        :param int remote_type: remote type used when transmitting
+        :param tuple remote_id: remote id used when transmitting
+        :param DuplicateFilter duplicates: filter shared by all receivers
+        """
+        from cc1101 import CC1101
+        from itho import ITHO
+
+        self.cc1101 = CC1101(self.spi_id, self.ss, self.gd02)
+        self.itho = ITHO(self.cc1101, remote_type, remote_id)
+        if duplicates is not None:
+            self.itho.duplicates = duplicates
+
+    def gd02_handler(self, pin):
+        self.rx_pending = True
+
+    def as_dict(self):
+        return {
+            "spi_id": self.spi_id,
+            "ss": self.ss,
+            "gd02": self.gd02,
+            "role": self.role,
+            "started": self.itho is not None,
+            "locked": self.lock.locked()
+        }
+
+
+def select(radios):
+    """ Choose the transmitter and the receivers
+
+    Only one radio transmits, as all commands must use the counter of
+    the same remote. A radio which only transmits is preferred, so a
+    radio which also receives keeps listening. All radios which can
+    receive do so, a message received by more than one is delivered
+    once by the shared duplicate filter.
+
+    :param list radios: Radio instances
+    :return tuple: (transmitting Radio, list of receiving Radios)
+    """
+    transmitters = [radio for radio in radios if radio.role == Radio.TX]
+    if len(transmitters) == 0:
+        transmitters = [radio for radio in radios if radio.transmits()]
+    if len(transmitters) == 0:
+        raise ValueError("no radio with role tx or both")
+    transmitter = transmitters[0]
+
+    receivers = [radio for radio in radios if radio.receives()]
+
+    return transmitter, receivers
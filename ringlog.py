@@ -0,0 +1,183 @@
+# Ring buffer logger
+#
+# Log records are kept in RAM in a fixed number of preallocated slots;
+# when all are used the oldest record is overwritten. A record holds
+# the level, the time, the logger name, and a reference to the format
+# string and its (at most 3) arguments. The text is only formatted when
+# the records are read, so writing a record takes a few microseconds,
+# does not allocate memory for integer arguments, and never blocks on a
+# slow console. Records below the level of the log are discarded at
+# once. The records can be read via the controller (/api/log).
+#
+# Usage, like module logging:
+#   logger = ringlog.getLogger(__name__)
+#   logger.info("offset %d ms from %s", offset, server)
+#
+# Copyright 2022 (c) Erik de Lange
+# Released under MIT license
+
+from array import array
+
+from hal import const, time
+
+DEBUG = const(10)
+INFO = const(20)
+WARNING = const(30)
+ERROR = const(40)
+CRITICAL = const(50)
+
+LEVEL_NAME = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR", CRITICAL: "CRITICAL"}
+
+_NONE = object()  # marks an unused argument
+
+
+class RingLog:
+    SLOTS = const(128)
+    ARGS = const(3)  # maximum number of arguments per record
+
+    def __init__(self, slots=SLOTS, level=INFO, echo=False):
+        """ Create a ring buffer for log records
+
+        :param int slots: number of records kept
+        :param int level: records below this level are discarded
+        :param bool echo: also print every record (formatting it immediately)
+        """
+        self.slots = slots
+        self.level = level
+        self.echo = echo
+        self.seq = 0  # number of records written, the sequence number of the next record
+        self.levels = bytearray(slots)
+        self.seconds = array("L", [0] * slots)  # time.time()
+        self.ticks = array("L", [0] * slots)  # time.ticks_ms()
+        self.name = [None] * slots
+        self.fmt = [None] * slots
+        self.args = [None] * (slots * RingLog.ARGS)
+        self.count = bytearray(slots)  # number of arguments
+
+    def write(self, level, name, fmt, a=_NONE, b=_NONE, c=_NONE):
+        """ Store a record, the text is fmt % (a, b, c) without the unused arguments """
+        if level < self.level:
+            return
+        slot = self.seq % self.slots
+        self.levels[slot] = level
+        self.seconds[slot] = time.time()
+        self.ticks[slot] = time.ticks_ms() & 0x3FFFFFFF
+        self.name[slot] = name
+        self.fmt[slot] = fmt
+        i = slot * RingLog.ARGS
+        self.args[i] = a
+        self.args[i + 1] = b
+        self.args[i + 2] = c
+        self.count[slot] = 0 if a is _NONE else 1 if b is _NONE else 2 if c is _NONE else 3
+        self.seq += 1
+        if self.echo is True:
+            print(self.format(self.seq - 1))
+
+    def oldest(self):
+        """ Return the sequence number of the oldest record still kept """
+        return max(0, self.seq - self.slots)
+
+    def text(self, seq):
+        """ Return the message of a record """
+        slot = seq % self.slots
+        fmt = self.fmt[slot]
+        count = self.count[slot]
+        if count == 0:
+            return str(fmt)
+        i = slot * RingLog.ARGS
+        args = tuple(self.args[i:i + count])
+        try:
+            return fmt % args
+        except (TypeError, ValueError):
+            return f"{fmt} {args}"
+
+    def format(self, seq):
+        """ Return a record as a line of text, the time is in UTC like the RTC (see tz.py) """
+        slot = seq % self.slots
+        t = time.gmtime(self.seconds[slot])
+        return (f"{seq} {t[0]:04d}-{t[1]:02d}-{t[2]:02d} {t[3]:02d}:{t[4]:02d}:{t[5]:02d} UTC "
+                f"[{self.ticks[slot]}] {LEVEL_NAME.get(self.levels[slot], self.levels[slot])} "
+                f"{self.name[slot]}: {self.text(seq)}")
+
+    def records(self, since=0, level=DEBUG):
+        """ Yield the sequence numbers of the kept records from since on
+
+        :param int since: first sequence number wanted
+        :param int level: minimum level
+        """
+        for seq in range(max(since, self.oldest()), self.seq):
+            if self.levels[seq % self.slots] >= level:
+                yield seq
+
+
+class Logger:
+
+    def __init__(self, log, name):
+        self.log = log
+        self.name = name
+
+    def debug(self, fmt, a=_NONE, b=_NONE, c=_NONE):
+        self.log.write(DEBUG, self.name, fmt, a, b, c)
+
+    def info(self, fmt, a=_NONE, b=_NONE, c=_NONE):
+        self.log.write(INFO, self.name, fmt, a, b, c)
+
+    def warning(self, fmt, a=_NONE, b=_NONE, c=_NONE):
+        self.log.write(WARNING, self.name, fmt, a, b, c)
+
+    def error(self, fmt, a=_NONE, b=_NONE, c=_NONE):
+        self.log.write(ERROR, self.name, fmt, a, b, c)
+
+    def critical(self, fmt, a=_NONE, b=_NONE, c=_NONE):
+        self.log.write(CRITICAL, self.name, fmt, a, b, c)
+
+    def exception(self, e, fmt="exception"):
+        """ Log an exception with its traceback at level ERROR (formatted now, exceptions are rare) """
+        import io
+        import sys
+
+        buffer = io.StringIO()
+        if hasattr(sys, "print_exception"):
+            sys.print_exception(e, buffer)
+        else:  # CPython
+            import traceback
+            traceback.print_exception(type(e), e, e.__traceback__, file=buffer)
+        self.log.write(ERROR, self.name, "%s: %s", fmt, buffer.getvalue())
+
+
+log = RingLog()  # shared by all loggers
+_loggers = dict()
+
+
+def configure(slots=RingLog.SLOTS, level=INFO, echo=False):
+    """ Recreate the shared ring buffer, discarding the records written so far """
+    log.__init__(slots, level, echo)
+
+
+def getLogger(name):
+    """ Return the logger for name, writing to the shared ring buffer """
+    if name not in _loggers:
+        _loggers[name] = Logger(log, name)
+    return _loggers[name]
+
+
+if __name__ == "__main__":
+    # Measure the cost of writing a record, and of a discarded one
+
+    import gc
+
+    logger = getLogger("benchmark")
+    rounds = 1000
+
+    for write, label in ((logger.info, "written"), (logger.debug, "discarded")):
+        gc.collect()
+        alloc = gc.mem_alloc()
+        start = time.ticks_us()
+        for i in range(rounds):
+            write("rx counter %d rssi %d", i & 0xFF, -60)
+        elapsed = time.ticks_diff(time.ticks_us(), start)
+        alloc = gc.mem_alloc() - alloc
+        print(f"{label}: {elapsed / rounds:.1f} us, {alloc / rounds:.1f} bytes per record")
+
+    for seq in log.records(log.seq - 3):
+        print(log.format(seq))
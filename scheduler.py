@@ -0,0 +1,94 @@
+# Scheduler
+#
+# Runs the scheduled tasks (tasks.py) and macros (macros.py) when their
+# run-time [hh, mm] has come. The scheduler checks every minute and runs
+# everything with a run-time in the local minutes passed since the
+# previous check. Local time is counted in minutes since the epoch, not
+# since midnight, so a run-time of 00:00 and a check which spans
+# midnight work like any other. A late check, and the hour skipped at
+# the start of daylight saving time, are caught up. When the clock goes
+# back (end of daylight saving time, or a time synchronization) nothing
+# runs until the clock has passed the previous check again, so nothing
+# runs twice. A jump forward of more than MAX_CATCHUP minutes is a clock
+# step (e.g. the first time synchronization after power-up); the
+# run-times in between are skipped.
+#
+# Copyright 2022 (c) Erik de Lange
+# Released under MIT license
+
+import time
+
+import uasyncio as asyncio
+
+import ringlog
+import tz
+from hal import const
+from itho import ITHOCOMMAND
+
+logger = ringlog.getLogger(__name__)
+
+
+class Scheduler:
+    INTERVAL = const(60)  # seconds between checks
+    MAX_CATCHUP = const(90)  # minutes, a larger jump forward is a clock step
+
+    def __init__(self, tasks, macros, send, submit):
+        """ Scheduler for tasks and macros
+
+        :param Tasks tasks: run-times of start_low and start_medium
+        :param Macros macros: macros, run if they have a run-time
+        :param function send: coroutine send(command, force) transmitting a command
+        :param function submit: submit(steps) starts a job, raises ValueError for invalid steps
+        """
+        self.tasks = tasks
+        self.macros = macros
+        self.send = send
+        self.submit = submit
+        self.previous = Scheduler.now()  # minutes, time of the previous check
+
+    @staticmethod
+    def now():
+        """ Return local time in minutes since the epoch """
+        t = time.time()
+        return (t + tz.utcoffset(t)) // 60
+
+    def eligible(self, scheduled_time, current):
+        """ Check if scheduled time lies after the previous check, up to and including current
+
+        :param list scheduled_time: [hh, mm]
+        :param int current: local time in minutes since the epoch
+        """
+        s_mins = scheduled_time[0] * 60 + scheduled_time[1]
+        return (s_mins - self.previous - 1) % 1440 < current - self.previous
+
+    async def check(self):
+        """ Run the tasks and macros which became due since the previous check """
+        current = Scheduler.now()
+        elapsed = current - self.previous
+
+        if elapsed <= 0:
+            return  # clock went back, wait until the previous check has passed again
+        if elapsed > Scheduler.MAX_CATCHUP:
+            logger.warning("clock stepped %d minutes, run-times in between skipped", elapsed)
+            self.previous = current
+            return
+
+        # just three tasks, no complex data structures needed
+        # check tasks one by one to see if they are eligible to run
+        # skip commands which would not change the fan state
+        if self.eligible(self.tasks.task["start_low"], current) is True:
+            await self.send(ITHOCOMMAND.LOW, False)
+        if self.eligible(self.tasks.task["start_medium"], current) is True:
+            await self.send(ITHOCOMMAND.MEDIUM, False)
+        for name, macro in self.macros.macro.items():
+            if macro["at"] is not None and self.eligible(macro["at"], current) is True:
+                try:
+                    self.submit(macro["steps"])
+                except ValueError as e:
+                    logger.error("macro %s: %s", name, e)
+        self.previous = current
+
+    async def run(self):
+        while True:
+            await self.check()
+            await asyncio.sleep(Scheduler.INTERVAL)
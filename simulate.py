@@ -0,0 +1,398 @@
+# Virtual time simulation of the scheduler and time synchronization
+#
+# The scheduler checks once a minute and its problems show up at
+# midnight, at a change to or from daylight saving time or after a
+# clock step, so testing it in real time is impossible. Here the real
+# Scheduler, tz, Tasks and Macros run against a virtual clock and a
+# virtual event loop, which jumps to the next task to wake up instead of
+# waiting. Modules time, uasyncio and machine are replaced by these
+# before the controller modules are imported. The virtual RTC drifts and
+# is kept on time the way the controller does it: ntp.sync(correct=False)
+# measures the offset, which ClockDiscipline (drift.py) steps or slews
+# away, synchronizing at the interval it adapts to the drift. ntp.sync
+# gets its answers from a simulated NTP server. The commands and macros
+# started are recorded by a fake remote with the local time, and
+# compared with the expected ones. A year is simulated in seconds.
+#
+# Runs on CPython and on the MicroPython unix port: python simulate.py
+# The exit status is 1 if a run-time was missed, repeated or late.
+#
+# Copyright 2022 (c) Erik de Lange
+# Released under MIT license
+
+import sys
+import time as host
+
+
+def days_from_civil(year, month, day):
+    """ Return the number of days since 1970-01-01 """
+    year -= month <= 2
+    era = year // 400
+    yoe = year - era * 400
+    doy = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+
+def civil_from_days(days):
+    """ Return (year, month, day, day of year) for a number of days since 1970-01-01 """
+    era = (days + 719468) // 146097
+    doe = days + 719468 - era * 146097
+    yoe = (doe - doe // 1460 + doe // 36524 - doe // 146096) // 365
+    doy = doe - (365 * yoe + yoe // 4 - yoe // 100)
+    mp = (5 * doy + 2) // 153
+    day = doy - (153 * mp + 2) // 5 + 1
+    month = mp + (3 if mp < 10 else -9)
+    year = yoe + era * 400 + (month <= 2)
+    return year, month, day, days - days_from_civil(year, 1, 1) + 1
+
+
+class VirtualClock:
+    """ Replaces module time, and provides the RTC of module machine
+
+    ns is the true time (also used for the ticks); the RTC runs ppm
+    too fast from the moment it was last set.
+    """
+
+    def __init__(self):
+        self.reset(0)
+
+    def reset(self, start, rtc=None, ppm=0):
+        """ Start at true time start, with the RTC at rtc (both seconds since the epoch) """
+        self.ns = start * 1000000000
+        self.ppm = ppm
+        self.set_rtc((start if rtc is None else rtc) * 1000000000)
+
+    def set_rtc(self, ns):
+        self.rtc_ns = ns
+        self.rtc_set = self.ns
+
+    # module time
+
+    def time_ns(self):
+        return self.rtc_ns + (self.ns - self.rtc_set) * (1000000 + self.ppm) // 1000000
+
+    def time(self):
+        return self.time_ns() // 1000000000
+
+    def gmtime(self, t=None):
+        if t is None:
+            t = self.time()
+        days, seconds = divmod(int(t), 86400)
+        year, month, day, yday = civil_from_days(days)
+        return year, month, day, seconds // 3600, seconds // 60 % 60, seconds % 60, (days + 3) % 7, yday
+
+    localtime = gmtime  # the RTC is kept in UTC
+
+    def mktime(self, tm):
+        return days_from_civil(tm[0], tm[1], tm[2]) * 86400 + tm[3] * 3600 + tm[4] * 60 + tm[5]
+
+    def ticks_ms(self):
+        return self.ns // 1000000
+
+    def ticks_us(self):
+        return self.ns // 1000
+
+    def ticks_add(self, ticks, delta):
+        return ticks + delta
+
+    def ticks_diff(self, ticks1, ticks2):
+        return ticks1 - ticks2
+
+    def sleep_ms(self, ms):  # blocking, time passes without other tasks running
+        self.ns += ms * 1000000
+
+    def sleep_us(self, us):
+        self.ns += us * 1000
+
+    def sleep(self, seconds):
+        self.ns += int(seconds * 1000000000)
+
+
+class Machine:
+    """ Replaces module machine, only the RTC """
+
+    def __init__(self, clock):
+        clock_ = clock
+
+        class RTC:
+            def datetime(self, dt=None):
+                """ dt is (year, month, day, weekday, hours, minutes, seconds, subseconds (us)) """
+                if dt is None:
+                    tm = clock_.gmtime()
+                    return tm[0], tm[1], tm[2], tm[6], tm[3], tm[4], tm[5], clock_.time_ns() // 1000 % 1000000
+                seconds = clock_.mktime((dt[0], dt[1], dt[2], dt[4], dt[5], dt[6]))
+                clock_.set_rtc(seconds * 1000000000 + dt[7] * 1000)
+
+        self.RTC = RTC
+
+
+class _Sleep:
+    def __init__(self, ns):
+        self.ns = ns
+
+    def __iter__(self):
+        yield self
+
+    __await__ = __iter__
+
+
+class VirtualLoop:
+    """ Replaces module uasyncio, only sleeping and running tasks """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.tasks = list()  # [wake up time ns, coroutine]
+
+    def sleep(self, seconds):
+        return _Sleep(int(seconds * 1000000000))
+
+    def sleep_ms(self, ms):
+        return _Sleep(ms * 1000000)
+
+    def create_task(self, coroutine):
+        self.tasks.append([self.clock.ns, coroutine])
+        return coroutine
+
+    def run_until(self, end):
+        """ Run the tasks until true time end (seconds since the epoch) """
+        end *= 1000000000
+        while len(self.tasks) > 0:
+            task = min(self.tasks, key=lambda task: task[0])
+            if task[0] > end:
+                break
+            self.clock.ns = max(self.clock.ns, task[0])
+            try:
+                request = task[1].send(None)
+            except StopIteration:
+                self.tasks.remove(task)
+                continue
+            task[0] = self.clock.ns + request.ns
+        self.clock.ns = max(self.clock.ns, end)
+
+    def reset(self):
+        for task in self.tasks:
+            task[1].close()
+        self.tasks = list()
+
+
+clock = VirtualClock()
+loop = VirtualLoop(clock)
+
+# the controller modules must see the virtual clock and loop, so they are imported after this
+sys.modules["time"] = clock
+sys.modules["uasyncio"] = loop
+sys.modules["machine"] = Machine(clock)
+
+import ntp
+import ringlog
+import sntp
+import tz
+from config import CLOCK_TARGET_MS
+from drift import ClockDiscipline
+from itho import ITHOCOMMAND
+from macros import Macros
+from scheduler import Scheduler
+from tasks import Tasks
+
+DAY = 86400
+
+
+def local_midnight(year, month, day):
+    """ Return the UTC time (seconds since the epoch) of 00:00 local time """
+    t = clock.mktime((year, month, day, 0, 0, 0))
+    return t - tz.utcoffset(t)
+
+
+class Remote:
+    """ Records the commands sent and the macros submitted by the scheduler """
+
+    def __init__(self):
+        self.fired = list()  # (name, local time tuple)
+
+    def record(self, name):
+        self.fired.append((name, tz.localtime()))
+
+    async def send(self, command, force=True):
+        self.record({ITHOCOMMAND.LOW: "start_low", ITHOCOMMAND.MEDIUM: "start_medium"}.get(command, command))
+        return True
+
+    def submit(self, steps):
+        self.record(steps[0]["macro"])
+
+
+class NTPServer:
+    """ Answers sntp.query with the true time, except every fail'th time """
+
+    def __init__(self, fail=0, delay_ms=30):
+        self.fail = fail
+        self.delay_ms = delay_ms
+        self.queries = 0
+        self.offsets = list()  # ns the RTC was off at every answer
+
+    async def query(self, servers, timeout=2000):
+        self.queries += 1
+        await loop.sleep_ms(self.delay_ms)
+        if self.fail > 0 and self.queries % self.fail == 0:
+            await loop.sleep_ms(timeout - self.delay_ms)
+            return list()
+        offset = clock.ns - clock.time_ns()
+        self.offsets.append(offset)
+        return [sntp.Sample("virtual", offset, self.delay_ms * 1000000, 2)]
+
+
+def setup(start, rtc=None, ppm=0, fail=0, target_ms=CLOCK_TARGET_MS):
+    """ Prepare a simulation starting at true time start
+
+    :param int target_ms: desired accuracy of the clock, determines the synchronization interval
+    :return tuple: (Scheduler, Remote, NTPServer, ClockDiscipline)
+    """
+    loop.reset()
+    clock.reset(start, rtc, ppm)
+    ringlog.configure(level=ringlog.INFO)
+
+    remote = Remote()
+    server = NTPServer(fail)
+    sntp.query = server.query
+
+    tasks = Tasks()
+    tasks.task = {"start_low": [22, 30], "start_medium": [7, 0]}
+    macros = Macros()
+    macros.macro = {
+        "midnight": {"steps": [{"macro": "midnight"}], "at": [0, 0]},
+        "night": {"steps": [{"macro": "night"}], "at": [2, 30]}  # skipped resp. repeated when the DST changes
+    }
+    scheduler = Scheduler(tasks, macros, remote.send, remote.submit)
+    discipline = ClockDiscipline(target_ms)
+
+    # the same tasks as controller.ntp_task, slew_task and scheduler_task
+    loop.create_task(discipline.sync_task(lambda: ntp.sync(correct=False)))
+    loop.create_task(discipline.slew_task())
+    loop.create_task(scheduler.run())
+    return scheduler, remote, server, discipline
+
+
+def check(remote, expected, start_day, days):
+    """ Compare the recorded runs with the expected ones
+
+    Every run-time must run once on each local day, in the minute it
+    is due or the next one. A run-time in the hour skipped at the start
+    of daylight saving time runs at 03:00 or 03:01.
+
+    :param function expected: day number -> dict {name: [hh, mm]} of the run-times that day
+    :return dict: number of missing, duplicate and late runs, and the first errors
+    """
+    result = {"runs": len(remote.fired), "missing": 0, "duplicate": 0, "late": 0, "errors": list()}
+    seen = dict()
+    for name, tm in remote.fired:
+        seen.setdefault((name, days_from_civil(tm[0], tm[1], tm[2])), list()).append(tm)
+
+    for day in range(start_day, start_day + days):
+        for name, at in expected(day).items():
+            runs = seen.pop((name, day), list())
+            if len(runs) == 0:
+                result["missing"] += 1
+                result["errors"].append(("missing", name, civil_from_days(day)[:3], at))
+                continue
+            if len(runs) > 1:
+                result["duplicate"] += 1
+                result["errors"].append(("duplicate", name, runs))
+            due = at[0] * 60 + at[1]
+            minute = runs[0][3] * 60 + runs[0][4]
+            if not (0 <= minute - due <= 1 or (120 <= due < 180 and 180 <= minute <= 181)):
+                result["late"] += 1
+                result["errors"].append(("late", name, runs[0][:6], at))
+
+    for (name, day), runs in seen.items():
+        result["duplicate"] += len(runs)
+        result["errors"].append(("unexpected", name, runs))
+
+    result["errors"] = result["errors"][:5]
+    return result
+
+
+def year(first=2022, ppm=25, fail=7):
+    """ Simulate a year with a drifting RTC, a failing NTP server and a change of the schedule
+
+    Halfway start_low is changed to 23:45 via Tasks.save() and load().
+    """
+    start = local_midnight(first, 1, 1)
+    start_day = days_from_civil(first, 1, 1)
+    days = days_from_civil(first + 1, 1, 1) - start_day
+    change_day = start_day + days // 2
+    scheduler, remote, server, discipline = setup(start - 60, ppm=ppm, fail=fail)
+
+    loop.run_until(start + (change_day - start_day) * DAY + 12 * 3600)
+    scheduler.tasks.task["start_low"] = [23, 45]
+    scheduler.tasks.save("simulate.json")
+    stored = Tasks()
+    stored.load("simulate.json")
+    import os
+    os.remove("simulate.json")
+    scheduler.tasks = stored
+    loop.run_until(local_midnight(first + 1, 1, 1) - 60)
+
+    def expected(day):
+        return {"start_low": [23, 45] if day >= change_day else [22, 30], "start_medium": [7, 0],
+                "midnight": [0, 0], "night": [2, 30]}
+
+    result = check(remote, expected, start_day, days)
+    result["stored"] = stored.task["start_low"] == [23, 45]
+    result["ntp_queries"] = server.queries
+    result["max_offset_ms"] = max(abs(offset) for offset in server.offsets[1:]) // 1000000
+    result["drift_ppm"] = round(discipline.drift, 1)
+    return result
+
+
+def steps(first=2022):
+    """ Simulate power-up with an unset RTC and two clock steps
+
+    Power-up is at 07:00 with the RTC at the epoch; the first time
+    synchronization steps it forward by years, so start_medium does not
+    run on the first day. With a target accuracy of 1 ms the time is
+    synchronized at least every 2000 s. On day 2 the RTC is set 3 hours
+    ahead at 12:00, and stepped back again by the next synchronization.
+    On day 3 the RTC is set 2 hours back at 23:00, which must not repeat
+    start_low at 22:30; the next synchronization steps it forward before
+    midnight.
+    """
+    start = local_midnight(first, 2, 1)
+    start_day = days_from_civil(first, 2, 1)
+    scheduler, remote, server, discipline = setup(start + 7 * 3600, rtc=0, target_ms=1)
+
+    rtc = sys.modules["machine"].RTC()
+
+    def set_rtc(offset):
+        tm = clock.gmtime(clock.time() + offset)
+        rtc.datetime((tm[0], tm[1], tm[2], tm[6], tm[3], tm[4], tm[5], 0))
+
+    loop.run_until(start + DAY + 12 * 3600)
+    set_rtc(3 * 3600)
+    loop.run_until(start + 2 * DAY + 23 * 3600)
+    set_rtc(-2 * 3600)
+    loop.run_until(start + 4 * DAY - 60)
+
+    def expected(day):
+        runs = {"start_low": [22, 30], "start_medium": [7, 0], "midnight": [0, 0], "night": [2, 30]}
+        if day == start_day:
+            return {"start_low": [22, 30]}
+        return runs
+
+    result = check(remote, expected, start_day, 4)
+    result["clock_steps"] = discipline.steps
+    result["warnings"] = [ringlog.log.text(seq) for seq in ringlog.log.records(0, ringlog.WARNING)]
+    return result
+
+
+if __name__ == "__main__":
+    failed = list()
+    for scenario in (year, steps):
+        begin = host.time()
+        result = scenario()
+        print(f"{scenario.__name__} ({host.time() - begin:.0f} s): {result}")
+        if result["missing"] > 0 or result["duplicate"] > 0 or result["late"] > 0 or result.get("stored") is False:
+            failed.append(scenario.__name__)
+    if len(failed) > 0:
+        print("failed:", ", ".join(failed))
+        sys.exit(1)
+    print("passed")
@@ -0,0 +1,257 @@
+# Non-blocking SNTP client
+#
+# Queries several NTP servers at the same time using non-blocking UDP
+# sockets, so the asyncio event loop keeps running while waiting for
+# the answers. The sample with the lowest round trip delay is the most
+# accurate one, its offset is corrected for the round trip time.
+#
+# While answers are pending the sockets are polled with a timeout of
+# 1 ms, and the receive timestamp is taken as soon as the poll returns.
+# So it is at most a millisecond late, independent of how long the
+# other tasks run before the event loop comes back to this one (an
+# answer is only read after that).
+#
+# Runs on the microcontroller, on the MicroPython unix port and on
+# CPython. Without arguments a test against local NTP responders is run,
+# with arguments the servers given are queried: python sntp.py pool.ntp.org
+#
+# Copyright 2022 (c) Erik de Lange
+# Released under MIT license
+
+import select
+import socket
+import struct
+
+try:
+    import uasyncio as asyncio
+except ImportError:  # CPython
+    import asyncio
+
+import ringlog
+from hal import const, time
+
+logger = ringlog.getLogger(__name__)
+
+# Seconds between the NTP epoch (1900) and the epoch used by time.time()
+NTP_DELTA = 3155673600 if time.gmtime(0)[0] == 2000 else 2208988800
+
+NTP_PORT = const(123)
+PACKET_SIZE = const(48)
+
+
+class Sample:
+
+    def __init__(self, server, offset, delay, stratum):
+        self.server = server
+        self.offset = offset  # ns to add to the local clock
+        self.delay = delay  # round trip delay in ns
+        self.stratum = stratum
+
+    def as_dict(self):
+        return {
+            "server": self.server,
+            "offset_ms": self.offset / 1000000,
+            "delay_ms": self.delay / 1000000,
+            "stratum": self.stratum
+        }
+
+
+def to_ns(buf, offset):
+    """ Convert an NTP timestamp in buf to ns since the epoch of time.time() """
+    seconds, fraction = struct.unpack_from("!II", buf, offset)
+    return (seconds - NTP_DELTA) * 1000000000 + (fraction * 1000000000 >> 32)
+
+
+def from_ns(ns, buf, offset):
+    """ Store ns since the epoch of time.time() as NTP timestamp in buf """
+    seconds, remainder = divmod(ns, 1000000000)
+    struct.pack_into("!II", buf, offset, (seconds + NTP_DELTA) & 0xFFFFFFFF, (remainder << 32) // 1000000000)
+
+
+async def query(servers, timeout=2000):
+    """ Query NTP servers simultaneously
+
+    Name resolution (getaddrinfo) is blocking, but normally answered
+    from the DNS cache of the network stack.
+
+    :param list servers: host names or addresses, optionally with ":port"
+    :param int timeout: ms to wait for the answers
+    :return list: Sample for every valid answer received
+    """
+    pending = list()  # [server, socket, request]
+    poller = select.poll()
+
+    for server in servers:
+        host, _, port = server.partition(":")
+        try:
+            address = socket.getaddrinfo(host, int(port) if port else NTP_PORT)[0][-1]
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            request = bytearray(PACKET_SIZE)
+            request[0] = 0x23  # leap indicator 0, version 4, mode 3 (client)
+            from_ns(time.time_ns(), request, 40)  # transmit timestamp, returned as originate timestamp
+            sock.sendto(request, address)
+            poller.register(sock, select.POLLIN)
+            pending.append([server, sock, request])
+        except OSError as e:
+            logger.warning("NTP server %s - %s", server, e)
+
+    samples = list()
+    start = time.ticks_ms()
+
+    while len(pending) > 0 and time.ticks_diff(time.ticks_ms(), start) < timeout:
+        if len(poller.poll(1)) == 0:  # blocks the event loop for at most 1 ms
+            await asyncio.sleep(0)
+            continue
+        t4 = time.time_ns()  # an answer arrived within the last ms
+        for entry in tuple(pending):
+            server, sock, request = entry
+            try:
+                response = sock.recv(PACKET_SIZE)
+            except OSError:
+                continue  # no answer yet
+            poller.unregister(sock)
+            sock.close()
+            pending.remove(entry)
+            sample = parse(server, request, response, t4)
+            if sample is not None:
+                samples.append(sample)
+
+    for _, sock, _ in pending:
+        sock.close()
+
+    return samples
+
+
+def parse(server, request, response, t4):
+    """ Check an NTP response and calculate offset and round trip delay
+
+    :return Sample: None if the response is invalid
+    """
+    if len(response) < PACKET_SIZE:
+        return None
+    if response[0] >> 6 == 3 or response[0] & 0x07 != 4:
+        return None  # server clock not synchronized or not a server response
+    stratum = response[1]
+    if not 1 <= stratum <= 15:
+        return None  # kiss-o'-death or invalid stratum
+    if response[24:32] != request[40:48]:
+        return None  # not the answer to our request
+
+    t1 = to_ns(request, 40)  # request sent
+    t2 = to_ns(response, 32)  # request received by server
+    t3 = to_ns(response, 40)  # response sent by server
+
+    offset = ((t2 - t1) + (t3 - t4)) // 2
+    delay = (t4 - t1) - (t3 - t2)
+
+    return Sample(server, offset, delay, stratum)
+
+
+def best(samples):
+    """ Return the sample with the lowest round trip delay (None if no samples) """
+    result = None
+    for sample in samples:
+        if result is None or sample.delay < result.delay:
+            result = sample
+    return result
+
+
+def datetime(ns):
+    """ Return ns since the epoch of time.time() as tuple for machine.RTC().datetime() """
+    seconds, remainder = divmod(ns, 1000000000)
+    tm = time.gmtime(seconds)
+    return tm[0], tm[1], tm[2], tm[6], tm[3], tm[4], tm[5], remainder // 1000
+
+
+def step(offset):
+    """ Correct the RTC by offset
+
+    :param int offset: ns to add to the RTC
+    """
+    import machine
+
+    machine.RTC().datetime(datetime(time.time_ns() + offset))
+
+
+class Responder:
+    """ NTP server for testing, answering with the local clock plus offset
+
+    The request is held for delay ms before it is processed, like a slow
+    network path towards the server.
+    """
+
+    def __init__(self, port, offset=0, delay=0, stratum=2):
+        self.offset = offset  # ns
+        self.delay = delay  # ms
+        self.stratum = stratum
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(socket.getaddrinfo("127.0.0.1", port)[0][-1])
+        self.sock.setblocking(False)
+
+    async def run(self):
+        while True:
+            try:
+                request, address = self.sock.recvfrom(PACKET_SIZE)
+            except OSError:
+                await asyncio.sleep(0.001)
+                continue
+            await asyncio.sleep(self.delay / 1000)
+            response = bytearray(PACKET_SIZE)
+            response[0] = 0x24  # leap indicator 0, version 4, mode 4 (server)
+            response[1] = self.stratum
+            response[24:32] = request[40:48]  # originate timestamp
+            from_ns(time.time_ns() + self.offset, response, 32)  # receive timestamp
+            from_ns(time.time_ns() + self.offset, response, 40)  # transmit timestamp
+            self.sock.sendto(response, address)
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) > 1:
+        for sample in asyncio.run(query(sys.argv[1:])):
+            print(sample.as_dict())
+        sys.exit()
+
+    # Query two local responders, both 1.5 s ahead; the one on port 11124 has a slow request path,
+    # which makes it look 25 ms further ahead. Then check the rejection of invalid answers and the
+    # conversion used by step().
+
+    async def main():
+        responders = (Responder(11123, 1500000000), Responder(11124, 1500000000, delay=50))
+        tasks = [asyncio.create_task(responder.run()) for responder in responders]
+        samples = await query(["127.0.0.1:11123", "127.0.0.1:11124", "127.0.0.1:11125"], timeout=500)
+        for task in tasks:
+            task.cancel()
+        return samples
+
+    samples = asyncio.run(main())
+    for sample in samples:
+        print(sample.as_dict())
+    sample = best(samples)
+    print("best is the fast responder:", sample is not None and sample.server.endswith("11123"))
+    print("offset error within half the delay:",
+          sample is not None and abs(sample.offset - 1500000000) <= sample.delay // 2)
+
+    request = bytearray(PACKET_SIZE)
+    from_ns(time.time_ns(), request, 40)
+    response = bytearray(PACKET_SIZE)
+    response[0] = 0x24
+    response[1] = 2
+    response[24:32] = request[40:48]
+    from_ns(to_ns(request, 40) + 1000000, response, 32)
+    from_ns(to_ns(request, 40) + 1000000, response, 40)
+    valid = parse("test", request, response, to_ns(request, 40))
+    print("valid answer accepted:", valid is not None and abs(valid.offset - 1000000) < 10 and abs(valid.delay) < 10)
+    invalid = list()
+    # unsynchronized, client mode, kiss-o'-death, invalid stratum, other originate timestamp, too short
+    for i, value in ((0, 0xE4), (0, 0x23), (1, 0), (1, 16), (24, response[24] ^ 1)):
+        changed = bytearray(response)
+        changed[i] = value
+        invalid.append(parse("test", request, changed, to_ns(request, 40)))
+    invalid.append(parse("test", request, response[:40], to_ns(request, 40)))
+    print("invalid answers rejected:", invalid == [None] * 6)
+
+    ns = (3908988800 - NTP_DELTA) * 1000000000 + 123456789  # 2023-11-14 22:13:20.123456789 UTC, a Tuesday
+    print("step conversion exact to the us:", datetime(ns) == (2023, 11, 14, 1, 22, 13, 20, 123456))
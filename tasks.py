@@ -8,7 +8,10 @@
 # Released under MIT license
 
 import json
-import logging
+
+import ringlog
+
+logger = ringlog.getLogger(__name__)
 
 
 class Tasks:
@@ -17,8 +20,7 @@ class Tasks:
     def __init__(self):
         self.task = {
             "start_low": [22, 30],
-            "start_medium": [7, 0],
-            "ntp_time_sync": [5, 0]
+            "start_medium": [7, 0]
         }  # default values for first time use, run-time format = [hh, mm]
 
         self.load()
@@ -41,13 +43,13 @@ class Tasks:
 
             self.task = temp
         except (ValueError, KeyError, TypeError) as e:
-            print(f"{e.__class__.__name__} loading file {filename} - {e}")
+            logger.warning("%s loading file %s - %s", e.__class__.__name__, filename, e)
         except OSError as e:
-            print(f"{e} - loading file {filename}")
+            logger.warning("%s - loading file %s", e, filename)
 
     def save(self, filename=TASKS_FILE):
         try:
             with open(filename, "w") as fp:
                 json.dump(self.task, fp)
         except OSError as e:
-            logging.critical(f"[Errno {e.args[0]}] {e.args[1]}: {filename}")
+            logger.critical("%s: %s", e, filename)
@@ -0,0 +1,33 @@
+# Boot timeline
+#
+# Records when the phases of starting the controller are completed,
+# in milliseconds since this module was imported. Import it first
+# thing in main.py so the time of the imports is included.
+#
+# Copyright 2022 (c) Erik de Lange
+# Released under MIT license
+
+import time
+
+START = time.ticks_ms()
+
+phases = list()  # list of (phase name, ms since START) in order of completion
+
+
+def mark(phase):
+    """ Record completion of a boot phase (only the first time) """
+    for name, _ in phases:
+        if name == phase:
+            return
+    phases.append((phase, time.ticks_diff(time.ticks_ms(), START)))
+
+
+def reached(phase):
+    for name, _ in phases:
+        if name == phase:
+            return True
+    return False
+
+
+def as_dict():
+    return {name: ms for name, ms in phases}
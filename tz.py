@@ -0,0 +1,88 @@
+# Local time
+#
+# The RTC runs in UTC. Local time is derived from a table with the UTC
+# times at which the offset from UTC changes. The table is computed
+# once at import for the timezone in config.py, using the EU rule for
+# daylight saving time: from the last Sunday of March 01:00 UTC until
+# the last Sunday of October 01:00 UTC. A change to or from daylight
+# saving time is effective immediately, no time synchronization needed.
+#
+# Copyright 2022 (c) Erik de Lange
+# Released under MIT license
+
+import time
+from array import array
+
+from config import TZ_DAYLIGHT_OFFSET, TZ_FIRST_YEAR, TZ_STANDARD_OFFSET, TZ_YEARS
+
+
+def last_sunday(year, month):
+    """ Return time.time() at 01:00 UTC on the last Sunday of month (March or October) """
+    t = time.mktime((year, month, 31, 1, 0, 0, 0, 0))
+    weekday = time.gmtime(t)[6]  # 0 = Monday
+    return t - ((weekday + 1) % 7) * 86400
+
+
+def build(first_year=TZ_FIRST_YEAR, years=TZ_YEARS):
+    """ Create the transition table
+
+    Segment i starts at transitions[i] (UTC) and uses offsets[i] until
+    transitions[i + 1]. The last segment has no end.
+
+    :return tuple: (array transitions, array offsets)
+    """
+    transitions = array("L", [0])
+    offsets = array("l", [TZ_STANDARD_OFFSET])
+
+    if TZ_DAYLIGHT_OFFSET != TZ_STANDARD_OFFSET:
+        for year in range(first_year, first_year + years):
+            transitions.append(last_sunday(year, 3))
+            offsets.append(TZ_DAYLIGHT_OFFSET)
+            transitions.append(last_sunday(year, 10))
+            offsets.append(TZ_STANDARD_OFFSET)
+
+    return transitions, offsets
+
+
+transitions, offsets = build()
+_segment = 0  # segment used for the previous lookup
+
+
+def utcoffset(t):
+    """ Return the offset from UTC in seconds at UTC time t
+
+    Normally t lies in the same segment as the previous lookup, or the
+    one after it, so the lookup takes constant time. Otherwise the
+    segment is found by binary search.
+    """
+    global _segment
+
+    i = _segment
+    last = len(transitions) - 1
+    for _ in range(2):
+        if transitions[i] <= t and (i == last or t < transitions[i + 1]):
+            _segment = i
+            return offsets[i]
+        if i == last:
+            break
+        i += 1
+
+    low, high = 0, last
+    while low < high:
+        middle = (low + high + 1) // 2
+        if transitions[middle] <= t:
+            low = middle
+        else:
+            high = middle - 1
+    _segment = low
+    return offsets[low]
+
+
+def localtime(t=None):
+    """ Return local time as a tuple like time.localtime()
+
+    :param int t: UTC in seconds since the epoch, now if None
+    """
+    if t is None:
+        t = time.time()
+    return time.gmtime(t + utcoffset(t))
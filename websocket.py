@@ -0,0 +1,116 @@
+# Minimal WebSocket support (RFC 6455) for ahttpserver
+#
+# Only what the user interface needs is implemented: the server side
+# handshake, unfragmented text frames, ping/pong and close. A client
+# frame which is not masked, or is a fragment, is a protocol error and
+# closes the connection with status 1002, a text message which is not
+# valid UTF-8 with status 1007. Frames
+# sent by the server are built by WebSocket.frame() so a broadcaster
+# can format a frame once and send it to many clients.
+#
+# Copyright 2022 (c) Erik de Lange
+# Released under MIT license
+
+import binascii
+import hashlib
+import struct
+
+from micropython import const
+
+
+class WebSocket:
+    GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+    MAX_PAYLOAD = const(1024)  # larger messages from the client are refused
+    MAX_HANDLERS = const(4)  # messages of a client handled at the same time, see controller.api_ws
+
+    # Opcodes
+    OP_CONTINUATION = const(0x0)
+    OP_TEXT = const(0x1)
+    OP_BINARY = const(0x2)
+    OP_CLOSE = const(0x8)
+    OP_PING = const(0x9)
+    OP_PONG = const(0xA)
+
+    def __init__(self, reader, output):
+        """ Create the server side of a WebSocket connection
+
+        :param StreamReader reader: client connection
+        :param function output: called with a complete frame (bytes) to send it to the client
+        """
+        self.reader = reader
+        self.output = output
+        self.handlers = 0  # messages being handled
+
+    @staticmethod
+    async def handshake(writer, key):
+        """ Accept the upgrade of an HTTP request to a WebSocket
+
+        :param StreamWriter writer: client connection
+        :param str key: value of the Sec-WebSocket-Key request header
+        """
+        accept = binascii.b2a_base64(hashlib.sha1((key + WebSocket.GUID).encode()).digest()).strip().decode()
+        writer.write("HTTP/1.1 101 Switching Protocols\r\n"
+                     "Upgrade: websocket\r\n"
+                     "Connection: Upgrade\r\n"
+                     f"Sec-WebSocket-Accept: {accept}\r\n\r\n")
+        await writer.drain()
+
+    @staticmethod
+    def frame(payload, opcode=OP_TEXT):
+        """ Build an unmasked server frame
+
+        :param str payload: data to send
+        :param int opcode: frame type
+        :return bytes: complete frame
+        """
+        if type(payload) is str:
+            payload = payload.encode()
+        length = len(payload)
+        if length < 126:
+            header = struct.pack("!BB", 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+        return header + payload
+
+    async def receive(self):
+        """ Wait for the next text message from the client
+
+        Ping frames are answered and a close frame is confirmed.
+
+        :return str: message received, None if the connection was closed
+        """
+        while True:
+            header = await self.reader.readexactly(2)
+            opcode = header[0] & 0x0F
+            if header[0] & 0x80 == 0 or opcode == WebSocket.OP_CONTINUATION or header[1] & 0x80 == 0:
+                self.output(WebSocket.frame(struct.pack("!H", 1002), WebSocket.OP_CLOSE))  # fragment or unmasked
+                return None
+            length = header[1] & 0x7F
+            if length == 126:
+                length = struct.unpack("!H", await self.reader.readexactly(2))[0]
+            elif length == 127:
+                length = struct.unpack("!Q", await self.reader.readexactly(8))[0]
+            if length > WebSocket.MAX_PAYLOAD:
+                self.output(WebSocket.frame(struct.pack("!H", 1009), WebSocket.OP_CLOSE))  # message too big
+                return None
+
+            mask = await self.reader.readexactly(4)
+            payload = bytearray(await self.reader.readexactly(length))
+            for i in range(length):
+                payload[i] ^= mask[i & 3]
+
+            if opcode == WebSocket.OP_TEXT:
+                try:
+                    return payload.decode()
+                except UnicodeError:
+                    self.output(WebSocket.frame(struct.pack("!H", 1007), WebSocket.OP_CLOSE))  # invalid UTF-8
+                    return None
+            if opcode == WebSocket.OP_PING:
+                self.output(WebSocket.frame(payload, WebSocket.OP_PONG))
+            elif opcode == WebSocket.OP_CLOSE:
+                self.output(WebSocket.frame(payload[:2], WebSocket.OP_CLOSE))
+                return None
+            # binary and pong frames are ignored
@@ -0,0 +1,136 @@
+# Wake-on-Radio statistics and microcontroller sleep
+#
+# In Wake-on-Radio mode (ITHO.init_wor) the CC1101 only listens during
+# a fraction of every poll interval. An Itho message is only received
+# if its sync word arrives while the receiver is on, as the preamble in
+# front of it is short. So per copy of a message the chance of
+# reception is about the receive duty cycle, and per button press (3
+# copies) somewhat higher. This module estimates these rates and
+# measures them from the received messages: the counter of a remote
+# increases with every button press, so a gap reveals missed presses.
+#
+# Copyright 2022 (c) Erik de Lange
+# Released under MIT license
+
+import time
+
+from micropython import const
+
+try:
+    import esp32  # wakeup from light sleep by GD02
+    import machine
+except ImportError:
+    esp32 = None
+
+SYNC_US = const(417)  # duration of the 16 bit sync word at 38.4 kBaud
+MAX_GAP = const(16)  # larger counter gaps are not counted as missed presses
+
+
+def duty_cycle(rx_time):
+    """ Return the fraction of a poll interval the receiver is on (MCSM2.RX_TIME, WOR_RES = 0) """
+    return 0.125 / (1 << rx_time)
+
+
+def expected_capture(interval, rx_time, copies=3):
+    """ Estimate the fraction of messages received compared to continuous receive mode
+
+    :param int interval: ms between polls
+    :param int rx_time: MCSM2.RX_TIME
+    :param int copies: number of copies sent per button press
+    :return tuple: (fraction of copies received, fraction of button presses received)
+    """
+    window = duty_cycle(rx_time) * interval * 1000 - SYNC_US  # us in which a sync word can start
+    copy = min(max(window / (interval * 1000), 0), 1)
+    return copy, 1 - (1 - copy) ** copies
+
+
+class CaptureStatistics:
+
+    def __init__(self, copies=3):
+        """ Count received button presses and detect missed ones
+
+        :param int copies: number of copies sent per button press
+        """
+        self.copies = copies
+        self.presses = 0
+        self.missed = 0
+        self.last = dict()  # key is remote type and id, value is last counter
+        self.start = time.ticks_ms()
+        self.awake = 0  # ms the microcontroller was not in light sleep
+        self.slept = 0  # ms the microcontroller was in light sleep
+
+    def record(self, packet):
+        """ Account a delivered (first copy of a) message """
+        self.presses += 1
+        source = (packet.remote_type << 24) | (packet.remote_id[0] << 16) | (packet.remote_id[1] << 8) | packet.remote_id[2]
+        last = self.last.get(source)
+        if last is not None:
+            gap = (packet.counter - last - 1) & 0xFF
+            if gap < MAX_GAP:
+                self.missed += gap
+        self.last[source] = packet.counter
+
+    def as_dict(self, duplicates=None):
+        """ Return the measured capture rates
+
+        :param DuplicateFilter duplicates: filter counting the repeated copies received
+        """
+        result = {
+            "presses": self.presses,
+            "missed": self.missed,
+            "press_capture": self.presses / (self.presses + self.missed) if self.presses > 0 else None
+        }
+        if duplicates is not None and duplicates.delivered > 0:
+            frames = duplicates.delivered + duplicates.duplicates
+            result["copy_capture"] = frames / (duplicates.delivered * self.copies)
+        if self.slept > 0:
+            result["mcu_awake"] = self.awake / (self.awake + self.slept)
+        return result
+
+
+def lightsleep(pin, timeout, statistics=None):
+    """ Put the microcontroller in light sleep until pin (GD02) goes high or timeout ms
+
+    GD02 goes high when the CC1101 detects a sync word, the message is
+    then received while the microcontroller wakes up. Does nothing if
+    the port does not support waking up by a pin (GD02 must be connected
+    to an RTC GPIO).
+
+    :param Pin pin: GD02
+    :param int timeout: maximum ms to sleep
+    :param CaptureStatistics statistics: accounts the time awake and asleep
+    """
+    if esp32 is None:
+        return
+    start = time.ticks_ms()
+    if statistics is not None:
+        statistics.awake = time.ticks_diff(start, statistics.start) - statistics.slept
+    esp32.wake_on_ext0(pin=pin, level=esp32.WAKEUP_ANY_HIGH)
+    machine.lightsleep(timeout)
+    if statistics is not None:
+        statistics.slept += time.ticks_diff(time.ticks_ms(), start)
+
+
+if __name__ == "__main__":
+    # Compare the estimate, which assumes copies arrive independently, with a simulation
+    # where the copies of a button press follow each other at a fixed spacing (one 52
+    # byte frame plus 40 ms, as sent by ITHO.send_command) at a random poll phase.
+
+    import random
+
+    SPACING_US = 40000 + 10840
+    PRESSES = 10000
+
+    for interval in (5, 20, 100):
+        for rx_time in (0, 2, 4):
+            copy, press = expected_capture(interval, rx_time)
+            window = duty_cycle(rx_time) * interval * 1000 - SYNC_US
+            copies = presses = 0
+            for _ in range(PRESSES):
+                start = random.random() * interval * 1000
+                received = sum(1 for k in range(3) if (start + k * SPACING_US) % (interval * 1000) <= window)
+                copies += received
+                presses += received > 0
+            print(f"interval {interval:3d} ms, duty cycle {duty_cycle(rx_time) * 100:5.2f}%:"
+                  f" copies {copy * 100:5.1f}% (simulated {copies / PRESSES / 3 * 100:5.1f}%),"
+                  f" presses {press * 100:5.1f}% (simulated {presses / PRESSES * 100:5.1f}%)")